@@ -0,0 +1,257 @@
+import argparse
+import bisect
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+from kvstore import InMemoryKVStore
+from locktable import ShardedLockTable
+from metrics import LockMetrics
+from prevention import LockWaitTimeout, WaitDie, WoundWait
+from student import TransactionCoordinator, TransactionHandler
+
+"""
+A benchmark for the lock manager. Worker threads run transactions against a
+ShardedLockTable and an in-memory store while a detector thread looks for
+deadlocks every --detector-interval seconds and has the victims abort
+themselves.
+
+Each transaction does --length operations on keys drawn from a Zipf
+distribution over --keys keys with exponent --skew (0 is uniform). An
+operation is a read with probability --read-ratio and a write otherwise, and
+with probability --upgrade-rate it is a read followed by a write of the same
+key. Transactions access their keys in random order, so they deadlock; with
+--ordered, they sort them first and only upgrades can deadlock. Aborted
+transactions are not retried.
+
+The results are printed as a JSON object: the configuration, commits, aborts,
+abort rate, committed transactions per second, the 50th and 99th percentile
+of the time operations spent waiting for a lock (over the operations that
+waited), and the number of detector passes and the time they took. With
+--metrics, it also includes a snapshot of the lock table's LockMetrics.
+
+Example:
+
+    python bench.py --threads 8 --skew 1.1 --read-ratio 0.9
+"""
+
+clock = getattr(time, 'perf_counter', time.time)
+
+POLICIES = {
+    'none': lambda args: None,
+    'wait-die': lambda args: WaitDie(),
+    'wound-wait': lambda args: WoundWait(),
+    'timeout': lambda args: LockWaitTimeout(args.lock_timeout),
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Lock manager benchmark.')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--transactions', type=int, default=1000,
+                        help='transactions per thread')
+    parser.add_argument('--length', type=int, default=8,
+                        help='operations per transaction')
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--skew', type=float, default=0.99,
+                        help='Zipf exponent of the key distribution')
+    parser.add_argument('--read-ratio', type=float, default=0.8)
+    parser.add_argument('--upgrade-rate', type=float, default=0.05)
+    parser.add_argument('--ordered', action='store_true',
+                        help='access the keys of a transaction in sorted order')
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='none',
+                        help='deadlock prevention policy')
+    parser.add_argument('--lock-timeout', type=float, default=0.05,
+                        help='seconds before a lock wait times out, for '
+                        '--policy timeout')
+    parser.add_argument('--detector-interval', type=float, default=0.01,
+                        help='seconds between deadlock detector passes, 0 to '
+                        'turn the detector off')
+    parser.add_argument('--metrics', action='store_true',
+                        help='collect and report lock table metrics')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the results to this file')
+    return parser.parse_args(argv)
+
+"""
+Draws key indices from a Zipf distribution over range(@n): index i is drawn
+with probability proportional to 1 / (i + 1) ** @skew.
+"""
+class ZipfGenerator(object):
+
+    def __init__(self, n, skew):
+        self._cdf = []
+        total = 0.0
+        for i in range(n):
+            total += 1.0 / (i + 1) ** skew
+            self._cdf.append(total)
+        self._total = total
+
+    def __call__(self, rng):
+        return bisect.bisect_left(self._cdf, rng.random() * self._total)
+
+class Workload(object):
+
+    def __init__(self, args):
+        self._args = args
+        self._zipf = ZipfGenerator(args.keys, args.skew)
+
+    def transaction(self, rng):
+        """
+        Returns the operations of one transaction as a list of (@key, @write)
+        pairs.
+        """
+        args = self._args
+        keys = ['k%d' % self._zipf(rng) for i in range(args.length)]
+        if args.ordered:
+            keys.sort()
+        operations = []
+        for key in keys:
+            if rng.random() < args.upgrade_rate:
+                operations.append((key, False))
+                operations.append((key, True))
+            else:
+                operations.append((key, rng.random() >= args.read_ratio))
+        return operations
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank @fraction percentile of the sorted list @values,
+    or 0 if it is empty.
+    """
+    if not values:
+        return 0
+    index = min(len(values) - 1, max(0, int(fraction * len(values) + 0.5) - 1))
+    return values[index]
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self._args = args
+        self._workload = Workload(args)
+        self._metrics = LockMetrics() if args.metrics else None
+        self._lock_table = ShardedLockTable(
+            args.shards, prevention=POLICIES[args.policy](args),
+            metrics=self._metrics)
+        self._store = InMemoryKVStore()
+        self._coordinator = TransactionCoordinator(self._lock_table)
+        self._handlers = {}
+        self._mutex = threading.Lock()
+        self._xids = itertools.count()
+        self._stop = threading.Event()
+        self._commits = 0
+        self._aborts = 0
+        self._operations = 0
+        self._waits = []
+        self._detector_runs = 0
+        self._detector_time = 0.0
+
+    def run(self):
+        """
+        Runs the benchmark and returns the results as a dict.
+        """
+        args = self._args
+        workers = [threading.Thread(target=self._worker,
+                                    args=(random.Random(args.seed + i),))
+                   for i in range(args.threads)]
+        detector = None
+        if args.detector_interval > 0:
+            detector = threading.Thread(target=self._detector)
+            detector.start()
+        start = clock()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = clock() - start
+        self._stop.set()
+        if detector is not None:
+            detector.join()
+        waits = sorted(self._waits)
+        transactions = self._commits + self._aborts
+        results = {
+            'config': vars(args),
+            'elapsed': elapsed,
+            'transactions': transactions,
+            'commits': self._commits,
+            'aborts': self._aborts,
+            'abort_rate': float(self._aborts) / transactions if transactions
+            else 0.0,
+            'throughput': self._commits / elapsed if elapsed else 0.0,
+            'operations': self._operations,
+            'lock_waits': len(waits),
+            'lock_wait_p50_ms': percentile(waits, 0.5) * 1000,
+            'lock_wait_p99_ms': percentile(waits, 0.99) * 1000,
+            'detector_runs': self._detector_runs,
+            'detector_time_ms': self._detector_time * 1000,
+        }
+        if self._metrics is not None:
+            results['metrics'] = self._metrics.snapshot()
+        return results
+
+    def _worker(self, rng):
+        commits = aborts = operations = 0
+        waits = []
+        for i in range(self._args.transactions):
+            with self._mutex:
+                xid = next(self._xids)
+            handler = TransactionHandler(self._lock_table, xid, self._store)
+            with self._mutex:
+                self._handlers[xid] = handler
+            aborted = False
+            for key, write in self._workload.transaction(rng):
+                operations += 1
+                start = clock()
+                if write:
+                    result = handler.perform_put(key, str(xid))
+                else:
+                    result = handler.perform_get(key)
+                if result is None:
+                    result = handler.wait_for_lock()
+                    waits.append(clock() - start)
+                if result is None or result == 'Deadlock Abort':
+                    aborted = True
+                    break
+            if aborted:
+                aborts += 1
+            else:
+                handler.commit()
+                commits += 1
+            with self._mutex:
+                del self._handlers[xid]
+        with self._mutex:
+            self._commits += commits
+            self._aborts += aborts
+            self._operations += operations
+            self._waits.extend(waits)
+
+    def _detector(self):
+        while not self._stop.wait(self._args.detector_interval):
+            start = clock()
+            victims = self._coordinator.find_deadlocks()
+            self._detector_time += clock() - start
+            self._detector_runs += 1
+            for xid in victims:
+                with self._mutex:
+                    handler = self._handlers.get(xid)
+                # A victim that is no longer waiting is no longer part of a
+                # deadlock. Handlers are not thread-safe, so the victim is
+                # only marked, and aborts itself in wait_for_lock().
+                if handler is not None and \
+                        self._lock_table.waiting_on(xid) is not None:
+                    handler.wound()
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = Benchmark(args).run()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
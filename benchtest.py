@@ -0,0 +1,35 @@
+import random
+import unittest
+
+from bench import Benchmark, ZipfGenerator, parse_args, percentile
+
+class BenchTest(unittest.TestCase):
+    def test_zipf(self):
+        rng = random.Random(0)
+        zipf = ZipfGenerator(100, 1.0)
+        counts = [0] * 100
+        for i in range(10000):
+            counts[zipf(rng)] += 1
+        self.assertTrue(counts[0] > counts[1] > counts[10] > counts[99])
+        uniform = ZipfGenerator(4, 0)
+        self.assertEqual(sorted(set(uniform(rng) for i in range(100))),
+                         [0, 1, 2, 3])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([], 0.5), 0)
+
+    def test_run(self):
+        for policy in ('none', 'wait-die'):
+            args = parse_args(['--threads', '2', '--transactions', '20',
+                               '--keys', '10', '--policy', policy])
+            results = Benchmark(args).run()
+            self.assertEqual(results['transactions'], 40)
+            self.assertEqual(results['commits'] + results['aborts'], 40)
+            self.assertTrue(results['lock_wait_p50_ms'] <=
+                            results['lock_wait_p99_ms'])
+
+if __name__ == '__main__':
+    unittest.main()
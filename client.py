@@ -0,0 +1,535 @@
+import asyncio
+import collections
+import contextlib
+import json
+import socket
+import sys
+
+import protocol
+from protocol import (ABORT, BEGIN, COMMIT, COMMITTED, DEADLOCK_ABORT, GET,
+                      IN_DOUBT, INVALID, KILL, MGET, MPUT, OK, PREPARE, PUT,
+                      RESOLVE, USER_ABORT, WAITS_FOR, WAITS_FOR_DELTA)
+from server import HOST, PORT
+
+"""
+Client libraries for the key-value store server. This module requires
+Python 3.
+
+Connection is an asyncio connection to the server. Like the server side of a
+connection, it runs one transaction at a time. Requests are pipelined: get(),
+put(), multi_get() and multi_put() write their request as soon as they are
+called and return a future for the response, so a caller can issue several
+requests before awaiting any of them and pays for one round trip instead of
+one per request. commit() and abort() wait for the requests in flight first.
+Connections opened with binary=True negotiate the binary protocol of
+protocol.py, and then also report the xid of their transaction.
+
+If the server aborts the transaction, the request that was aborted and every
+request of the transaction after it fail with TransactionAborted, and so does
+commit(). Requests that were already in flight when the abort arrived have
+started a new transaction on the server, which the connection aborts for
+them. Call abort() to start over on the same connection.
+
+ConnectionPool keeps up to @size connections open and hands them out one
+transaction at a time, and execute() runs a batch of operations in one
+pipelined transaction.
+
+KVStoreCommandLineClient sends the lines typed on its standard input to the
+server and prints the responses.
+"""
+
+class TransactionAborted(Exception):
+    """
+    Raised by the requests of a transaction that the server aborted. The
+    argument is the server's response, 'Deadlock Abort' or 'User Abort'.
+    """
+
+def _check_key(key):
+    if not key or ' ' in key or '\n' in key:
+        raise ValueError('invalid key %r' % (key,))
+
+def _check_value(value):
+    if '\n' in value:
+        raise ValueError('values cannot contain newlines')
+
+_STATUSES = dict((message, status)
+                 for status, message in protocol.MESSAGES.items())
+
+def _value(value):
+    return None if value == 'No such key' else value
+
+"""
+Requests and responses in the text protocol. Keys cannot contain spaces and
+values cannot contain newlines.
+"""
+class _TextCodec(object):
+
+    def encode(self, opcode, args):
+        if opcode == GET:
+            _check_key(args[0])
+            line = 'GET %s' % args[0]
+        elif opcode == PUT:
+            _check_key(args[0])
+            _check_value(args[1])
+            line = 'PUT %s %s' % args
+        elif opcode == MGET:
+            for key in args[0]:
+                _check_key(key)
+            line = 'MGET %s' % ' '.join(args[0])
+        elif opcode == MPUT:
+            for key, value in args[0].items():
+                _check_key(key)
+                _check_value(value)
+            line = 'MPUT %s' % json.dumps(args[0])
+        elif opcode in (BEGIN, WAITS_FOR, WAITS_FOR_DELTA, KILL, PREPARE,
+                        IN_DOUBT, RESOLVE):
+            raise ValueError('only the binary protocol supports this request')
+        else:
+            line = 'COMMIT' if opcode == COMMIT else 'ABORT'
+        return line.encode('utf-8') + b'\n'
+
+    async def read(self, reader):
+        return await reader.readline()
+
+    def decode(self, response, opcode):
+        response = response.decode('utf-8').rstrip('\n')
+        status = _STATUSES.get(response, OK)
+        if status == COMMITTED and opcode != COMMIT:
+            # A value that happens to read 'Transaction Completed'
+            status = OK
+        if status != OK:
+            return status, None, None
+        if opcode == GET:
+            return OK, None, _value(response)
+        if opcode == MGET:
+            return OK, None, [_value(value) for value in json.loads(response)]
+        return OK, None, None
+
+"""
+Requests and responses in the binary protocol.
+"""
+class _BinaryCodec(object):
+
+    def encode(self, opcode, args):
+        return protocol.encode_request(opcode, args)
+
+    async def read(self, reader):
+        header = await reader.readexactly(protocol.HEADER_SIZE)
+        return await reader.readexactly(protocol.frame_length(header))
+
+    def decode(self, response, opcode):
+        return protocol.decode_response(memoryview(response), opcode)
+
+class Connection(object):
+
+    def __init__(self, reader, writer, binary=False):
+        self._reader = reader
+        self._writer = writer
+        self._codec = _BinaryCodec() if binary else _TextCodec()
+        # (future, opcode) per request in flight, or None for a response to
+        # be ignored
+        self._pending = collections.deque()
+        self._aborted = None
+        self._active = False
+        self._closed = False
+        self.xid = None
+        self._reading = asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def open(cls, host=HOST, port=PORT, binary=False):
+        """
+        Connects to the server, switching the connection to the binary
+        protocol if @binary is True.
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        if binary:
+            writer.write(protocol.HELLO)
+            if await reader.readline() != protocol.HELLO_REPLY:
+                writer.close()
+                raise ConnectionError('the server does not speak the binary '
+                                      'protocol')
+        return cls(reader, writer, binary)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def in_transaction(self):
+        """
+        True if requests have been sent since the last commit() or abort().
+        """
+        return self._active
+
+    def get(self, key):
+        """
+        @return: a future for the value of @key, or None if there is no such
+        key.
+        """
+        return self._request(GET, (key,))
+
+    def put(self, key, value):
+        """
+        @return: a future for 'Success'.
+        """
+        return self._request(PUT, (key, value))
+
+    def multi_get(self, keys):
+        """
+        Reads all of @keys with a single request.
+
+        @return: a future for the list of their values, with None for keys
+        that do not exist.
+        """
+        if not keys:
+            raise ValueError('no keys')
+        return self._request(MGET, (keys,))
+
+    def multi_put(self, items):
+        """
+        Writes the key-value pairs in the dict @items with a single request.
+
+        @return: a future for 'Success'.
+        """
+        if not items:
+            raise ValueError('no items')
+        return self._request(MPUT, (items,))
+
+    def begin(self, xid):
+        """
+        Starts the next transaction with xid @xid. Binary connections only.
+
+        @return: a future for None.
+        """
+        return self._request(BEGIN, (xid,))
+
+    def waits_for(self):
+        """
+        Asks for the server's waits-for graph. Binary connections only, and
+        not part of a transaction.
+
+        @return: a future for a list of (@waiter, @blocker) pairs.
+        """
+        return self._request(WAITS_FOR, (), transactional=False)
+
+    def waits_for_delta(self):
+        """
+        Asks for the edges added to and removed from the server's waits-for
+        graph since this connection last asked; the first time, every edge is
+        added. Binary connections only, and not part of a transaction.
+
+        @return: a future for a tuple (@added, @removed) of lists of
+        (@waiter, @blocker) pairs.
+        """
+        return self._request(WAITS_FOR_DELTA, (), transactional=False)
+
+    def kill(self, xid):
+        """
+        Has the server abort transaction @xid as a deadlock victim. Binary
+        connections only, and not part of a transaction.
+
+        @return: a future for None.
+        """
+        return self._request(KILL, (xid,), transactional=False)
+
+    def in_doubt(self):
+        """
+        Asks for the xids of the server's in-doubt transactions. Binary
+        connections only, and not part of a transaction.
+
+        @return: a future for the sorted list of xids.
+        """
+        return self._request(IN_DOUBT, (), transactional=False)
+
+    def resolve(self, xid, commit):
+        """
+        Has the server commit (if @commit is True) or abort the in-doubt
+        transaction @xid. Binary connections only, and not part of a
+        transaction.
+
+        @return: a future for None.
+        """
+        return self._request(RESOLVE, (xid, commit), transactional=False)
+
+    async def prepare(self):
+        """
+        Waits for the requests in flight and prepares the transaction for
+        two-phase commit. Binary connections only.
+
+        @return: 'Prepared', after which commit() or abort() finishes the
+        transaction, or 'Transaction Completed' if it had nothing to commit
+        and has committed.
+        """
+        await self._flush()
+        if self._aborted is not None:
+            raise TransactionAborted(self._aborted)
+        response = await self._request(PREPARE, ())
+        if response != 'Prepared':
+            self._active = False
+        return response
+
+    async def commit(self):
+        """
+        Waits for the requests in flight and commits the transaction.
+
+        @return: 'Transaction Completed'.
+        @raise TransactionAborted: if the server aborted the transaction,
+        before or instead of committing it.
+        """
+        await self._flush()
+        if self._aborted is not None:
+            raise TransactionAborted(self._aborted)
+        if not self._active:
+            return 'Transaction Completed'
+        response = await self._request(COMMIT, ())
+        self._active = False
+        return response
+
+    async def abort(self):
+        """
+        Waits for the requests in flight and aborts the transaction, unless
+        the server already did.
+
+        @return: the response that ended the transaction.
+        """
+        await self._flush()
+        if self._aborted is not None:
+            response, self._aborted = self._aborted, None
+        elif self._active:
+            response = await self._request(ABORT, ())
+        else:
+            response = 'User Abort'
+        self._active = False
+        return response
+
+    async def close(self):
+        """
+        Closes the connection. The server aborts an unfinished transaction.
+        """
+        if not self._closed:
+            self._closed = True
+            self._writer.close()
+        self._reading.cancel()
+        with contextlib.suppress(asyncio.CancelledError, ConnectionError):
+            await self._reading
+        with contextlib.suppress(ConnectionError):
+            await self._writer.wait_closed()
+
+    def _request(self, opcode, args, transactional=True):
+        data = self._codec.encode(opcode, args)
+        future = asyncio.get_event_loop().create_future()
+        if self._closed:
+            future.set_exception(ConnectionError('connection closed'))
+        elif self._aborted is not None:
+            future.set_exception(TransactionAborted(self._aborted))
+        else:
+            self._writer.write(data)
+            self._pending.append((future, opcode))
+            self._active = self._active or transactional
+        return future
+
+    async def _flush(self):
+        futures = [entry[0] for entry in self._pending if entry is not None]
+        if futures:
+            await asyncio.gather(*futures, return_exceptions=True)
+        await self._writer.drain()
+
+    async def _read_responses(self):
+        try:
+            while True:
+                response = await self._codec.read(self._reader)
+                if not response:
+                    break
+                entry = self._pending.popleft()
+                if entry is not None:
+                    self._resolve(entry, response)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._closed = True
+            while self._pending:
+                entry = self._pending.popleft()
+                if entry is not None and not entry[0].done():
+                    entry[0].set_exception(ConnectionError('connection lost'))
+
+    def _resolve(self, entry, response):
+        future, opcode = entry
+        status, xid, value = self._codec.decode(response, opcode)
+        if xid is not None:
+            self.xid = xid
+        # A router answers COMMIT with an abort if the transaction fails to
+        # prepare somewhere, which is a failure like any other abort
+        ending = opcode in (ABORT, PREPARE)
+        if self._aborted is not None:
+            # Sent after the transaction was aborted, so it ran in a new one
+            error = TransactionAborted(self._aborted)
+        elif status in (USER_ABORT, DEADLOCK_ABORT) and not ending:
+            self._aborted = protocol.MESSAGES[status]
+            error = TransactionAborted(self._aborted)
+            if self._pending:
+                # Roll back the transaction the requests in flight started
+                self._writer.write(self._codec.encode(ABORT, ()))
+                self._pending.append(None)
+        elif status == INVALID:
+            error = ValueError(protocol.MESSAGES[status])
+        else:
+            error = None
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        elif status != OK:
+            future.set_result(protocol.MESSAGES[status])
+        elif opcode in (PUT, MPUT):
+            future.set_result('Success')
+        else:
+            future.set_result(value)
+
+"""
+A pool of up to @size connections to the server at @host:@port, or of any
+number if @size is None, which use the binary protocol if @binary is True.
+Connections are opened when they are first needed and reused by later
+transactions.
+"""
+class ConnectionPool(object):
+
+    def __init__(self, host=HOST, port=PORT, size=8, binary=False):
+        self._host = host
+        self._port = port
+        self._binary = binary
+        self._idle = []
+        self._slots = asyncio.Semaphore(size) if size is not None else None
+
+    async def acquire(self):
+        """
+        Returns a connection with no transaction in progress, waiting until
+        one is free if all @size are in use.
+        """
+        if self._slots is not None:
+            await self._slots.acquire()
+        try:
+            while self._idle:
+                connection = self._idle.pop()
+                if not connection.closed:
+                    return connection
+            return await Connection.open(self._host, self._port,
+                                         self._binary)
+        except BaseException:
+            if self._slots is not None:
+                self._slots.release()
+            raise
+
+    def release(self, connection):
+        """
+        Returns @connection to the pool. A connection that is still in a
+        transaction is closed instead, which makes the server abort it.
+        """
+        if connection.closed or connection.in_transaction:
+            asyncio.ensure_future(connection.close())
+        else:
+            self._idle.append(connection)
+        if self._slots is not None:
+            self._slots.release()
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        An asynchronous context manager that runs a transaction on a pooled
+        connection. The transaction commits when the block exits and aborts
+        if the block raises.
+        """
+        connection = await self.acquire()
+        try:
+            yield connection
+            await connection.commit()
+        except BaseException:
+            with contextlib.suppress(ConnectionError):
+                await connection.abort()
+            raise
+        finally:
+            self.release(connection)
+
+    async def execute(self, operations):
+        """
+        Runs @operations in one transaction and commits it. The requests are
+        pipelined, and runs of consecutive reads or writes are sent as one
+        MGET or MPUT request.
+
+        @param operations: a list of ('GET', @key) and ('PUT', @key, @value)
+        tuples.
+        @return: the list of their results: the value (or None) for each
+        read and 'Success' for each write.
+        @raise TransactionAborted: if the server aborted the transaction.
+        """
+        batches = []
+        for operation in operations:
+            command = operation[0].upper()
+            if command not in ('GET', 'PUT'):
+                raise ValueError('unknown operation %r' % (operation,))
+            if batches and batches[-1][0] == command:
+                batches[-1][1].append(operation[1:])
+            else:
+                batches.append((command, [operation[1:]]))
+        async with self.transaction() as connection:
+            futures = []
+            for command, arguments in batches:
+                if command == 'GET':
+                    futures.append(connection.multi_get(
+                        [key for key, in arguments]))
+                else:
+                    futures.append(connection.multi_put(dict(arguments)))
+            responses = await asyncio.gather(*futures, return_exceptions=True)
+            for response in responses:
+                if isinstance(response, BaseException):
+                    raise response
+        results = []
+        for (command, arguments), response in zip(batches, responses):
+            if command == 'GET':
+                results.extend(response)
+            else:
+                results.extend([response] * len(arguments))
+        return results
+
+    async def close(self):
+        """
+        Closes the idle connections.
+        """
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            await connection.close()
+
+class KVStoreCommandLineClient(object):
+
+    def __init__(self, host=HOST, port=PORT):
+        self._host = host
+        self._port = port
+
+    def run(self, stdin=None, stdout=None):
+        """
+        Sends each line read from @stdin to the server and writes the response
+        to @stdout, until the input ends or the line is 'QUIT'.
+        """
+        stdin = stdin or sys.stdin
+        stdout = stdout or sys.stdout
+        interactive = stdin.isatty()
+        with socket.create_connection((self._host, self._port)) as sock:
+            server = sock.makefile('rwb')
+            while True:
+                if interactive:
+                    stdout.write('> ')
+                    stdout.flush()
+                line = stdin.readline()
+                if not line or line.strip().upper() == 'QUIT':
+                    break
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                server.write(line.encode('utf-8') + b'\n')
+                server.flush()
+                response = server.readline()
+                if not response:
+                    stdout.write('Connection closed\n')
+                    break
+                stdout.write(response.decode('utf-8'))
+                stdout.flush()
+            server.close()
@@ -0,0 +1,149 @@
+import asyncio
+import io
+import threading
+import unittest
+
+from client import (Connection, ConnectionPool, KVStoreCommandLineClient,
+                    TransactionAborted)
+from kvstore import InMemoryKVStore
+from server import KVStoreServer
+from servertest import ServerFixture
+
+class ClientTest(ServerFixture, unittest.TestCase):
+    binary = False
+
+    def test_pipelined_requests(self):
+        async def scenario(server):
+            connection = await Connection.open(port=server.port,
+                                               binary=self.binary)
+            # Nothing is awaited until all the requests have been sent
+            put = connection.put('a', 'hello world')
+            get = connection.get('a')
+            missing = connection.get('b')
+            multi_put = connection.multi_put({'b': '1', 'c': '2'})
+            multi_get = connection.multi_get(['a', 'b', 'c', 'd'])
+            self.assertEqual(await connection.commit(),
+                             'Transaction Completed')
+            self.assertEqual(await put, 'Success')
+            self.assertEqual(await get, 'hello world')
+            self.assertIsNone(await missing)
+            self.assertEqual(await multi_put, 'Success')
+            self.assertEqual(await multi_get, ['hello world', '1', '2', None])
+            self.assertFalse(connection.in_transaction)
+            await connection.close()
+        self.run_server(scenario)
+
+    def test_execute(self):
+        async def scenario(server):
+            pool = ConnectionPool(port=server.port, size=2,
+                                  binary=self.binary)
+            results = await pool.execute([('PUT', 'a', '0'), ('PUT', 'b', '1'),
+                                          ('GET', 'a'), ('GET', 'c'),
+                                          ('PUT', 'c', '2')])
+            self.assertEqual(results, ['Success', 'Success', '0', None,
+                                       'Success'])
+            results = await pool.execute([('GET', 'a'), ('GET', 'b'),
+                                          ('GET', 'c')])
+            self.assertEqual(results, ['0', '1', '2'])
+            # Both transactions ran on the same connection
+            self.assertEqual(len(pool._idle), 1)
+            with self.assertRaises(ValueError):
+                await pool.execute([('DELETE', 'a')])
+            await pool.close()
+        self.run_server(scenario)
+
+    def test_transaction_aborts_on_error(self):
+        async def scenario(server):
+            pool = ConnectionPool(port=server.port, binary=self.binary)
+            with self.assertRaises(RuntimeError):
+                async with pool.transaction() as connection:
+                    await connection.put('a', '0')
+                    raise RuntimeError()
+            self.assertEqual(await pool.execute([('GET', 'a')]), [None])
+            await pool.close()
+        self.run_server(scenario)
+
+    def test_deadlock_abort(self):
+        async def scenario(server):
+            connection1 = await Connection.open(port=server.port,
+                                                binary=self.binary)
+            connection2 = await Connection.open(port=server.port,
+                                                binary=self.binary)
+            self.assertIsNone(await connection1.get('a'))
+            self.assertIsNone(await connection2.get('b'))
+            write1 = connection1.put('b', '1')
+            await asyncio.sleep(0.02)
+            write2 = connection2.put('a', '2')
+            # Pipelined behind the aborted request, so it reaches the server
+            # after the abort and must be rolled back
+            write3 = connection2.put('c', '2')
+            with self.assertRaises(TransactionAborted):
+                await write2
+            with self.assertRaises(TransactionAborted):
+                await write3
+            with self.assertRaises(TransactionAborted):
+                await connection2.commit()
+            self.assertEqual(await connection2.abort(), 'Deadlock Abort')
+            self.assertEqual(await write1, 'Success')
+            self.assertEqual(await connection1.commit(),
+                             'Transaction Completed')
+            self.assertEqual(await connection2.multi_get(['b', 'c']),
+                             ['1', None])
+            self.assertEqual(await connection2.commit(),
+                             'Transaction Completed')
+            await connection1.close()
+            await connection2.close()
+        self.run_server(scenario)
+
+    def test_command_line_client(self):
+        loop = asyncio.new_event_loop()
+        server = KVStoreServer(port=0, store=InMemoryKVStore())
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(server.start(), loop).result(5)
+            stdin = io.StringIO('PUT a 0\nGET a\n\nCOMMIT\nQUIT\nGET a\n')
+            stdout = io.StringIO()
+            KVStoreCommandLineClient(port=server.port).run(stdin, stdout)
+            self.assertEqual(stdout.getvalue(),
+                             'Success\n0\nTransaction Completed\n')
+            asyncio.run_coroutine_threadsafe(server.stop(), loop).result(5)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+class BinaryClientTest(ClientTest):
+    binary = True
+
+    def test_unescaped_strings(self):
+        async def scenario(server):
+            connection = await Connection.open(port=server.port, binary=True)
+            items = {'a key': 'two\nlines', 'b': 'User Abort', 'c': ''}
+            self.assertEqual(await connection.multi_put(items), 'Success')
+            self.assertEqual(await connection.get('a key'), 'two\nlines')
+            self.assertEqual(await connection.multi_get(['b', 'c', 'd']),
+                             ['User Abort', '', None])
+            self.assertEqual(await connection.commit(),
+                             'Transaction Completed')
+            with self.assertRaises(ValueError):
+                await connection.get('')
+            await connection.abort()
+            await connection.close()
+        self.run_server(scenario)
+
+    def test_xid(self):
+        async def scenario(server):
+            connection = await Connection.open(port=server.port, binary=True)
+            await connection.get('a')
+            first = connection.xid
+            await connection.put('a', '0')
+            self.assertEqual(connection.xid, first)
+            await connection.commit()
+            await connection.get('a')
+            self.assertNotEqual(connection.xid, first)
+            await connection.close()
+        self.run_server(scenario)
+
+if __name__ == '__main__':
+    unittest.main()
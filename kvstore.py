@@ -1,3 +1,26 @@
+import bisect
+import collections
+import contextlib
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+"""
+All stores support bulk reads and writes. get_many(@keys) returns the values
+of @keys as a list, with None for keys that do not exist, and put_many(@items)
+writes a list of (@key, @value) pairs in order.
+
+write_batch() returns a context manager that groups the puts made inside it
+into as few writes to the underlying storage as possible. Reads inside the
+batch see the batched values. The batch is always applied when the block is
+left, even if it raises, so the store ends up as if every put had been made
+directly. Batches can be nested; the outermost one applies the writes.
+
+Putting None makes the key read as missing again.
+"""
 class InMemoryKVStore:
     def __init__(self):
         self._kv_store = {}
@@ -8,13 +31,628 @@ class InMemoryKVStore:
     def put(self, key, value):
         self._kv_store[key] = value
 
+    def get_many(self, keys):
+        get = self._kv_store.get
+        return [get(key) for key in keys]
+
+    def put_many(self, items):
+        self._kv_store.update(items)
+
+    @contextlib.contextmanager
+    def write_batch(self):
+        # Writes to a dict cannot be batched any further
+        yield self
+
 class DBMStore:
-    def __init__(self):
+    def __init__(self, path='cache'):
         import dbm
-        self._kv_store = dbm.open('cache', 'c')
+        self._kv_store = dbm.open(path, 'c')
+        self._batch = None
 
     def get(self, key):
-        return self._kv_store.get(key, None)
+        if self._batch is not None and key in self._batch:
+            return self._batch[key]
+        value = self._kv_store.get(key, None)
+        if isinstance(value, bytes) and not isinstance(value, str):
+            # Python 3 dbm hands back bytes for the str values we stored
+            value = value.decode('utf-8')
+        return value
 
     def put(self, key, value):
-        self._kv_store[key] = value
+        if self._batch is not None:
+            self._batch[key] = value
+        else:
+            self._write(key, value)
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def put_many(self, items):
+        with self.write_batch():
+            for key, value in items:
+                self._batch[key] = value
+
+    @contextlib.contextmanager
+    def write_batch(self):
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = {}
+        try:
+            yield self
+        finally:
+            # Only the last value put for each key is written
+            batch, self._batch = self._batch, None
+            for key, value in batch.items():
+                self._write(key, value)
+
+    def _write(self, key, value):
+        if value is not None:
+            self._kv_store[key] = value
+        elif key in self._kv_store:
+            del self._kv_store[key]
+
+"""
+A persistent store in the style of Bitcask: an append-only log of records on
+disk and an in-memory index of where the latest value of every key is.
+
+The log is a sequence of segment files in the directory @path. Every put
+appends a record with the key and value to the active segment, so writes are
+sequential, and points the index at it. A batch is appended with a single
+write. The store can be shared by several threads, and each thread has its
+own write batch, which other threads do not see until it is applied. Once
+the active segment has grown to @max_segment_size bytes, a new one is
+started. Reads look the key up in the index and copy the value out of a
+memory map of its segment. Removing a key appends a deletion record.
+
+Values that have been overwritten or removed stay in their segments until
+compaction, which rewrites every segment except the active one into a single
+segment holding only the values the index still points to. It runs on a
+background thread once @compact_segments segments have filled up, or can be
+run with compact(). Reads and writes carry on while it runs.
+
+Each segment file is named after the range of segment numbers it covers, so
+'00000003-00000003.data' is the third segment and '00000001-00000003.data'
+the result of compacting the first three. A compacted segment is written to a
+temporary file and renamed into place, and when the store is opened any
+segment inside the range of another one is a leftover from a compaction that
+was interrupted and is deleted. The index is rebuilt by reading the segments
+in order, and a record torn by a crash, which fails its checksum, ends its
+segment.
+
+Writes reach the operating system but are not synced to disk; use a
+write-ahead log for durability. Call close() when done with the store.
+"""
+_CRC = struct.Struct('>I')
+_LENGTHS = struct.Struct('>Ii')
+_SEGMENT_NAME = re.compile(r'^(\d{8})-(\d{8})\.data$')
+
+def _record(key, value):
+    # A record is a checksum, the key and value lengths (-1 for a deletion),
+    # the key and the value
+    body = _LENGTHS.pack(len(key), -1 if value is None else len(value)) + \
+        key + (value or b'')
+    return _CRC.pack(zlib.crc32(body) & 0xffffffff) + body
+
+class _Segment(object):
+
+    __slots__ = ('first', 'last', 'path', 'reader', 'map', 'mapped')
+
+    def __init__(self, directory, first, last):
+        self.first = first
+        self.last = last
+        self.path = os.path.join(directory, '%08d-%08d.data' % (first, last))
+        self.reader = None
+        self.map = None
+        self.mapped = 0
+
+    def read(self, offset, length):
+        if offset + length > self.mapped:
+            self.remap()
+        return self.map[offset:offset + length]
+
+    def remap(self):
+        # Maps the whole file as it is now. The active segment is remapped
+        # whenever a read goes past the end of the last mapping.
+        if self.reader is None:
+            self.reader = open(self.path, 'rb')
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.mapped = 0
+        size = os.fstat(self.reader.fileno()).st_size
+        if size:
+            self.map = mmap.mmap(self.reader.fileno(), size,
+                                 access=mmap.ACCESS_READ)
+            self.mapped = size
+
+    def scan(self):
+        """
+        Returns the intact records of the segment as a list of (@key,
+        @offset, @length) tuples, where @offset and @length locate the value
+        and @length is -1 for a deletion, and the offset of the end of the
+        last intact record.
+        """
+        self.remap()
+        records = []
+        offset = 0
+        header = _CRC.size + _LENGTHS.size
+        while offset + header <= self.mapped:
+            crc, = _CRC.unpack_from(self.map, offset)
+            key_length, length = _LENGTHS.unpack_from(self.map,
+                                                      offset + _CRC.size)
+            end = offset + header + key_length + max(length, 0)
+            if end > self.mapped or zlib.crc32(
+                    self.map[offset + _CRC.size:end]) & 0xffffffff != crc:
+                break
+            key = self.map[offset + header:offset + header + key_length]
+            records.append((key.decode('utf-8'), end - max(length, 0), length))
+            offset = end
+        return records, offset
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        self.mapped = 0
+
+class LogStore:
+    def __init__(self, path='logstore', max_segment_size=64 * 1024 * 1024,
+                 compact_segments=4):
+        self._path = path
+        self._max_segment_size = max_segment_size
+        self._compact_segments = compact_segments
+        self._mutex = threading.Lock()
+        self._compaction = threading.Lock()
+        self._compactor = None
+        self._index = {}
+        self._segments = []
+        self._active = None
+        self._writer = None
+        self._size = 0
+        # The open write batch of each thread
+        self._local = threading.local()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load()
+
+    def _load(self):
+        ranges = []
+        for name in os.listdir(self._path):
+            match = _SEGMENT_NAME.match(name)
+            if match:
+                ranges.append((int(match.group(1)), int(match.group(2))))
+            elif name.endswith('.tmp'):
+                os.remove(os.path.join(self._path, name))
+        last = 0
+        for first, end in sorted(ranges, key=lambda r: (r[1], r[0])):
+            segment = _Segment(self._path, first, end)
+            if any(other != (first, end) and other[0] <= first and
+                   end <= other[1] for other in ranges):
+                # Already compacted into the segment that covers it
+                os.remove(segment.path)
+                continue
+            records, size = segment.scan()
+            if size < segment.mapped:
+                segment.close()
+                with open(segment.path, 'r+b') as f:
+                    f.truncate(size)
+            if not size:
+                segment.close()
+                os.remove(segment.path)
+                continue
+            for key, offset, length in records:
+                if length < 0:
+                    self._index.pop(key, None)
+                else:
+                    self._index[key] = (segment, offset, length)
+            self._segments.append(segment)
+            last = end
+        self._open_active(last + 1)
+
+    def _open_active(self, number):
+        self._active = _Segment(self._path, number, number)
+        self._writer = open(self._active.path, 'ab', 0)
+        self._size = 0
+
+    def close(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._mutex:
+            self._writer.close()
+            for segment in self._segments + [self._active]:
+                segment.close()
+            if not self._size:
+                os.remove(self._active.path)
+
+    def _batch(self):
+        return getattr(self._local, 'batch', None)
+
+    def get(self, key):
+        batch = self._batch()
+        if batch is not None and key in batch:
+            return batch[key]
+        with self._mutex:
+            location = self._index.get(key)
+            if location is None:
+                return None
+            segment, offset, length = location
+            return segment.read(offset, length).decode('utf-8')
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def put_many(self, items):
+        batch = self._batch()
+        if batch is not None:
+            batch.update(items)
+            return
+        # Only the last value of each key needs a record
+        items = dict(items)
+        if items:
+            with self._mutex:
+                self._append(items.items())
+
+    @contextlib.contextmanager
+    def write_batch(self):
+        if self._batch() is not None:
+            yield self
+            return
+        self._local.batch = {}
+        try:
+            yield self
+        finally:
+            batch, self._local.batch = self._local.batch, None
+            if batch:
+                with self._mutex:
+                    self._append(batch.items())
+
+    def _append(self, items):
+        records = []
+        locations = []
+        offset = self._size
+        for key, value in items:
+            key_bytes = key.encode('utf-8')
+            if value is not None:
+                value = value.encode('utf-8')
+            record = _record(key_bytes, value)
+            records.append(record)
+            offset += len(record)
+            if value is None:
+                locations.append((key, None))
+            else:
+                locations.append((key, (self._active, offset - len(value),
+                                        len(value))))
+        self._writer.write(b''.join(records))
+        self._size = offset
+        for key, location in locations:
+            if location is None:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = location
+        if self._size >= self._max_segment_size:
+            self._rotate()
+
+    def _rotate(self):
+        self._writer.close()
+        self._segments.append(self._active)
+        self._open_active(self._active.last + 1)
+        if len(self._segments) >= self._compact_segments and (
+                self._compactor is None or not self._compactor.is_alive()):
+            self._compactor = threading.Thread(target=self.compact)
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def compact(self):
+        """
+        Rewrites every segment except the active one into a single segment
+        holding only the values that are still current. Safe to call while
+        the store is in use.
+        """
+        with self._compaction:
+            with self._mutex:
+                segments = list(self._segments)
+                if not segments:
+                    return
+                members = set(segments)
+                live = [(key, location)
+                        for key, location in self._index.items()
+                        if location[0] in members]
+                # Map the segments in full now, so that reading them below
+                # never remaps them under a concurrent get()
+                for segment in segments:
+                    segment.remap()
+            merged = _Segment(self._path, segments[0].first, segments[-1].last)
+            moved = []
+            offset = 0
+            with open(merged.path + '.tmp', 'wb') as f:
+                for key, location in live:
+                    segment, value_offset, length = location
+                    value = segment.read(value_offset, length)
+                    record = _record(key.encode('utf-8'), value)
+                    f.write(record)
+                    offset += len(record)
+                    moved.append((key, location, (merged, offset - length,
+                                                  length)))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(merged.path + '.tmp', merged.path)
+            with self._mutex:
+                for key, old, new in moved:
+                    # Keys written since the snapshot already point elsewhere
+                    if self._index.get(key) is old:
+                        self._index[key] = new
+                self._segments[:len(segments)] = [merged]
+            for segment in segments:
+                segment.close()
+                if segment.path != merged.path:
+                    os.remove(segment.path)
+
+    def segment_count(self):
+        """
+        Returns the number of segment files, the active one included.
+        """
+        with self._mutex:
+            return len(self._segments) + 1
+
+"""
+A read cache in front of another store, such as a LogStore or a DBMStore. It
+keeps up to @max_entries keys, and up to @max_bytes bytes of keys and values,
+and evicts the least recently used keys first. Either limit can be None. The
+absence of a key is cached too.
+
+Puts, including the undo writes of an aborted transaction, go through to the
+wrapped store and update the cache, and write_batch() uses the wrapped store's
+batches. Writes made to the wrapped store directly are not seen by the cache.
+
+stats() returns the numbers of hits, misses and evictions so far, and the
+current numbers of entries and bytes in the cache.
+"""
+_MISSING = object()
+
+class CachedStore:
+    def __init__(self, store=None, max_entries=10000, max_bytes=None):
+        self._store = store if store is not None else LogStore()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._cache = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._mutex = threading.Lock()
+
+    def get(self, key):
+        # The wrapped store is read under the mutex too, so that a concurrent
+        # put cannot be overwritten in the cache by the value it replaced
+        with self._mutex:
+            if key in self._cache:
+                self._hits += 1
+                value = self._cache.pop(key)
+                self._cache[key] = value
+                return value
+            self._misses += 1
+            value = self._store.get(key)
+            self._insert(key, value)
+            return value
+
+    def put(self, key, value):
+        with self._mutex:
+            self._store.put(key, value)
+            self._insert(key, value)
+
+    def get_many(self, keys):
+        values = {}
+        missing = []
+        with self._mutex:
+            for key in keys:
+                if key in self._cache:
+                    self._hits += 1
+                    value = values[key] = self._cache.pop(key)
+                    self._cache[key] = value
+                elif key not in values:
+                    self._misses += 1
+                    values[key] = None
+                    missing.append(key)
+            if missing:
+                for key, value in zip(missing, self._store.get_many(missing)):
+                    values[key] = value
+                    self._insert(key, value)
+        return [values[key] for key in keys]
+
+    def put_many(self, items):
+        items = list(items)
+        with self._mutex:
+            self._store.put_many(items)
+            for key, value in items:
+                self._insert(key, value)
+
+    def write_batch(self):
+        return self._store.write_batch()
+
+    def close(self):
+        if hasattr(self._store, 'close'):
+            self._store.close()
+
+    def stats(self):
+        with self._mutex:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': len(self._cache),
+                'bytes': self._bytes,
+            }
+
+    def _insert(self, key, value):
+        old = self._cache.pop(key, _MISSING)
+        if old is not _MISSING:
+            self._bytes -= self._size(key, old)
+        size = self._size(key, value)
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+        self._cache[key] = value
+        self._bytes += size
+        while (self._max_entries is not None and
+               len(self._cache) > self._max_entries) or \
+                (self._max_bytes is not None and self._bytes > self._max_bytes):
+            old_key, old_value = self._cache.popitem(last=False)
+            self._bytes -= self._size(old_key, old_value)
+            self._evictions += 1
+
+    def _size(self, key, value):
+        return len(key) + (len(value) if value is not None else 0)
+
+"""
+An in-memory store that keeps several versions of every key for multi-version
+concurrency control.
+
+Every write gets a commit timestamp from a counter, and the versions of a key
+are kept as a pair of parallel lists (@timestamps, @values) in timestamp
+order. A reader calls begin() to get a snapshot, the
+timestamp of the last write so far, and then reads with get_at() and
+get_many_at() as of that snapshot, no matter what is written afterwards. It
+calls end() when it is done.
+
+commit_writes() installs all the writes of a transaction under a single
+timestamp, and committed_since() tells a writer whether somebody else got
+there first. get(), put() and the other plain methods work on the latest
+versions, so the store can also be used as an ordinary store.
+
+A version is garbage-collected once a newer version of the same key is visible
+to every active snapshot, which is checked whenever the oldest active snapshot
+moves forward.
+"""
+class MVCCStore:
+    def __init__(self):
+        self._versions = {}
+        self._timestamp = 0
+        self._active = {}
+        self._horizon = 0
+        self._collectable = set()
+        self._mutex = threading.Lock()
+
+    def get(self, key):
+        with self._mutex:
+            versions = self._versions.get(key)
+            return versions[1][-1] if versions else None
+
+    def put(self, key, value):
+        self.commit_writes([(key, value)])
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def put_many(self, items):
+        self.commit_writes(items)
+
+    @contextlib.contextmanager
+    def write_batch(self):
+        # Every put is its own version, there is nothing to batch
+        yield self
+
+    def begin(self):
+        """
+        Starts a snapshot of the current state of the store.
+
+        @return: the snapshot timestamp, to be passed to get_at() and end().
+        """
+        with self._mutex:
+            snapshot = self._timestamp
+            self._active[snapshot] = self._active.get(snapshot, 0) + 1
+            return snapshot
+
+    def end(self, snapshot):
+        """
+        Ends a snapshot started with begin().
+        """
+        with self._mutex:
+            count = self._active[snapshot] - 1
+            if count:
+                self._active[snapshot] = count
+            else:
+                del self._active[snapshot]
+            self._collect_garbage()
+
+    def get_at(self, key, snapshot):
+        """
+        Returns the value of @key as of @snapshot, or None.
+        """
+        with self._mutex:
+            return self._get_at(key, snapshot)
+
+    def get_many_at(self, keys, snapshot):
+        with self._mutex:
+            return [self._get_at(key, snapshot) for key in keys]
+
+    def _get_at(self, key, snapshot):
+        versions = self._versions.get(key)
+        if versions is None:
+            return None
+        index = bisect.bisect_right(versions[0], snapshot) - 1
+        return versions[1][index] if index >= 0 else None
+
+    def commit_writes(self, items):
+        """
+        Installs a list of (@key, @value) pairs as new versions under one new
+        commit timestamp. If a key appears more than once, the last value wins.
+
+        @return: the commit timestamp.
+        """
+        with self._mutex:
+            self._timestamp += 1
+            timestamp = self._timestamp
+            for key, value in dict(items).items():
+                versions = self._versions.get(key)
+                if versions is None:
+                    self._versions[key] = ([timestamp], [value])
+                else:
+                    versions[0].append(timestamp)
+                    versions[1].append(value)
+                    self._collectable.add(key)
+            self._collect_garbage()
+            return timestamp
+
+    def committed_since(self, keys, snapshot):
+        """
+        Returns True if a version of any of @keys was committed after
+        @snapshot.
+        """
+        with self._mutex:
+            for key in keys:
+                versions = self._versions.get(key)
+                if versions is not None and versions[0][-1] > snapshot:
+                    return True
+            return False
+
+    def version_count(self, key):
+        """
+        Returns the number of versions kept for @key.
+        """
+        with self._mutex:
+            versions = self._versions.get(key)
+            return len(versions[0]) if versions else 0
+
+    def _collect_garbage(self):
+        horizon = min(self._active) if self._active else self._timestamp
+        if horizon == self._horizon:
+            return
+        self._horizon = horizon
+        for key in list(self._collectable):
+            timestamps, values = self._versions[key]
+            # Keep the newest version every snapshot can see, and later ones
+            index = bisect.bisect_right(timestamps, horizon) - 1
+            if index > 0:
+                del timestamps[:index]
+                del values[:index]
+            if len(timestamps) == 1:
+                self._collectable.discard(key)
+                if values[0] is None:
+                    del self._versions[key]
@@ -0,0 +1,216 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from kvstore import CachedStore, DBMStore, InMemoryKVStore, LogStore
+
+try:
+    import dbm
+except ImportError:
+    dbm = None
+
+class CountingDict(dict):
+    def __init__(self):
+        dict.__init__(self)
+        self.writes = 0
+
+    def __setitem__(self, key, value):
+        self.writes += 1
+        dict.__setitem__(self, key, value)
+
+class KVStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for store in getattr(self, '_log_stores', ()):
+            store.close()
+        shutil.rmtree(self._dir)
+
+    def log_store(self, **options):
+        store = LogStore(os.path.join(self._dir, 'log'), **options)
+        self._log_stores = getattr(self, '_log_stores', []) + [store]
+        return store
+
+    def stores(self):
+        stores = [InMemoryKVStore(), self.log_store(),
+                  CachedStore(InMemoryKVStore(), max_entries=1)]
+        if dbm is not None:
+            stores.append(DBMStore(os.path.join(self._dir, 'cache')))
+        return stores
+
+    def test_get_put_many(self):
+        for store in self.stores():
+            store.put_many([('a', '0'), ('b', '1'), ('a', '2')])
+            self.assertEqual(store.get_many(['a', 'b', 'c']), ['2', '1', None])
+            store.put_many([('a', None)])
+            self.assertEqual(store.get('a'), None)
+
+    def test_write_batch(self):
+        for store in self.stores():
+            with store.write_batch():
+                store.put('a', '0')
+                with store.write_batch():
+                    store.put('a', '1')
+                self.assertEqual(store.get('a'), '1')
+                store.put('b', '2')
+            self.assertEqual(store.get_many(['a', 'b']), ['1', '2'])
+
+    @unittest.skipIf(dbm is None, 'dbm is not available')
+    def test_dbm_batch_writes_each_key_once(self):
+        store = DBMStore(os.path.join(self._dir, 'cache'))
+        store._kv_store = CountingDict()
+        with store.write_batch():
+            for i in range(10):
+                store.put('a', str(i))
+                store.put('b', str(i))
+            self.assertEqual(store._kv_store.writes, 0)
+        self.assertEqual(store._kv_store.writes, 2)
+        store.put_many(reversed([('a', None), ('a', '5'), ('b', '6')]))
+        self.assertEqual(store._kv_store.writes, 3)
+        self.assertEqual(store.get_many(['a', 'b']), [None, '6'])
+
+    def test_batch_applied_on_error(self):
+        for store in self.stores():
+            try:
+                with store.write_batch():
+                    store.put('a', '0')
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(store.get('a'), '0')
+
+    def test_cache_lru(self):
+        store = CachedStore(InMemoryKVStore(), max_entries=2)
+        store.put_many([('a', '0'), ('b', '1'), ('c', '2')])
+        self.assertEqual(store.stats()['evictions'], 1)
+        self.assertEqual(store.get('b'), '1')
+        self.assertEqual(store.get('a'), '0')
+        # 'c' was the least recently used
+        self.assertEqual(store.get_many(['b', 'c', 'd', 'd']),
+                         ['1', '2', None, None])
+        self.assertEqual(store.stats(), {'hits': 2, 'misses': 3,
+                                         'evictions': 4, 'entries': 2,
+                                         'bytes': 3})
+
+    def test_cache_bytes(self):
+        store = CachedStore(InMemoryKVStore(), max_entries=None, max_bytes=10)
+        store.put('a', '0123')
+        store.put('b', '0123')
+        self.assertEqual(store.stats()['bytes'], 10)
+        store.put('c', '0')
+        self.assertEqual(store.stats()['entries'], 2)
+        self.assertEqual(store.stats()['bytes'], 7)
+        # Too big to cache at all, and nothing is evicted for it
+        store.put('d', '0123456789')
+        self.assertEqual(store.get('d'), '0123456789')
+        self.assertEqual(store.stats()['entries'], 2)
+        self.assertEqual(store.get('c'), '0')
+        self.assertEqual(store.stats()['hits'], 1)
+
+    def test_cache_write_through(self):
+        backend = InMemoryKVStore()
+        store = CachedStore(backend)
+        store.put('a', '0')
+        with store.write_batch():
+            store.put_many(reversed([('a', None), ('b', '1')]))
+        self.assertEqual(backend.get_many(['a', 'b']), [None, '1'])
+        self.assertEqual(store.get_many(['a', 'b']), [None, '1'])
+        self.assertEqual(store.stats()['misses'], 0)
+
+    def test_log_store_batch_per_thread(self):
+        store = self.log_store()
+        results = []
+
+        def other_thread():
+            store.put_many([('b', '1')])
+            results.append(store.get_many(['a', 'b']))
+        with store.write_batch():
+            store.put('a', '0')
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            thread.join()
+            # The other thread's writes went straight to the store, and it
+            # did not see the batch
+            self.assertEqual(results, [[None, '1']])
+            self.assertEqual(store.get_many(['a', 'b']), ['0', '1'])
+        self.assertEqual(store.get_many(['a', 'b']), ['0', '1'])
+
+    def test_log_store_reopen(self):
+        path = os.path.join(self._dir, 'log')
+        store = LogStore(path, max_segment_size=100)
+        for i in range(20):
+            store.put('k%d' % (i % 3), 'v%d' % i)
+        store.put_many([('k0', None), ('k3', 'x')])
+        store.close()
+        store = self.log_store()
+        self.assertEqual(store.get_many(['k0', 'k1', 'k2', 'k3']),
+                         [None, 'v19', 'v17', 'x'])
+
+    def test_log_store_torn_record(self):
+        path = os.path.join(self._dir, 'log')
+        store = LogStore(path)
+        store.put('a', '0')
+        store.put('b', '1')
+        store.close()
+        segment = os.path.join(path, sorted(os.listdir(path))[-1])
+        with open(segment, 'r+b') as f:
+            f.truncate(os.path.getsize(segment) - 1)
+        store = self.log_store()
+        self.assertEqual(store.get_many(['a', 'b']), ['0', None])
+        store.put('b', '2')
+        self.assertEqual(store.get('b'), '2')
+
+    def test_log_store_compaction(self):
+        store = self.log_store(max_segment_size=50, compact_segments=1000)
+        for i in range(100):
+            store.put('k%d' % (i % 4), 'v%d' % i)
+        store.put('k3', None)
+        self.assertTrue(store.segment_count() > 10)
+        store.compact()
+        self.assertEqual(store.segment_count(), 2)
+        self.assertEqual(store.get_many(['k0', 'k1', 'k2', 'k3']),
+                         ['v96', 'v97', 'v98', None])
+        # Only the current values are left
+        files = os.listdir(os.path.join(self._dir, 'log'))
+        self.assertEqual(len(files), 2)
+        self.assertTrue(sum(os.path.getsize(os.path.join(self._dir, 'log', f))
+                            for f in files) < 100)
+
+    def test_log_store_background_compaction(self):
+        store = self.log_store(max_segment_size=50, compact_segments=3)
+        for i in range(200):
+            store.put('k%d' % (i % 4), 'v%d' % i)
+            self.assertEqual(store.get('k%d' % (i % 4)), 'v%d' % i)
+        store._compactor.join()
+        # How many segments are left depends on when the compactor got to
+        # run, but some of them have been merged
+        self.assertTrue(any(segment.first < segment.last
+                            for segment in store._segments))
+        self.assertEqual(store.get_many(['k0', 'k1', 'k2', 'k3']),
+                         ['v196', 'v197', 'v198', 'v199'])
+
+    def test_log_store_interrupted_compaction(self):
+        path = os.path.join(self._dir, 'log')
+        store = LogStore(path, max_segment_size=10)
+        store.put('a', '0')
+        store.put('b', '1')
+        store.put('a', None)
+        store.close()
+        names = sorted(os.listdir(path))
+        self.assertEqual(len(names), 3)
+        # Leftovers of a compaction that was interrupted after the rename
+        shutil.copy(os.path.join(path, names[1]),
+                    os.path.join(path, '00000001-00000002.data'))
+        with open(os.path.join(path, '00000001-00000003.data.tmp'), 'wb'):
+            pass
+        store = self.log_store()
+        self.assertEqual(store.get_many(['a', 'b']), [None, '1'])
+        self.assertEqual(sorted(os.listdir(path)),
+                         ['00000001-00000002.data', '00000003-00000003.data',
+                          '00000004-00000004.data'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,719 @@
+import threading
+import weakref
+from collections import deque
+
+"""
+Lock modes. Keys are locked in "S" or "X" mode. With hierarchical locking (see
+LockTable), the partition a key belongs to is locked too: in "IS" or "IX" mode
+by a transaction that is about to lock keys in it in "S" or "X" mode, or in "S"
+or "X" mode to cover every key in it at once.
+"""
+SHARED = "S"
+EXCLUSIVE = "X"
+INTENTION_SHARED = "IS"
+INTENTION_EXCLUSIVE = "IX"
+
+"""
+COMBINED[@held, @mode] is the mode a transaction holds after it is granted
+@mode while holding @held: the weakest mode that is at least as strong as both.
+There is no SIX mode, so "IX" combined with "S" gives "X".
+"""
+COMBINED = {}
+for _held, _mode, _combined in [
+        (INTENTION_SHARED, INTENTION_SHARED, INTENTION_SHARED),
+        (INTENTION_SHARED, INTENTION_EXCLUSIVE, INTENTION_EXCLUSIVE),
+        (INTENTION_SHARED, SHARED, SHARED),
+        (INTENTION_EXCLUSIVE, INTENTION_EXCLUSIVE, INTENTION_EXCLUSIVE),
+        (INTENTION_EXCLUSIVE, SHARED, EXCLUSIVE),
+        (SHARED, SHARED, SHARED)]:
+    COMBINED[_held, _mode] = COMBINED[_mode, _held] = _combined
+for _mode in (INTENTION_SHARED, INTENTION_EXCLUSIVE, SHARED, EXCLUSIVE):
+    COMBINED[_mode, EXCLUSIVE] = COMBINED[EXCLUSIVE, _mode] = EXCLUSIVE
+
+def covers(held, mode):
+    """
+    Returns True if holding a lock in mode @held (or None) already gives
+    everything a lock in @mode would.
+    """
+    return held is not None and COMBINED[held, mode] == held
+
+"""
+The key under which the lock table locks a partition, as opposed to a key of
+the store.
+"""
+PARTITION = '__partition__'
+
+def partition_resource(name):
+    return (PARTITION, name)
+
+def prefix_partition(separator=':'):
+    """
+    Returns a partition function for LockTable that puts every key into the
+    partition named by the part of the key before the first @separator, so that
+    'user:42' belongs to partition 'user'. Keys without @separator all belong
+    to partition ''.
+    """
+    def partition_of(key):
+        return key.partition(separator)[0] if separator in key else ''
+    return partition_of
+
+"""
+A lock table entry records who holds the lock on a single key and who is
+waiting for it.
+
+entry.holders: a dict mapping the xid of every transaction that holds the lock
+to the mode it holds.
+
+entry.shared_count: the number of transactions that hold the lock in shared
+mode.
+
+entry.exclusive: the xid of the transaction that holds the lock in exclusive
+mode, or None.
+
+entry.intention_shared, entry.intention_exclusive: the number of transactions
+that hold the lock in "IS" and "IX" mode. These are only ever non-zero for
+partitions.
+
+entry.upgrades: a deque of (@xid, @mode, @notify) upgrade requests, from
+transactions that already hold the lock in a weaker mode. These are the
+upgrade slots: they are granted before anything in entry.queue.
+
+entry.queue: a deque of (@xid, @mode, @notify) requests from transactions that
+do not hold the lock yet, in the order in which they will be granted. @notify
+is called with no arguments once the request has been granted, or is None if
+the requester polls instead.
+
+entry.waiting: the number of requests in entry.upgrades and entry.queue that
+have not been cancelled.
+
+entry.cancelled: the xids of cancelled requests that are still in the deques,
+or None. Cancelling only marks the request, and it is dropped when it reaches
+the front, so that every queue operation is O(1).
+
+The queues are strictly first come, first served. A new request waits if
+anybody is waiting ahead of it, even if it is compatible with the holders, so
+a steady stream of readers cannot starve a writer. When a lock is released,
+every request at the front that is compatible with the holders is granted in
+the same step, for example all the readers queued behind a writer.
+
+For code written against the old list-of-lists layout, entry[0] returns the
+granted locks as a list of (@xid, @mode) tuples and entry[1] returns the wait
+queue, upgrades first, as a list of (@xid, @mode) tuples. Both are copies.
+"""
+class LockEntry(object):
+
+    __slots__ = ('holders', 'shared_count', 'exclusive', 'intention_shared',
+                 'intention_exclusive', 'upgrades', 'queue', 'waiting',
+                 'cancelled')
+
+    def __init__(self):
+        self.holders = {}
+        self.shared_count = 0
+        self.exclusive = None
+        self.intention_shared = 0
+        self.intention_exclusive = 0
+        self.upgrades = deque()
+        self.queue = deque()
+        self.waiting = 0
+        self.cancelled = None
+
+    def __getitem__(self, index):
+        if index == 0:
+            return list(self.holders.items())
+        if index == 1:
+            return [(xid, mode) for xid, mode, notify in self.requests()]
+        raise IndexError(index)
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        yield self[0]
+        yield self[1]
+
+    def __repr__(self):
+        return 'LockEntry(%r, %r)' % (self[0], self[1])
+
+    def requests(self):
+        """
+        Yields the (@xid, @mode, @notify) requests waiting for the lock, in
+        the order in which they will be granted.
+        """
+        cancelled = self.cancelled
+        for queue in (self.upgrades, self.queue):
+            for request in queue:
+                if not cancelled or request[0] not in cancelled:
+                    yield request
+
+    def is_empty(self):
+        """
+        Returns True if nobody holds or waits for the lock, in which case the
+        entry can be removed from the lock table.
+        """
+        return not self.holders and not self.waiting
+
+    def can_grant(self, xid, mode):
+        """
+        Returns True if the lock could be granted to @xid in @mode right now,
+        ignoring anybody waiting in the queue. A current holder is asking for
+        the combination of what it holds and @mode, and its own lock never
+        conflicts with that.
+        """
+        held = self.holders.get(xid)
+        if held is not None:
+            mode = COMBINED[held, mode]
+        if self.exclusive is not None and self.exclusive != xid:
+            return False
+        if mode == SHARED:
+            return not self.intention_exclusive
+        if mode == EXCLUSIVE:
+            return len(self.holders) == (held is not None)
+        if mode == INTENTION_EXCLUSIVE:
+            return not self.shared_count
+        return True
+
+    def grant(self, xid, mode):
+        """
+        Records that @xid holds the lock in @mode, or in the combination of
+        @mode and the mode it already holds. Granting "X" to a holder of "S"
+        upgrades the lock; granting "S" to a holder of "X" is a no-op.
+        """
+        held = self.holders.get(xid)
+        if held is not None:
+            mode = COMBINED[held, mode]
+            if mode == held:
+                return
+            self._count(held, -1)
+        self.holders[xid] = mode
+        self._count(mode, 1)
+        if mode == EXCLUSIVE:
+            self.exclusive = xid
+
+    def _count(self, mode, delta):
+        if mode == SHARED:
+            self.shared_count += delta
+        elif mode == INTENTION_SHARED:
+            self.intention_shared += delta
+        elif mode == INTENTION_EXCLUSIVE:
+            self.intention_exclusive += delta
+
+    def enqueue(self, xid, mode, notify=None):
+        """
+        Queues a request from @xid for the lock in @mode. A request by a
+        current holder is an upgrade and goes into the upgrade slots.
+        @notify, if given, is returned by release() once the request has been
+        granted so that the caller can wake the waiter up.
+        """
+        if xid in self.holders:
+            self.upgrades.append((xid, mode, notify))
+        else:
+            self.queue.append((xid, mode, notify))
+        self.waiting += 1
+
+    def cancel(self, xid):
+        """
+        Withdraws the request @xid has queued. @xid must have exactly one
+        request queued, and it must not make another one on this lock.
+        """
+        if self.cancelled is None:
+            self.cancelled = set()
+        self.cancelled.add(xid)
+        self.waiting -= 1
+
+    def release(self, xid):
+        """
+        Releases the lock held by @xid, if any, and grants it to as many
+        waiting requests from the front of the queue as possible.
+
+        @return: a list of the (@xid, @mode, @notify) requests that were
+        granted.
+        """
+        mode = self.holders.pop(xid, None)
+        if mode == EXCLUSIVE:
+            self.exclusive = None
+        elif mode is not None:
+            self._count(mode, -1)
+        return self.grant_waiting()
+
+    def grant_waiting(self):
+        """
+        Grants the lock to waiting requests, upgrades first, until a request
+        cannot be granted.
+
+        @return: a list of the (@xid, @mode, @notify) requests that were
+        granted.
+        """
+        granted = []
+        for queue in (self.upgrades, self.queue):
+            while queue:
+                request = queue[0]
+                xid = request[0]
+                if self.cancelled and xid in self.cancelled:
+                    queue.popleft()
+                    self.cancelled.discard(xid)
+                    continue
+                if not self.can_grant(xid, request[1]):
+                    return granted
+                queue.popleft()
+                self.waiting -= 1
+                self.grant(xid, request[1])
+                granted.append(request)
+        return granted
+
+"""
+The lock table maps each key to its LockEntry. On top of the entries it keeps
+an index of which key every blocked transaction is queued on, which together
+with the holders of that key gives the transaction's edges in the waits-for
+graph. The index is updated as requests are enqueued, granted and cancelled,
+so the graph never has to be rebuilt by scanning the whole table.
+
+The table also remembers which keys gained waits-for edges since the last
+deadlock detection pass, that is, keys that a transaction queued on and keys
+that granted the lock to new holders while others were still waiting. Any new
+cycle has to go through a transaction waiting on one of those keys, so the
+detector only needs to search from there.
+
+All changes to entries should go through acquire(), try_acquire(), cancel() and
+release() so that the index stays up to date.
+
+A lock table created with a @partition_of function locks hierarchically: every
+key belongs to the partition partition_of(@key) returns, and transactions lock
+the partition (under partition_resource(@name)) in intention mode before they
+lock keys in it. Once a transaction holds more than @escalation_threshold key
+locks in one partition, it tries to trade them for a single "S" or "X" lock on
+the partition. The lock table only stores these settings; TransactionHandler
+does the locking.
+
+A lock table created with a @prevention policy has transactions decide
+whether to wait or abort at the moment a request is queued; see prevention.py.
+One created with a @metrics hook reports lock requests, waits, deadlocks and
+aborts to it; see metrics.py.
+"""
+class LockTable(dict):
+
+    def __init__(self, partition_of=None, escalation_threshold=None,
+                 prevention=None, metrics=None):
+        dict.__init__(self)
+        self.partition_of = partition_of
+        self.escalation_threshold = escalation_threshold
+        self.prevention = prevention
+        self.metrics = metrics
+        self._waiting = {}
+        self._touched = set()
+
+    def acquire(self, key, xid, mode, notify=None):
+        """
+        Grants the lock on @key to @xid in @mode if it is compatible with the
+        current holders and nobody is waiting ahead of it. Otherwise queues
+        the request; upgrades by a current holder go to the front.
+
+        @return: True if the lock was granted, False if the request was queued.
+        """
+        entry = self.get(key)
+        if entry is None:
+            entry = self[key] = LockEntry()
+        held = entry.holders.get(xid)
+        if covers(held, mode):
+            return True
+        granted = self._grantable(entry, xid, held, mode)
+        if self.metrics is not None:
+            self.metrics.acquire(key, xid, mode, granted, held is not None,
+                                 entry.waiting)
+        if granted:
+            entry.grant(xid, mode)
+            return True
+        entry.enqueue(xid, mode, notify)
+        self._waiting[xid] = key
+        self._touched.add(key)
+        return False
+
+    def try_acquire(self, key, xid, mode):
+        """
+        Grants the lock on @key to @xid in @mode if acquire() would grant it
+        right away, and otherwise leaves the table untouched.
+
+        @return: True if the lock was granted.
+        """
+        entry = self.get(key)
+        if entry is None:
+            entry = self[key] = LockEntry()
+        held = entry.holders.get(xid)
+        if covers(held, mode):
+            return True
+        if self._grantable(entry, xid, held, mode):
+            entry.grant(xid, mode)
+            return True
+        if entry.is_empty():
+            del self[key]
+        return False
+
+    def _grantable(self, entry, xid, held, mode):
+        # Upgrades only have to be compatible, new requests also have to wait
+        # for anybody already queued
+        return entry.can_grant(xid, mode) and (held is not None or
+                                               not entry.waiting)
+
+    def held(self, key, xid):
+        """
+        Returns the mode in which @xid holds the lock on @key, or None.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        return entry.holders.get(xid)
+
+    def cancel(self, key, xid):
+        """
+        Withdraws the request @xid has queued on @key, if any. Call release()
+        afterwards to grant the lock to whoever was queued behind it.
+        """
+        if self._waiting.get(xid) == key:
+            self[key].cancel(xid)
+            del self._waiting[xid]
+
+    def release(self, key, xid):
+        """
+        Releases the lock @xid holds on @key, if any, and grants it to as many
+        waiting requests as possible. The entry is dropped once nobody holds
+        or waits for the lock.
+
+        @return: a list of the (@xid, @mode, @notify) requests that were
+        granted.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return []
+        granted = entry.release(xid)
+        for request in granted:
+            self._waiting.pop(request[0], None)
+        if entry.is_empty():
+            del self[key]
+        elif granted and entry.waiting:
+            self._touched.add(key)
+        return granted
+
+    def waiting_on(self, xid):
+        """
+        Returns the key @xid is queued on, or None if it is not blocked.
+        """
+        return self._waiting.get(xid)
+
+    def waiting(self):
+        """
+        Returns the xids of all blocked transactions.
+        """
+        return list(self._waiting)
+
+    def waits_for(self, xid):
+        """
+        Returns the xids of the transactions @xid is waiting for, that is, the
+        other holders of the key it is queued on.
+        """
+        key = self._waiting.get(xid)
+        if key is None:
+            return []
+        return [holder for holder in self[key].holders if holder != xid]
+
+    def blockers(self, key, xid):
+        """
+        Returns the xids of the transactions whose locks on @key, held or
+        queued ahead, stand between @xid and the lock it is queued for.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return []
+        blockers = [holder for holder in entry.holders if holder != xid]
+        for request in entry.requests():
+            if request[0] == xid:
+                break
+            blockers.append(request[0])
+        return blockers
+
+    def touched_waiters(self):
+        """
+        Returns the xids of the transactions queued on keys that gained
+        waits-for edges since the last call to clear_touched(), in ascending
+        order.
+        """
+        waiters = set()
+        for key in self._touched:
+            entry = self.get(key)
+            if entry is not None:
+                waiters.update(request[0] for request in entry.requests())
+        return sorted(waiters)
+
+    def clear_touched(self):
+        """
+        Marks every waits-for edge as seen by the deadlock detector.
+        """
+        self._touched.clear()
+
+    def mark_touched(self, xids):
+        """
+        Makes the deadlock detector search from the transactions in @xids
+        again on its next pass, for those of them that are still waiting.
+        """
+        for xid in xids:
+            key = self._waiting.get(xid)
+            if key is not None:
+                self._touched.add(key)
+
+    def waits_for_snapshot(self):
+        """
+        Hands the waits-for graph to the deadlock detector and marks every
+        edge in it as seen. If the detector finds a cycle it should call
+        mark_touched() with the returned start points, so that the cycle is
+        found again if the victim is not aborted.
+
+        @return: a tuple (@starts, @waits_for), where @starts is the result of
+        touched_waiters() and @waits_for is a function returning the xids a
+        transaction waits for.
+        """
+        starts = self.touched_waiters()
+        self.clear_touched()
+        return starts, self.waits_for
+
+"""
+Handlers and coordinators used to share a plain dict as their lock table.
+lock_table_of() gives such a dict a LockTable view: the view keeps its
+entries in the dict as well, so code that looks them up there keeps working,
+and every caller that passes the same dict gets the same view.
+"""
+class _DictLockTable(LockTable):
+
+    def __init__(self, entries):
+        LockTable.__init__(self)
+        self._entries = entries
+
+    def __setitem__(self, key, entry):
+        LockTable.__setitem__(self, key, entry)
+        self._entries[key] = entry
+
+    def __delitem__(self, key):
+        LockTable.__delitem__(self, key)
+        del self._entries[key]
+
+# The view of each plain dict, by id. A view holds on to its dict, so the id
+# cannot be reused while the view is alive.
+_views = weakref.WeakValueDictionary()
+_views_mutex = threading.Lock()
+
+def lock_table_of(lock_table):
+    """
+    Returns the LockTable to use for @lock_table: @lock_table itself, unless
+    it is a plain dict, in which case it is the dict's view.
+    """
+    if type(lock_table) is not dict:
+        return lock_table
+    with _views_mutex:
+        view = _views.get(id(lock_table))
+        if view is None:
+            view = _views[id(lock_table)] = _DictLockTable(lock_table)
+        return view
+
+
+"""
+A lock table for multi-threaded servers. Keys are hashed into a fixed number of
+shards, each a LockTable guarded by its own mutex, so that transactions working
+on keys in different shards never contend with each other. It supports the
+same operations as LockTable, each of which holds only the mutex of the shard
+the key belongs to.
+
+A transaction only ever waits on one key at a time, so its waits-for edges live
+in a single shard. waits_for_snapshot() takes every shard mutex, in shard
+order, to copy out a consistent waits-for graph for the deadlock detector.
+
+Notifications for granted requests are returned by release() and should be
+delivered after it returns, outside of any shard mutex.
+"""
+class ShardedLockTable(object):
+
+    def __init__(self, num_shards=16, partition_of=None,
+                 escalation_threshold=None, prevention=None, metrics=None):
+        self.partition_of = partition_of
+        self.escalation_threshold = escalation_threshold
+        self.prevention = prevention
+        self.metrics = metrics
+        self._shards = [LockTable(metrics=metrics) for i in range(num_shards)]
+        self._mutexes = [threading.Lock() for i in range(num_shards)]
+
+    def _shard(self, key):
+        index = hash(key) % len(self._shards)
+        return self._shards[index], self._mutexes[index]
+
+    def __getitem__(self, key):
+        shard, mutex = self._shard(key)
+        with mutex:
+            return shard[key]
+
+    def __contains__(self, key):
+        shard, mutex = self._shard(key)
+        with mutex:
+            return key in shard
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def __iter__(self):
+        for shard, mutex in zip(self._shards, self._mutexes):
+            with mutex:
+                keys = list(shard)
+            for key in keys:
+                yield key
+
+    def get(self, key, default=None):
+        shard, mutex = self._shard(key)
+        with mutex:
+            return shard.get(key, default)
+
+    def acquire(self, key, xid, mode, notify=None):
+        shard, mutex = self._shard(key)
+        with mutex:
+            return shard.acquire(key, xid, mode, notify)
+
+    def try_acquire(self, key, xid, mode):
+        shard, mutex = self._shard(key)
+        with mutex:
+            return shard.try_acquire(key, xid, mode)
+
+    def held(self, key, xid):
+        shard, mutex = self._shard(key)
+        with mutex:
+            return shard.held(key, xid)
+
+    def cancel(self, key, xid):
+        shard, mutex = self._shard(key)
+        with mutex:
+            shard.cancel(key, xid)
+
+    def release(self, key, xid):
+        shard, mutex = self._shard(key)
+        with mutex:
+            return shard.release(key, xid)
+
+    def blockers(self, key, xid):
+        shard, mutex = self._shard(key)
+        with mutex:
+            return shard.blockers(key, xid)
+
+    def waiting_on(self, xid):
+        for shard, mutex in zip(self._shards, self._mutexes):
+            with mutex:
+                key = shard.waiting_on(xid)
+            if key is not None:
+                return key
+        return None
+
+    def touched_waiters(self):
+        waiters = set()
+        for shard, mutex in zip(self._shards, self._mutexes):
+            with mutex:
+                waiters.update(shard.touched_waiters())
+        return sorted(waiters)
+
+    def clear_touched(self):
+        for shard, mutex in zip(self._shards, self._mutexes):
+            with mutex:
+                shard.clear_touched()
+
+    def mark_touched(self, xids):
+        for shard, mutex in zip(self._shards, self._mutexes):
+            with mutex:
+                shard.mark_touched(xids)
+
+    def waits_for_snapshot(self):
+        for mutex in self._mutexes:
+            mutex.acquire()
+        try:
+            starts = set()
+            graph = {}
+            for shard in self._shards:
+                starts.update(shard.touched_waiters())
+                shard.clear_touched()
+                for xid in shard.waiting():
+                    graph[xid] = shard.waits_for(xid)
+        finally:
+            for mutex in self._mutexes:
+                mutex.release()
+        return sorted(starts), lambda xid: graph.get(xid, ())
+
+def strongly_connected_components(starts, successors):
+    """
+    Finds the strongly connected components of the part of a directed graph
+    that is reachable from @starts, using an iterative version of Tarjan's
+    algorithm. Each vertex and edge is visited once.
+
+    @param starts: the vertices to search from.
+    @param successors: a function returning the successors of a vertex.
+
+    @return: a list of components, each a list of vertices. Components come out
+    in reverse topological order.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for start in starts:
+        if start in index:
+            continue
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(successors(start)))]
+        while work:
+            vertex, edges = work[-1]
+            for successor in edges:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(successors(successor))))
+                    break
+                if successor in on_stack:
+                    lowlink[vertex] = min(lowlink[vertex], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[vertex])
+                if lowlink[vertex] == index[vertex]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == vertex:
+                            break
+                    components.append(component)
+    return components
+
+def deadlock_victims(starts, waits_for, choose=max):
+    """
+    Finds every cycle in the waits-for graph reachable from @starts and picks
+    the transactions to abort so that none is left. Each deadlocked component
+    gives up the transaction picked by @choose; if the rest of the component
+    still contains a cycle, it is split up again. A component that is a single
+    cycle, by far the common case, is resolved in one O(V+E) pass.
+
+    @param starts: the xids to search from.
+    @param waits_for: a function returning the xids a transaction waits for.
+    @param choose: a function picking the victim from a list of deadlocked
+    xids. It must be deterministic.
+
+    @return: a sorted list of the xids to abort, empty if there is no cycle.
+    """
+    victims = []
+    pending = strongly_connected_components(starts, waits_for)
+    while pending:
+        component = pending.pop()
+        if len(component) < 2:
+            continue
+        victim = choose(component)
+        victims.append(victim)
+        survivors = set(component)
+        survivors.discard(victim)
+        pending.extend(strongly_connected_components(
+            sorted(survivors),
+            lambda xid: [other for other in waits_for(xid) if other in survivors]))
+    return sorted(victims)
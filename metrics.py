@@ -0,0 +1,187 @@
+import heapq
+import threading
+from collections import OrderedDict
+
+"""
+Lock manager instrumentation.
+
+A lock table created with a @metrics hook (see LockTable) reports every lock
+request, every wait, every deadlock found by TransactionCoordinator and every
+abort to it. Without one, the only cost is a test for None at each of those
+points.
+
+MetricsHook defines the hook interface and does nothing; subclass it to feed
+another metrics system. Hooks are called while the lock table is being
+modified, possibly from several threads at once, so they should be quick and
+thread-safe.
+
+LockMetrics collects counters and histograms in memory and hands out a
+consistent copy of them with snapshot().
+"""
+
+class MetricsHook(object):
+
+    def acquire(self, key, xid, mode, granted, upgrade, queue_depth):
+        """
+        Called for every lock request that is not already covered by a lock
+        the transaction holds.
+
+        @param granted: True if the lock was granted right away, False if the
+        request was queued.
+        @param upgrade: True if the transaction already held a weaker lock on
+        @key.
+        @param queue_depth: the number of requests queued on @key before this
+        one.
+        """
+
+    def wait(self, key, xid, mode, seconds):
+        """
+        Called when a queued request has been granted and picked up by the
+        transaction, with the time it waited.
+        """
+
+    def deadlock(self, victims):
+        """
+        Called when a deadlock detection pass finds cycles, with the xids of
+        the transactions it picked to abort.
+        """
+
+    def abort(self, xid, mode):
+        """
+        Called when a transaction aborts, with the abort mode.
+        """
+
+"""
+A histogram with power-of-two buckets. observe() adds a value to the bucket of
+the smallest power of two that is at least as large as the value.
+"""
+class Histogram(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        bound = 1
+        while bound < value:
+            bound *= 2
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket that holds the @fraction
+        percentile, or 0 if the histogram is empty.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for bound in sorted(self.buckets):
+            seen += self.buckets[bound]
+            if seen >= rank:
+                return bound
+        return 0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': sorted(self.buckets.items()),
+        }
+
+"""
+In-memory lock metrics. snapshot() returns a dict with:
+
+acquisitions: the number of lock requests per mode.
+immediate_grants: the number of requests per mode granted right away.
+upgrades: the number of requests that upgraded a lock.
+wait_us: per mode, a histogram of the microseconds granted requests waited.
+queue_depth: a histogram of the number of requests already queued ahead of
+each request that had to wait.
+contended_keys: the @top keys that requests waited on the most, as
+(@key, @waits) pairs, most contended first. Only the @max_keys keys waited on
+most recently are counted, so that a long-running server does not keep a
+counter for every key it ever saw; a key that drops out starts over from zero
+when it is waited on again. Keys that are hot enough to matter are waited on
+too often to drop out.
+deadlocks: the number of detection passes that found a deadlock.
+victims: the number of transactions they picked to abort.
+aborts: the number of aborts per abort mode.
+"""
+class LockMetrics(MetricsHook):
+
+    def __init__(self, max_keys=1000):
+        self._max_keys = max_keys
+        self._mutex = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._mutex:
+            self._acquisitions = {}
+            self._immediate = {}
+            self._upgrades = 0
+            self._waits = {}
+            self._queue_depth = Histogram()
+            # Least recently waited on first
+            self._contention = OrderedDict()
+            self._deadlocks = 0
+            self._victims = 0
+            self._aborts = {}
+
+    def acquire(self, key, xid, mode, granted, upgrade, queue_depth):
+        with self._mutex:
+            self._acquisitions[mode] = self._acquisitions.get(mode, 0) + 1
+            if upgrade:
+                self._upgrades += 1
+            if granted:
+                self._immediate[mode] = self._immediate.get(mode, 0) + 1
+            else:
+                self._queue_depth.observe(queue_depth)
+                self._contention[key] = self._contention.pop(key, 0) + 1
+                if len(self._contention) > self._max_keys:
+                    self._contention.popitem(last=False)
+
+    def wait(self, key, xid, mode, seconds):
+        with self._mutex:
+            histogram = self._waits.get(mode)
+            if histogram is None:
+                histogram = self._waits[mode] = Histogram()
+            histogram.observe(int(seconds * 1000000))
+
+    def deadlock(self, victims):
+        with self._mutex:
+            self._deadlocks += 1
+            self._victims += len(victims)
+
+    def abort(self, xid, mode):
+        with self._mutex:
+            self._aborts[mode] = self._aborts.get(mode, 0) + 1
+
+    def snapshot(self, top=10):
+        """
+        Returns a copy of the metrics collected so far, see above.
+
+        @param top: the number of contended keys to return.
+        """
+        with self._mutex:
+            return {
+                'acquisitions': dict(self._acquisitions),
+                'immediate_grants': dict(self._immediate),
+                'upgrades': self._upgrades,
+                'wait_us': dict((mode, histogram.snapshot())
+                                for mode, histogram in self._waits.items()),
+                'queue_depth': self._queue_depth.snapshot(),
+                'contended_keys': heapq.nlargest(
+                    top, self._contention.items(),
+                    key=lambda item: (item[1], str(item[0]))),
+                'deadlocks': self._deadlocks,
+                'victims': self._victims,
+                'aborts': dict(self._aborts),
+            }
@@ -0,0 +1,90 @@
+import unittest
+
+from kvstore import InMemoryKVStore
+from locktable import LockTable
+from metrics import Histogram, LockMetrics, MetricsHook
+from student import DEADLOCK, USER, TransactionCoordinator, TransactionHandler
+
+class RecordingHook(MetricsHook):
+    def __init__(self):
+        self.events = []
+
+    def acquire(self, key, xid, mode, granted, upgrade, queue_depth):
+        self.events.append(('acquire', key, xid, mode, granted, upgrade,
+                            queue_depth))
+
+    def deadlock(self, victims):
+        self.events.append(('deadlock', victims))
+
+    def abort(self, xid, mode):
+        self.events.append(('abort', xid, mode))
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in (0, 1, 3, 4, 100):
+            histogram.observe(value)
+        self.assertEqual(histogram.snapshot(),
+                         {'count': 5, 'sum': 108, 'max': 100, 'p50': 4,
+                          'p99': 128, 'buckets': [(1, 2), (4, 2), (128, 1)]})
+        self.assertEqual(Histogram().percentile(0.5), 0)
+
+    def test_hook(self):
+        hook = RecordingHook()
+        lock_table = LockTable(metrics=hook)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        self.assertEqual(t1.perform_get('b'), 'No such key')
+        self.assertEqual(t0.perform_put('b', '0'), None)
+        self.assertEqual(t1.perform_put('a', '1'), None)
+        self.assertEqual(coordinator.find_deadlocks(), [1])
+        self.assertEqual(t1.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(hook.events, [
+            ('acquire', 'a', 0, 'S', True, False, 0),
+            ('acquire', 'b', 1, 'S', True, False, 0),
+            ('acquire', 'b', 0, 'X', False, False, 0),
+            ('acquire', 'a', 1, 'X', False, False, 0),
+            ('deadlock', [1]),
+            ('abort', 1, DEADLOCK),
+        ])
+
+    def test_lock_metrics(self):
+        metrics = LockMetrics()
+        lock_table = LockTable(metrics=metrics)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t1.perform_get('a'), None)
+        self.assertEqual(t2.perform_put('a', '2'), None)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), '0')
+        self.assertEqual(t1.abort(USER), 'User Abort')
+        self.assertEqual(t2.check_lock(), 'Success')
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['acquisitions'], {'S': 2, 'X': 2})
+        self.assertEqual(snapshot['immediate_grants'], {'S': 1, 'X': 1})
+        self.assertEqual(snapshot['upgrades'], 1)
+        self.assertEqual(snapshot['wait_us']['S']['count'], 1)
+        self.assertEqual(snapshot['wait_us']['X']['count'], 1)
+        self.assertEqual(snapshot['queue_depth']['buckets'], [(1, 2)])
+        self.assertEqual(snapshot['contended_keys'], [('a', 2)])
+        self.assertEqual(snapshot['aborts'], {USER: 1})
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()['acquisitions'], {})
+
+    def test_contended_keys_bounded(self):
+        metrics = LockMetrics(max_keys=2)
+        for key in ('a', 'b', 'a', 'c', 'a', 'd'):
+            metrics.acquire(key, 0, 'X', False, False, 1)
+        self.assertEqual(metrics.snapshot()['contended_keys'],
+                         [('a', 3), ('d', 1)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
+import threading
+import time
 import unittest
 
-from kvstore import InMemoryKVStore
+from kvstore import InMemoryKVStore, MVCCStore
+from locktable import (LockEntry, LockTable, ShardedLockTable,
+                       partition_resource, prefix_partition)
 from student import USER, TransactionHandler
 
 class Part1Test(unittest.TestCase):
@@ -365,5 +369,420 @@ class Part1Test(unittest.TestCase):
         self.assertEqual(t0.perform_get('a'), '1') 
         self.assertEqual(t0.perform_put('a', '3'), 'Success')
 
+    def test_lock_entry_view(self):
+        lock_table = {}
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        self.assertEqual(t1.perform_get('a'), 'No such key')
+        self.assertEqual(t2.perform_put('a', '2'), None)
+        self.assertEqual(t0.perform_put('a', '0'), None)
+        self.assertEqual(sorted(lock_table['a'][0]), [(0, 'S'), (1, 'S')])
+        self.assertEqual(lock_table['a'][1], [(0, 'X'), (2, 'X')])
+        self.assertEqual(lock_table['a'].shared_count, 2)
+        self.assertEqual(lock_table['a'].exclusive, None)
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table['a'][0], [(0, 'X')])
+        self.assertEqual(lock_table['a'].exclusive, 0)
+        self.assertEqual(t0.check_lock(), 'Success')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), 'Success')
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table, {})
+
+    def test_reread_behind_writer(self):
+        lock_table = {}
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        self.assertEqual(t1.perform_get('a'), 'No such key')
+        self.assertEqual(t2.perform_put('a', '2'), None)
+        # t0 already holds a shared lock, so it must not queue behind t2
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), 'Success')
+
+    def test_abort_granted_but_unchecked(self):
+        lock_table = {}
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t1.perform_put('a', '1'), None)
+        self.assertEqual(t2.perform_get('a'), None)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        # t1 was granted the lock but aborts before calling check_lock()
+        self.assertEqual(t1.abort(USER), 'User Abort')
+        self.assertEqual(t2.check_lock(), '0')
+
+    def test_grant_callback(self):
+        lock_table = {}
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        granted = []
+        t1.set_grant_callback(granted.append)
+        t2.set_grant_callback(granted.append)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t1.perform_put('a', '1'), None)
+        self.assertEqual(t2.perform_get('a'), None)
+        self.assertEqual(granted, [])
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        # Only the waiter that was granted the lock is woken up
+        self.assertEqual(granted, [t1])
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(granted, [t1, t2])
+        self.assertEqual(t2.check_lock(), '1')
+
+    def test_wait_for_lock(self):
+        lock_table = {}
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t1.perform_get('a'), None)
+        self.assertEqual(t1.wait_for_lock(0), None)
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(t1.wait_for_lock()))
+        waiter.start()
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        waiter.join(5)
+        self.assertEqual(result, ['0'])
+
+    def test_wait_for_lock_after_abort(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t1.perform_get('a'), None)
+        self.assertEqual(t1.abort(USER), 'User Abort')
+        # The wake-up for the aborted request does not end the next wait
+        self.assertEqual(t1.perform_get('a'), None)
+        result = []
+        waiter = threading.Thread(
+            target=lambda: result.append(t1.wait_for_lock(5)))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        waiter.join(5)
+        self.assertEqual(result, ['0'])
+
+    def test_sharded_lock_table(self):
+        lock_table = ShardedLockTable(4)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        self.assertEqual(t1.perform_get('a'), 'No such key')
+        self.assertEqual(t1.perform_put('a', '1'), None)
+        self.assertEqual(lock_table['a'][1], [(1, 'X')])
+        self.assertEqual(lock_table.waiting_on(1), 'a')
+        self.assertEqual(t0.perform_put('b', '0'), 'Success')
+        self.assertEqual(sorted(lock_table), ['a', 'b'])
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(len(lock_table), 0)
+
+    def test_sharded_threads(self):
+        lock_table = ShardedLockTable(8)
+        store = InMemoryKVStore()
+        errors = []
+
+        def run(xid):
+            for i in range(50):
+                t = TransactionHandler(lock_table, (xid, i), store)
+                result = t.perform_put('hot', str(xid))
+                if result is None:
+                    result = t.wait_for_lock(5)
+                if result != 'Success' or \
+                        t.perform_put('key%d' % xid, str(i)) != 'Success':
+                    errors.append((xid, i, result))
+                t.commit()
+
+        threads = [threading.Thread(target=run, args=(xid,))
+                   for xid in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(lock_table), 0)
+        self.assertEqual(store.get('key3'), '49')
+
+    def test_multi_get_put(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_multi_put([('b', '1'), ('a', '0'),
+                                               ('b', '2')]), 'Success')
+        self.assertEqual(t0.perform_multi_get(['b', 'c', 'a', 'b']),
+                         ['2', 'No such key', '0', '2'])
+        self.assertEqual(t0._acquired_locks, {'a': 'X', 'b': 'X', 'c': 'S'})
+        self.assertEqual(t0.abort(USER), 'User Abort')
+        self.assertEqual(store.get_many(['a', 'b']), [None, None])
+        self.assertEqual(t1.perform_multi_get(['a', 'b']),
+                         ['No such key', 'No such key'])
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table, {})
+
+    def test_multi_blocked(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_put('b', '0'), 'Success')
+        self.assertEqual(t2.perform_get('d'), 'No such key')
+        self.assertEqual(t1.perform_multi_put({'a': '1', 'b': '1', 'c': '1',
+                                               'd': '1'}), None)
+        # Locks are taken in key order, so t1 holds a and waits for b
+        self.assertEqual(t1._desired_lock, ('b', 'X'))
+        self.assertEqual(lock_table.held('a', 1), 'X')
+        self.assertEqual(lock_table.held('c', 1), None)
+        self.assertEqual(t1.check_lock(), None)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), None)
+        self.assertEqual(t1._desired_lock, ('d', 'X'))
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(store.get_many(['a', 'b', 'c', 'd']), ['1'] * 4)
+        self.assertEqual(t1.abort(USER), 'User Abort')
+        self.assertEqual(store.get_many(['a', 'b', 'c', 'd']),
+                         [None, '0', None, None])
+
+    def test_write_buffered_commit(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store, write_buffered=True)
+        t1 = TransactionHandler(lock_table, 1, store, write_buffered=True)
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t0.perform_multi_put([('b', '1'), ('c', '2')]),
+                         'Success')
+        self.assertEqual(t0.perform_get('a'), '0')
+        self.assertEqual(t0.perform_multi_get(['c', 'd']), ['2', 'No such key'])
+        self.assertEqual(store.get_many(['a', 'b', 'c']), [None, None, None])
+        self.assertEqual(t1.perform_get('a'), None)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(store.get_many(['a', 'b', 'c']), ['0', '1', '2'])
+        self.assertEqual(t1.check_lock(), '0')
+
+    def test_write_buffered_abort(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        store.put('a', '0')
+        t0 = TransactionHandler(lock_table, 0, store, write_buffered=True)
+        t1 = TransactionHandler(lock_table, 1, store, write_buffered=True)
+        self.assertEqual(t0.perform_get('a'), '0')
+        self.assertEqual(t1.perform_get('a'), '0')
+        self.assertEqual(t0.perform_put('a', '1'), None)
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t0.check_lock(), 'Success')
+        self.assertEqual(t0.perform_get('a'), '1')
+        self.assertEqual(t0._undo_log, {})
+        self.assertEqual(t0.abort(USER), 'User Abort')
+        self.assertEqual(store.get('a'), '0')
+
+    def test_mvcc_wr(self):
+        lock_table = LockTable()
+        store = MVCCStore()
+        store.put('a', '0')
+        t0 = TransactionHandler(lock_table, 0, store, mvcc=True)
+        t1 = TransactionHandler(lock_table, 1, store, mvcc=True)
+        self.assertEqual(t0.perform_put('a', '1'), 'Success')
+        self.assertEqual(t0.perform_get('a'), '1')
+        # The reader does not wait for the writer and sees its snapshot
+        self.assertEqual(t1.perform_get('a'), '0')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.perform_multi_get(['a', 'b']), ['0', 'No such key'])
+        self.assertEqual(store.get('a'), '1')
+        # t0 committed a after t1's snapshot, so t1 must not overwrite it
+        self.assertEqual(t1.perform_put('a', '2'), 'Deadlock Abort')
+        self.assertEqual(store.get('a'), '1')
+        self.assertEqual(lock_table, {})
+
+    def test_mvcc_lost_update(self):
+        lock_table = LockTable()
+        store = MVCCStore()
+        store.put('ctr', '0')
+        t0 = TransactionHandler(lock_table, 0, store, mvcc=True)
+        t1 = TransactionHandler(lock_table, 1, store, mvcc=True)
+        self.assertEqual(t0.perform_get('ctr'), '0')
+        self.assertEqual(t1.perform_get('ctr'), '0')
+        self.assertEqual(t0.perform_put('ctr', '1'), 'Success')
+        self.assertEqual(t1.perform_multi_put({'ctr': '1'}), None)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), 'Deadlock Abort')
+        t2 = TransactionHandler(lock_table, 2, store, mvcc=True)
+        self.assertEqual(t2.perform_get('ctr'), '1')
+        self.assertEqual(t2.perform_put('ctr', '2'), 'Success')
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(store.get('ctr'), '2')
+        self.assertEqual(lock_table, {})
+
+    def test_mvcc_ww(self):
+        lock_table = LockTable()
+        store = MVCCStore()
+        t0 = TransactionHandler(lock_table, 0, store, mvcc=True)
+        t1 = TransactionHandler(lock_table, 1, store, mvcc=True)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t1.perform_put('a', '1'), None)
+        self.assertEqual(t0.abort(USER), 'User Abort')
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(store.get('a'), '1')
+
+    def test_mvcc_garbage_collection(self):
+        lock_table = LockTable()
+        store = MVCCStore()
+        store.put('a', '0')
+        reader = TransactionHandler(lock_table, 0, store, mvcc=True)
+        for i in range(1, 4):
+            writer = TransactionHandler(lock_table, i, store, mvcc=True)
+            self.assertEqual(writer.perform_put('a', str(i)), 'Success')
+            self.assertEqual(writer.commit(), 'Transaction Completed')
+        self.assertEqual(store.version_count('a'), 4)
+        self.assertEqual(reader.perform_get('a'), '0')
+        self.assertEqual(reader.commit(), 'Transaction Completed')
+        self.assertEqual(store.version_count('a'), 1)
+        self.assertEqual(store.get('a'), '3')
+
+    def test_repeated_writes_bookkeeping(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        store.put('a', 'old')
+        t0 = TransactionHandler(lock_table, 0, store)
+        for i in range(100):
+            key = 'k%d' % (i % 10)
+            self.assertEqual(t0.perform_get(key), 'No such key' if i < 10
+                             else str(i - 10))
+            self.assertEqual(t0.perform_put(key, str(i)), 'Success')
+            self.assertEqual(t0.perform_put('a', str(i)), 'Success')
+        # One lock and one undo entry per key, however often it was written
+        self.assertEqual(len(t0._acquired_locks), 11)
+        self.assertEqual(set(t0._acquired_locks.values()), set(['X']))
+        self.assertEqual(len(t0._undo_log), 11)
+        self.assertEqual(t0._undo_log['a'], 'old')
+        self.assertEqual(t0.abort(USER), 'User Abort')
+        self.assertEqual(store.get('a'), 'old')
+        self.assertEqual(store.get('k3'), None)
+        self.assertEqual(lock_table, {})
+
+    def test_fair_queue(self):
+        entry = LockEntry()
+        entry.grant(0, 'X')
+        entry.enqueue(1, 'S')
+        entry.enqueue(2, 'S')
+        entry.enqueue(3, 'X')
+        entry.enqueue(4, 'S')
+        # Every reader in front of the writer is granted at once
+        self.assertEqual([request[0] for request in entry.release(0)], [1, 2])
+        self.assertEqual(entry[1], [(3, 'X'), (4, 'S')])
+        # The upgrade slot goes ahead of the queued writer
+        entry.enqueue(1, 'X')
+        self.assertEqual(entry[1], [(1, 'X'), (3, 'X'), (4, 'S')])
+        self.assertEqual(entry.release(2), [(1, 'X', None)])
+        entry.cancel(3)
+        self.assertEqual(entry[1], [(4, 'S')])
+        self.assertEqual(entry.waiting, 1)
+        self.assertEqual(entry.release(1), [(4, 'S', None)])
+        self.assertFalse(entry.is_empty())
+        self.assertEqual(len(entry.queue), 0)
+        self.assertEqual(entry.cancelled, set())
+
+    def test_writer_not_starved(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        writer = TransactionHandler(lock_table, 0, store)
+        readers = [TransactionHandler(lock_table, xid, store)
+                   for xid in range(1, 5)]
+        self.assertEqual(readers[0].perform_get('a'), 'No such key')
+        self.assertEqual(writer.perform_put('a', '0'), None)
+        # Readers arriving after the writer wait behind it
+        for reader in readers[1:]:
+            self.assertEqual(reader.perform_get('a'), None)
+        self.assertEqual(readers[0].commit(), 'Transaction Completed')
+        self.assertEqual(writer.check_lock(), 'Success')
+        self.assertEqual(writer.commit(), 'Transaction Completed')
+        for reader in readers[1:]:
+            self.assertEqual(reader.check_lock(), '0')
+        self.assertEqual(sorted(lock_table['a'][0]), [(2, 'S'), (3, 'S'),
+                                                      (4, 'S')])
+
+    def test_intention_locks(self):
+        lock_table = LockTable(prefix_partition())
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_put('user:1', '1'), 'Success')
+        self.assertEqual(t1.perform_get('user:2'), 'No such key')
+        self.assertEqual(t1.perform_put('user:3', '3'), 'Success')
+        self.assertEqual(sorted(lock_table[partition_resource('user')][0]),
+                         [(0, 'IX'), (1, 'IX')])
+        # The "IX" lock replaced the "IS" lock taken for the read
+        self.assertEqual(t1._acquired_locks,
+                         {'user:2': 'S', ('__partition__', 'user'): 'IX',
+                          'user:3': 'X'})
+        # "IS" goes with the "IX" locks, the key lock has to wait
+        self.assertEqual(t2.perform_multi_get(['user:1']), None)
+        self.assertEqual(t2._desired_lock, ('user:1', 'S'))
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), ['1'])
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table, {})
+
+    def test_lock_escalation(self):
+        lock_table = LockTable(prefix_partition(), escalation_threshold=2)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_multi_put([('a:1', '1'), ('a:2', '2'),
+                                               ('b:1', '1')]), 'Success')
+        self.assertEqual(t0.perform_put('a:3', '3'), 'Success')
+        # The key locks in 'a' were traded for one partition lock
+        self.assertEqual(sorted(lock_table, key=str),
+                         [('__partition__', 'a'), ('__partition__', 'b'),
+                          'b:1'])
+        self.assertEqual(lock_table.held(partition_resource('a'), 0), 'X')
+        self.assertEqual(t0.perform_put('a:4', '4'), 'Success')
+        self.assertEqual(len(t0._acquired_locks), 3)
+        self.assertEqual(t1.perform_get('a:9'), None)
+        self.assertEqual(t1._desired_lock, (('__partition__', 'a'), 'IS'))
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), 'No such key')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table, {})
+
+    def test_lock_escalation_blocked(self):
+        lock_table = LockTable(prefix_partition(), escalation_threshold=1)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t1.perform_put('a:0', '0'), 'Success')
+        # t1 holds "IX" on the partition, so t0 has to keep its key locks
+        self.assertEqual(t0.perform_multi_get(['a:1', 'a:2', 'a:3']),
+                         ['No such key'] * 3)
+        self.assertEqual(lock_table.held(partition_resource('a'), 0), 'IS')
+        self.assertEqual(lock_table.held('a:3', 0), 'S')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t0.perform_get('a:4'), 'No such key')
+        self.assertEqual(lock_table.held(partition_resource('a'), 0), 'S')
+        self.assertEqual(list(lock_table), [partition_resource('a')])
+        self.assertEqual(t0.abort(USER), 'User Abort')
+        self.assertEqual(lock_table, {})
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,10 @@
+import threading
+import time
 import unittest
 
 from kvstore import InMemoryKVStore
+from locktable import LockTable, ShardedLockTable
+from prevention import START, LockWaitTimeout, WaitDie, WoundWait
 from student import DEADLOCK, USER, TransactionCoordinator, TransactionHandler
 
 class Part2Test(unittest.TestCase):
@@ -249,7 +253,255 @@ class Part2Test(unittest.TestCase):
         self.assertTrue(abort_id == 2 or abort_id == 4)
 
 
+    def test_no_deadlock_shared_waiter(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        t3 = TransactionHandler(lock_table, 3, store)
+        coordinator = TransactionCoordinator(lock_table)
+        # t3 waits for t1 and t2 on c, and t2 waits for t1 on a: no cycle
+        self.assertEqual(t1.perform_put('a', 'a1'), 'Success')
+        self.assertEqual(t1.perform_get('c'), 'No such key')
+        self.assertEqual(t2.perform_get('c'), 'No such key')
+        self.assertEqual(t3.perform_get('d'), 'No such key')
+        self.assertEqual(t3.perform_put('c', 'c3'), None)
+        self.assertEqual(t2.perform_get('a'), None)
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+
+    def test_deadlock_after_clean_pass(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        t3 = TransactionHandler(lock_table, 3, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t1.perform_get('a'), 'No such key')
+        self.assertEqual(t2.perform_get('a'), 'No such key')
+        self.assertEqual(t3.perform_get('b'), 'No such key')
+        self.assertEqual(t3.perform_put('a', 'a3'), None)
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(lock_table.touched_waiters(), [])
+        # t3 now only waits for t2, and t2 starts waiting for t3
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t2.perform_put('b', 'b2'), None)
+        self.assertEqual(lock_table.touched_waiters(), [2])
+        self.assertEqual(coordinator.detect_deadlocks(), 3)
+        self.assertEqual(t3.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(t2.check_lock(), 'Success')
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+
+    def test_find_all_deadlocks(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        coordinator = TransactionCoordinator(lock_table)
+        t = dict((xid, TransactionHandler(lock_table, xid, store))
+                 for xid in range(1, 7))
+        # 1 -> 2 -> 1 and 3 -> 4 -> 5 -> 3, and 6 waits on the second cycle
+        for holder, waiter, key in [(2, 1, 'a'), (1, 2, 'b'), (4, 3, 'c'),
+                                    (5, 4, 'd'), (3, 5, 'e')]:
+            self.assertEqual(t[holder].perform_get(key), 'No such key')
+        self.assertEqual(t[3].perform_get('f'), 'No such key')
+        for holder, waiter, key in [(2, 1, 'a'), (1, 2, 'b'), (4, 3, 'c'),
+                                    (5, 4, 'd'), (3, 5, 'e')]:
+            self.assertEqual(t[waiter].perform_put(key, key), None)
+        self.assertEqual(t[6].perform_put('f', 'f'), None)
+        self.assertEqual(coordinator.find_deadlocks(), [2, 5])
+        self.assertEqual(coordinator.detect_deadlocks(), 2)
+        self.assertEqual(t[2].abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(t[5].abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(coordinator.find_deadlocks(), [])
+
+    def test_find_deadlocks_nested_cycles(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        coordinator = TransactionCoordinator(lock_table)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        t3 = TransactionHandler(lock_table, 3, store)
+        # 1 and 3 both wait for 2, and 2 waits for 1 and 3
+        self.assertEqual(t1.perform_get('a'), 'No such key')
+        self.assertEqual(t3.perform_get('a'), 'No such key')
+        self.assertEqual(t2.perform_get('b'), 'No such key')
+        self.assertEqual(t2.perform_put('a', 'a2'), None)
+        self.assertEqual(t1.perform_put('b', 'b1'), None)
+        self.assertEqual(t3.perform_put('b', 'b3'), None)
+        # Aborting 3 still leaves 1 and 2 waiting for each other
+        self.assertEqual(coordinator.find_deadlocks(), [2, 3])
+
+    def test_sharded_deadlock(self):
+        lock_table = ShardedLockTable(4)
+        store = InMemoryKVStore()
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t1.perform_get('a'), 'No such key')
+        self.assertEqual(t2.perform_get('b'), 'No such key')
+        self.assertEqual(t1.perform_put('b', 'b1'), None)
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t2.perform_put('a', 'a2'), None)
+        self.assertEqual(coordinator.detect_deadlocks(), 2)
+        # The cycle is reported until the victim is aborted
+        self.assertEqual(coordinator.detect_deadlocks(), 2)
+        self.assertEqual(t2.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t1.check_lock(), 'Success')
 
 
+
+    def test_wait_die(self):
+        lock_table = LockTable(prevention=WaitDie())
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')
+        self.assertEqual(t1.perform_put('b', 'b1'), 'Success')
+        # The older transaction waits, the younger one dies
+        self.assertEqual(t0.perform_get('b'), None)
+        self.assertEqual(t1.perform_get('a'), 'Deadlock Abort')
+        self.assertEqual(t0.check_lock(), 'No such key')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table, {})
+
+    def test_wait_die_queue(self):
+        lock_table = LockTable(prevention=WaitDie())
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t2.perform_put('a', 'a2'), 'Success')
+        self.assertEqual(t0.perform_put('a', 'a0'), None)
+        # t1 is younger than t0, which is queued ahead of it
+        self.assertEqual(t1.perform_get('a'), 'Deadlock Abort')
+        self.assertEqual(lock_table['a'][1], [(0, 'X')])
+
+    def test_wound_wait(self):
+        lock_table = LockTable(prevention=WoundWait())
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t1.perform_put('a', 'a1'), 'Success')
+        self.assertEqual(t2.perform_put('b', 'b2'), 'Success')
+        # The younger transaction waits for the older one
+        self.assertEqual(t2.perform_get('a'), None)
+        # t0 wounds t2, which is waiting and aborts as soon as it checks its
+        # lock, and t1, which aborts once it has to wait
+        self.assertEqual(t0.perform_get('b'), None)
+        self.assertEqual(t2.check_lock(), 'Deadlock Abort')
+        self.assertEqual(t0.check_lock(), 'No such key')
+        self.assertEqual(t0.perform_put('a', 'a0'), None)
+        self.assertEqual(t1.perform_put('b', 'b1'), 'Deadlock Abort')
+        self.assertEqual(t0.check_lock(), 'Success')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(store.get('a'), 'a0')
+        self.assertEqual(lock_table, {})
+
+    def test_wound_wait_reused_handler(self):
+        lock_table = LockTable(prevention=WoundWait())
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t1.perform_put('a', 'a1'), 'Success')
+        self.assertEqual(t0.perform_get('a'), None)
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t0.check_lock(), 'a1')
+        # t1's next transaction was not wounded, and can be
+        self.assertEqual(t1.perform_put('b', 'b1'), 'Success')
+        self.assertEqual(t1.perform_put('a', 'a2'), None)
+        self.assertEqual(t0.perform_get('b'), None)
+        self.assertEqual(t1.check_lock(), 'Deadlock Abort')
+        self.assertEqual(t0.check_lock(), 'No such key')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table, {})
+
+    def test_wound_waiting_thread(self):
+        lock_table = ShardedLockTable(4, prevention=WoundWait())
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t1.perform_put('a', 'a1'), 'Success')
+        self.assertEqual(t0.perform_put('b', 'b0'), 'Success')
+        self.assertEqual(t1.perform_get('b'), None)
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(t1.wait_for_lock(10)))
+        waiter.start()
+        # t1 is woken up and aborts itself on its own thread
+        self.assertEqual(t0.perform_get('a'), None)
+        waiter.join(10)
+        self.assertEqual(results, ['Deadlock Abort'])
+        self.assertEqual(t0.wait_for_lock(10), 'No such key')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+
+    def test_wait_die_start_order(self):
+        lock_table = LockTable(prevention=WaitDie(START))
+        store = InMemoryKVStore()
+        t1 = TransactionHandler(lock_table, 1, store)
+        t0 = TransactionHandler(lock_table, 0, store)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')
+        self.assertEqual(t1.perform_get('a'), None)
+        self.assertEqual(t0.perform_put('b', 'b0'), 'Success')
+        self.assertEqual(t1.abort(USER), 'User Abort')
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t2.perform_get('b'), 'Deadlock Abort')
+
+    def test_lock_wait_timeout(self):
+        lock_table = LockTable(prevention=LockWaitTimeout(0.05))
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')
+        self.assertEqual(t1.perform_get('a'), None)
+        self.assertEqual(t1.check_lock(), None)
+        start = time.time()
+        self.assertEqual(t1.wait_for_lock(), 'Deadlock Abort')
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(lock_table['a'][1], [])
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table, {})
+
+    def test_cheapest_victim(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        handlers = [TransactionHandler(lock_table, xid, store)
+                    for xid in range(3)]
+        t0, t1, t2 = handlers
+        coordinator = TransactionCoordinator(
+            lock_table, lambda xid: handlers[xid].rollback_cost())
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        for key in 'bcd':
+            self.assertEqual(t1.perform_put(key, '1'), 'Success')
+        self.assertEqual(t2.perform_get('e'), 'No such key')
+        self.assertEqual(t0.perform_put('b', '0'), None)
+        self.assertEqual(t1.perform_put('e', '1'), None)
+        self.assertEqual(t2.perform_put('a', '2'), None)
+        # t1 has the most to undo, t0 and t2 tie and t2 is younger
+        self.assertEqual(t0.rollback_cost(), (0, 1))
+        self.assertEqual(t1.rollback_cost(), (3, 3))
+        self.assertEqual(coordinator.find_deadlocks(), [2])
+        self.assertEqual(t2.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(coordinator.find_deadlocks(), [])
+
+    def test_cheapest_victim_writes(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        handlers = [TransactionHandler(lock_table, xid, store)
+                    for xid in range(2)]
+        t0, t1 = handlers
+        coordinator = TransactionCoordinator(
+            lock_table, lambda xid: handlers[xid].rollback_cost())
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        self.assertEqual(t1.perform_multi_put([('b', '1'), ('c', '1')]),
+                         'Success')
+        self.assertEqual(t0.perform_get('b'), None)
+        self.assertEqual(t1.perform_put('a', '1'), None)
+        # Without costs the youngest transaction would be picked
+        self.assertEqual(TransactionCoordinator(lock_table).find_deadlocks(),
+                         [1])
+        self.assertEqual(coordinator.find_deadlocks(), [0])
+
 if __name__ == '__main__':
     unittest.main()
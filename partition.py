@@ -0,0 +1,423 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import multiprocessing
+import zlib
+
+from client import Connection, ConnectionPool, TransactionAborted
+from kvstore import InMemoryKVStore
+from locktable import LockTable, deadlock_victims
+from protocol import INVALID, PREPARE
+from server import DEADLOCK_CHECK_INTERVAL, HOST, PORT, KVStoreServer
+from student import DEADLOCK, LOG_LEVEL
+from wal import WriteAheadLog
+
+"""
+A key-value store server that spreads the key space over several worker
+processes, so that it is not limited to one core. This module requires
+Python 3.
+
+PartitionedKVStoreServer starts @partitions worker processes, each an ordinary
+KVStoreServer with its own store and lock table that owns the keys hashed to
+it by partition_of_key(). It then serves clients itself, with the same
+protocols as KVStoreServer, as a router: every request is sent to the workers
+that own its keys, over pooled binary connections (see client.py). A
+transaction holds one connection to each worker it has touched, and runs
+there under the xid the router gave it, so the workers and the router agree
+on which transaction is which. Transactions that stay within one partition
+run in parallel on different workers; the router only forwards requests and
+does no lock or store work of its own.
+
+Deadlocks can span partitions, so the workers do not look for deadlocks
+themselves. Every @deadlock_interval seconds the router asks every worker how
+its waits-for graph changed since the last time, keeps a copy of each graph
+up to date with those deltas, merges the copies, and has the workers abort
+the youngest transaction of each cycle. A worker only sends the edges that
+came or went, so the traffic grows with the lock waits rather than with the
+number of waiting transactions. The victims depend only on the merged graph,
+so every detection round over the same graph picks the same ones. A
+transaction that is aborted on one worker is rolled back on all the others.
+
+A transaction that spans partitions commits with two-phase commit, with the
+router as the coordinator. It first prepares the transaction on every worker
+it touched, in parallel. Workers it only read from commit right there. If any
+worker fails to prepare, the transaction is aborted everywhere and the client
+gets 'Deadlock Abort'. Otherwise the router logs its decision to commit, and
+then commits the transaction on the prepared workers, in parallel. A
+transaction that touched a single worker simply commits there.
+
+With a @log_path, worker @index logs to '@log_path.@index' and the router
+logs its commit decisions to '@log_path.coordinator' (see wal.py). Aborts are
+not logged: a transaction with no commit decision in the log never committed
+anywhere. A worker keeps a prepared transaction, and its locks, until it
+learns the outcome, even across a restart, and when the router starts it
+resolves whatever the workers have in doubt from its log.
+
+Workers are created with @store_factory(@index) if it is given, for example
+to give each of them a store in its own file, and with the default store of
+KVStoreServer otherwise.
+"""
+
+logger = logging.getLogger(__name__)
+
+# How long stop() waits for a connection to a worker to close, in case the
+# worker is gone
+CLOSE_TIMEOUT = 1
+
+def partition_of_key(key, partitions):
+    """
+    Returns the partition that owns @key, the same in every process.
+    """
+    return zlib.crc32(key.encode('utf-8')) % partitions
+
+def _run_worker(pipe, index, store_factory, log_path, write_buffered, mvcc):
+    logging.basicConfig(level=LOG_LEVEL)
+    store = store_factory(index) if store_factory is not None else None
+    wal = None
+    if log_path is not None:
+        wal = WriteAheadLog('%s.%d' % (log_path, index))
+    server = KVStoreServer(host=HOST, port=0, store=store, wal=wal,
+                           write_buffered=write_buffered, mvcc=mvcc,
+                           deadlock_interval=None, router_requests=True)
+
+    async def main():
+        await server.start()
+        pipe.send(server.port)
+        pipe.close()
+        await server._server.serve_forever()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+"""
+The router's side of a transaction. It has the same coroutines as
+AsyncTransactionHandler, except prepare(), and returns the same responses, so
+KVStoreServer can run it like one. The router coordinates the two-phase
+commits of its own transactions and cannot take part in somebody else's, so
+it answers PREPARE with INVALID.
+"""
+class RoutedTransaction(object):
+
+    # The router never leaves a transaction prepared
+    prepared = False
+
+    def __init__(self, router, xid):
+        self.xid = xid
+        self._router = router
+        self._connections = {}
+        self._finished = False
+
+    async def perform_get(self, key):
+        partition = self._router.partition_of(key)
+        results = await self._run([(partition, lambda c: c.get(key))])
+        if isinstance(results, str):
+            return results
+        return 'No such key' if results[0] is None else results[0]
+
+    async def perform_put(self, key, value):
+        partition = self._router.partition_of(key)
+        results = await self._run([(partition, lambda c: c.put(key, value))])
+        return results if isinstance(results, str) else results[0]
+
+    async def perform_multi_get(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._router.partition_of(key), []).append(key)
+        results = await self._run(
+            [(partition, lambda c, group=group: c.multi_get(group))
+             for partition, group in groups.items()])
+        if isinstance(results, str):
+            return results
+        values = {}
+        for group, result in zip(groups.values(), results):
+            values.update(zip(group, result))
+        return ['No such key' if values[key] is None else values[key]
+                for key in keys]
+
+    async def perform_multi_put(self, items):
+        groups = {}
+        for key, value in items.items():
+            partition = self._router.partition_of(key)
+            groups.setdefault(partition, {})[key] = value
+        results = await self._run(
+            [(partition, lambda c, group=group: c.multi_put(group))
+             for partition, group in groups.items()])
+        return results if isinstance(results, str) else 'Success'
+
+    async def commit(self):
+        self._finished = True
+        connections = list(self._connections.items())
+        self._connections = {}
+        try:
+            if len(connections) > 1:
+                return await self._commit_prepared(connections)
+            for partition, connection in connections:
+                await connection.commit()
+            return 'Transaction Completed'
+        finally:
+            for partition, connection in connections:
+                self._router.release(partition, connection)
+
+    async def _commit_prepared(self, connections):
+        votes = await asyncio.gather(
+            *[connection.prepare() for partition, connection in connections],
+            return_exceptions=True)
+        prepared = [pair for pair, vote in zip(connections, votes)
+                    if vote == 'Prepared']
+        if any(vote not in ('Prepared', 'Transaction Completed')
+               for vote in votes):
+            await asyncio.gather(
+                *[connection.abort() for partition, connection in prepared],
+                return_exceptions=True)
+            return 'Deadlock Abort'
+        if not prepared:
+            return 'Transaction Completed'
+        await self._router.log_commit(self.xid)
+        results = await asyncio.gather(
+            *[connection.commit() for partition, connection in prepared],
+            return_exceptions=True)
+        for (partition, connection), result in zip(prepared, results):
+            if isinstance(result, BaseException):
+                # The worker keeps the transaction in doubt until it is told
+                # the outcome
+                logger.warning('Transaction %d did not commit on partition '
+                               '%d: %r', self.xid, partition, result)
+                await self._router.resolve(partition, self.xid)
+        return 'Transaction Completed'
+
+    def abort(self, mode):
+        if not self._finished:
+            self._finished = True
+            connections, self._connections = self._connections, {}
+            asyncio.ensure_future(self._abort(connections))
+        return 'Deadlock Abort' if mode == DEADLOCK else 'User Abort'
+
+    async def _abort(self, connections):
+        for partition, connection in connections.items():
+            try:
+                await connection.abort()
+            except ConnectionError:
+                pass
+            self._router.release(partition, connection)
+
+    async def _run(self, calls):
+        """
+        Sends the requests in @calls, a list of (@partition, @request) pairs
+        where @request sends a request on the connection to @partition it is
+        given.
+
+        @return: the list of the results, or the response to the client if the
+        transaction was aborted.
+        """
+        tasks = [asyncio.ensure_future(self._call(partition, request))
+                 for partition, request in calls]
+        done, pending = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_EXCEPTION)
+        if pending:
+            # Requests still waiting for locks elsewhere would hold up the
+            # abort
+            self._router.kill(self.xid)
+            await asyncio.wait(pending)
+        results = []
+        for task in tasks:
+            error = task.exception()
+            if isinstance(error, TransactionAborted):
+                return self.abort(DEADLOCK)
+            if error is not None:
+                self.abort(DEADLOCK)
+                raise error
+            results.append(task.result())
+        return results
+
+    async def _call(self, partition, request):
+        connection = self._connections.get(partition)
+        begin = None
+        if connection is None:
+            connection = await self._router.acquire(partition)
+            self._connections[partition] = connection
+            begin = connection.begin(self.xid)
+        future = request(connection)
+        if begin is not None:
+            await begin
+        return await future
+
+class PartitionedKVStoreServer(KVStoreServer):
+
+    def __init__(self, host=HOST, port=PORT, partitions=4, store_factory=None,
+                 log_path=None, write_buffered=False, mvcc=False,
+                 deadlock_interval=DEADLOCK_CHECK_INTERVAL):
+        # The router keeps no data and takes no locks of its own
+        KVStoreServer.__init__(self, host, port, store=InMemoryKVStore(),
+                               lock_table=LockTable(),
+                               deadlock_interval=deadlock_interval)
+        self._partitions = partitions
+        self._store_factory = store_factory
+        self._log_path = log_path
+        self._log = None
+        if log_path is not None:
+            self._log = WriteAheadLog(log_path + '.coordinator')
+        self._worker_options = (log_path, write_buffered, mvcc)
+        self._workers = []
+        self._pools = []
+        self._control = []
+        # The router's copy of the waits-for edges of each worker
+        self._edges = []
+
+    @property
+    def partitions(self):
+        return self._partitions
+
+    def partition_of(self, key):
+        return partition_of_key(key, self._partitions)
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        context = multiprocessing.get_context('spawn')
+        pipes = []
+        for index in range(self._partitions):
+            receiver, sender = context.Pipe(duplex=False)
+            worker = context.Process(
+                target=_run_worker,
+                args=(sender, index, self._store_factory) +
+                self._worker_options)
+            worker.daemon = True
+            worker.start()
+            sender.close()
+            self._workers.append(worker)
+            pipes.append(receiver)
+        ports = await asyncio.gather(
+            *[loop.run_in_executor(None, pipe.recv) for pipe in pipes])
+        for pipe in pipes:
+            pipe.close()
+        for port in ports:
+            # Connections stay with a transaction while it waits for locks,
+            # so running out of them could deadlock the router
+            self._pools.append(ConnectionPool(HOST, port, size=None,
+                                              binary=True))
+            self._control.append(await Connection.open(HOST, port,
+                                                       binary=True))
+            self._edges.append(set())
+        last = await self.recover()
+        self._xids = itertools.count(last + 1)
+        await KVStoreServer.start(self)
+
+    async def stop(self):
+        try:
+            await KVStoreServer.stop(self)
+            for closeable in self._control + self._pools:
+                with contextlib.suppress(ConnectionError,
+                                         asyncio.TimeoutError):
+                    await asyncio.wait_for(closeable.close(), CLOSE_TIMEOUT)
+        finally:
+            for worker in self._workers:
+                worker.terminate()
+            loop = asyncio.get_event_loop()
+            for worker in self._workers:
+                await loop.run_in_executor(None, worker.join)
+        self._workers = []
+        self._pools = []
+        self._control = []
+        self._edges = []
+        if self._log is not None:
+            self._log.close()
+
+    def _begin(self, xid=None):
+        transaction = RoutedTransaction(self, next(self._xids))
+        self._handlers[transaction.xid] = transaction
+        return transaction
+
+    async def _execute(self, handler, request):
+        if request is not None and request[0] == PREPARE:
+            return INVALID, None
+        return await KVStoreServer._execute(self, handler, request)
+
+    async def acquire(self, partition):
+        return await self._pools[partition].acquire()
+
+    def release(self, partition, connection):
+        self._pools[partition].release(connection)
+
+    async def log_commit(self, xid):
+        """
+        Makes the decision to commit transaction @xid durable, if the router
+        has a log.
+        """
+        if self._log is not None:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self._log.decide, xid, True)
+
+    async def resolve(self, partition, xid):
+        """
+        Tells the worker of @partition that transaction @xid committed, in
+        case it has it in doubt.
+        """
+        try:
+            await self._control[partition].resolve(xid, True)
+        except ConnectionError:
+            # It will be resolved when the router next starts
+            pass
+
+    async def recover(self):
+        """
+        Resolves the transactions the workers have in doubt: those with a
+        commit decision in the log commit, and the rest abort.
+
+        @return: the largest xid found in the log or in doubt, or -1.
+        """
+        decisions = self._log.decisions() if self._log is not None else {}
+        last = max(decisions) if decisions else -1
+        in_doubt = await asyncio.gather(
+            *[connection.in_doubt() for connection in self._control])
+        for connection, xids in zip(self._control, in_doubt):
+            for xid in xids:
+                logger.info('Resolving in-doubt transaction %d', xid)
+                await connection.resolve(xid, decisions.get(xid, False))
+                last = max(last, xid)
+        return last
+
+    def kill(self, xid):
+        """
+        Has every worker abort transaction @xid as a deadlock victim.
+        """
+        for connection in self._control:
+            connection.kill(xid).add_done_callback(_ignore_result)
+
+    async def global_waits_for(self):
+        """
+        Returns the union of the waits-for graphs of the workers, as a dict
+        mapping each waiting transaction to the sorted list of the
+        transactions it waits for. Only the changes since the last call are
+        fetched from the workers.
+        """
+        deltas = await asyncio.gather(
+            *[connection.waits_for_delta() for connection in self._control])
+        waits_for = {}
+        for edges, (added, removed) in zip(self._edges, deltas):
+            edges.difference_update(removed)
+            edges.update(added)
+            for waiter, blocker in edges:
+                waits_for.setdefault(waiter, set()).add(blocker)
+        return dict((xid, sorted(blockers))
+                    for xid, blockers in waits_for.items())
+
+    async def find_deadlocks(self):
+        """
+        Returns the sorted xids of the transactions to abort to break every
+        cycle in the global waits-for graph, the youngest of each.
+        """
+        waits_for = await self.global_waits_for()
+        return deadlock_victims(sorted(waits_for),
+                                lambda xid: waits_for.get(xid, ()))
+
+    async def _detect_deadlocks(self):
+        while True:
+            await asyncio.sleep(self._deadlock_interval)
+            for xid in await self.find_deadlocks():
+                logger.info('Aborting transaction %d to break a deadlock', xid)
+                self.kill(xid)
+
+def _ignore_result(future):
+    if not future.cancelled():
+        future.exception()
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from client import Connection, ConnectionPool, TransactionAborted
+from partition import PartitionedKVStoreServer, partition_of_key
+from servertest import ServerFixture
+from wal import WriteAheadLog
+
+def keys_in(partition, partitions, count):
+    keys = []
+    i = 0
+    while len(keys) < count:
+        key = 'k%d' % i
+        if partition_of_key(key, partitions) == partition:
+            keys.append(key)
+        i += 1
+    return keys
+
+class PartitionTest(ServerFixture, unittest.TestCase):
+    server_class = PartitionedKVStoreServer
+    timeout = 30
+
+    def server_options(self):
+        return {'partitions': 2, 'deadlock_interval': 0.01}
+
+    def test_partition_of_key(self):
+        self.assertEqual(partition_of_key('a', 4), partition_of_key('a', 4))
+        self.assertEqual(set(partition_of_key('k%d' % i, 4)
+                             for i in range(100)), set(range(4)))
+
+    def test_cross_partition_transaction(self):
+        a, = keys_in(0, 2, 1)
+        b, c = keys_in(1, 2, 2)
+
+        async def scenario(server):
+            connection = await Connection.open(port=server.port)
+            self.assertEqual(await connection.put(a, '0'), 'Success')
+            self.assertEqual(await connection.multi_put({b: '1', c: '2'}),
+                             'Success')
+            self.assertEqual(await connection.multi_get([c, 'x', a, b]),
+                             ['2', None, '0', '1'])
+            self.assertEqual(await connection.commit(),
+                             'Transaction Completed')
+            # Each worker only has its own keys
+            self.assertEqual(await connection.get(b), '1')
+            self.assertEqual(await connection.abort(), 'User Abort')
+
+            self.assertEqual(await connection.put(a, 'x'), 'Success')
+            self.assertEqual(await connection.put(b, 'y'), 'Success')
+            self.assertEqual(await connection.abort(), 'User Abort')
+            self.assertEqual(await connection.multi_get([a, b]), ['0', '1'])
+            await connection.commit()
+            await connection.close()
+        self.run_server(scenario)
+
+    def test_global_deadlock(self):
+        a, = keys_in(0, 2, 1)
+        b, = keys_in(1, 2, 1)
+
+        async def scenario(server):
+            connection1 = await Connection.open(port=server.port)
+            connection2 = await Connection.open(port=server.port)
+            self.assertIsNone(await connection1.get(a))
+            self.assertIsNone(await connection2.get(b))
+            write1 = connection1.put(b, '1')
+            await asyncio.sleep(0.05)
+            write2 = connection2.put(a, '2')
+            # Neither worker sees a cycle, the router does and aborts the
+            # younger transaction
+            with self.assertRaises(TransactionAborted):
+                await write2
+            self.assertEqual(await write1, 'Success')
+            self.assertEqual(await connection1.commit(),
+                             'Transaction Completed')
+            self.assertEqual(await connection2.abort(), 'Deadlock Abort')
+            self.assertEqual(await connection2.multi_get([a, b]), [None, '1'])
+            await connection2.commit()
+            self.assertEqual(await server.find_deadlocks(), [])
+            await connection1.close()
+            await connection2.close()
+        self.run_server(scenario)
+
+    def test_prepare_is_invalid(self):
+        a, = keys_in(0, 2, 1)
+
+        async def scenario(server):
+            connection = await Connection.open(port=server.port, binary=True)
+            await connection.put(a, '0')
+            with self.assertRaises(ValueError):
+                await connection.prepare()
+            self.assertEqual(await connection.commit(),
+                             'Transaction Completed')
+            self.assertEqual(await connection.get(a), '0')
+            await connection.commit()
+            await connection.close()
+        self.run_server(scenario)
+
+    def test_failed_prepare(self):
+        a, = keys_in(0, 2, 1)
+        b, = keys_in(1, 2, 1)
+
+        async def scenario(server):
+            pool = ConnectionPool(port=server.port, binary=True)
+            with self.assertRaises(TransactionAborted):
+                async with pool.transaction() as connection:
+                    await connection.multi_put({a: '0', b: '0'})
+                    # The worker of b cannot vote to commit
+                    worker = server._workers[1]
+                    worker.terminate()
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, worker.join)
+            async with pool.transaction() as connection:
+                self.assertIsNone(await connection.get(a))
+            await pool.close()
+        self.run_server(scenario)
+
+    def test_stop_after_worker_died(self):
+        a, = keys_in(0, 2, 1)
+        b, = keys_in(1, 2, 1)
+
+        async def scenario(server):
+            connection = await Connection.open(port=server.port)
+            await connection.multi_put({a: '0', b: '0'})
+            worker = server._workers[1]
+            worker.terminate()
+            await asyncio.get_event_loop().run_in_executor(None, worker.join)
+            await connection.close()
+        self.run_server(scenario)
+
+    def test_two_phase_commit_recovery(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'log')
+        a, c, e = keys_in(0, 2, 3)
+        b, d = keys_in(1, 2, 2)
+
+        async def commit(server):
+            connection = await Connection.open(port=server.port)
+            await connection.multi_put({a: '0', b: '0'})
+            self.assertEqual(await connection.commit(),
+                             'Transaction Completed')
+            # Only one partition has anything to commit
+            self.assertEqual(await connection.get(a), '0')
+            await connection.put(b, '1')
+            self.assertEqual(await connection.commit(),
+                             'Transaction Completed')
+            await connection.close()
+        self.run_server(commit, log_path=path)
+
+        # The router crashed after deciding to commit 100 but before telling
+        # the workers, which also have 101 prepared
+        for index, prepared in ((0, [(100, c), (101, e)]), (1, [(100, d)])):
+            wal = WriteAheadLog('%s.%d' % (path, index))
+            for xid, key in prepared:
+                wal.prepare(xid, [(key, str(xid))], [])
+            wal.close()
+        wal = WriteAheadLog(path + '.coordinator')
+        wal.decide(100, True)
+        wal.close()
+
+        async def recover(server):
+            connection = await Connection.open(port=server.port)
+            self.assertEqual(await connection.multi_get([a, b, c, d, e]),
+                             ['0', '1', '100', '100', None])
+            # 101 gave up its locks
+            await connection.put(e, '1')
+            await connection.commit()
+            await connection.close()
+        self.run_server(recover, log_path=path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import itertools
+import threading
+
+"""
+Deadlock prevention policies.
+
+A lock table created with a prevention policy (see LockTable) has every
+transaction handler consult the policy at the moment one of its requests is
+queued, instead of leaving deadlocks to be found later by the detector in
+TransactionCoordinator. The policy decides whether the requester may wait; if
+not, the requester aborts itself with 'Deadlock Abort' right away. Policies
+that never let a cycle of waiting transactions form make the detector
+unnecessary.
+
+Transactions are ranked by age, oldest first. With order=XID a lower xid is
+older, and with order=START a transaction is as old as the moment its handler
+was created.
+
+WaitDie: a transaction may only wait for younger transactions. If anybody it
+would wait for is older, it dies (aborts) instead.
+
+WoundWait: a transaction always waits, but wounds every younger transaction it
+would wait for. Wounding only marks the victim and wakes it up if it is
+waiting; the victim aborts itself, on its own thread, the next time it checks
+on a lock, whether that is the lock it is waiting for or the next one it has
+to wait for.
+
+LockWaitTimeout: a transaction may wait, but is aborted if its request has not
+been granted after @timeout seconds. This does not prevent deadlocks, it only
+bounds how long they last.
+
+PreventionPolicy itself lets every transaction wait, and is the base class of
+the others.
+"""
+
+XID = 'xid'
+START = 'start'
+
+class PreventionPolicy(object):
+
+    timeout = None
+
+    def __init__(self, order=XID):
+        if order not in (XID, START):
+            raise ValueError('unknown order %r' % (order,))
+        self.order = order
+        self._handlers = {}
+        self._started = {}
+        self._clock = itertools.count()
+        self._mutex = threading.Lock()
+
+    def begin(self, handler):
+        """
+        Registers a new transaction. Called by the transaction handler.
+        """
+        with self._mutex:
+            self._handlers[handler._xid] = handler
+            self._started[handler._xid] = next(self._clock)
+
+    def end(self, handler):
+        """
+        Unregisters a transaction once it has released its locks.
+        """
+        with self._mutex:
+            self._handlers.pop(handler._xid, None)
+            self._started.pop(handler._xid, None)
+
+    def age(self, xid):
+        """
+        Returns a value that is lower the older transaction @xid is.
+        """
+        if self.order == XID:
+            return xid
+        with self._mutex:
+            return self._started.get(xid, xid)
+
+    def handler(self, xid):
+        with self._mutex:
+            return self._handlers.get(xid)
+
+    def on_block(self, handler, blockers):
+        """
+        Called when a request of @handler has just been queued behind the
+        transactions in @blockers.
+
+        @return: True if the transaction may wait, False if it must abort.
+        """
+        return True
+
+class WaitDie(PreventionPolicy):
+
+    def on_block(self, handler, blockers):
+        age = self.age(handler._xid)
+        return all(age < self.age(blocker) for blocker in blockers)
+
+class WoundWait(PreventionPolicy):
+
+    def on_block(self, handler, blockers):
+        age = self.age(handler._xid)
+        for blocker in blockers:
+            if self.age(blocker) > age:
+                victim = self.handler(blocker)
+                if victim is not None:
+                    victim.wound()
+        return True
+
+class LockWaitTimeout(PreventionPolicy):
+
+    def __init__(self, timeout, order=XID):
+        PreventionPolicy.__init__(self, order)
+        self.timeout = timeout
@@ -0,0 +1,288 @@
+import struct
+
+"""
+The binary protocol of the key-value store server. This module requires
+Python 3.
+
+A connection starts out speaking the text protocol (see server.py). A client
+switches it to the binary protocol by sending the line 'PROTOCOL BINARY'
+before its first request; the server answers 'Protocol binary' and from then
+on both sides exchange frames. Every frame starts with the length of the rest
+of the frame as an unsigned 32-bit big-endian integer.
+
+A request frame holds an opcode byte followed by its arguments:
+
+    GET       <key>
+    PUT       <key> <value>
+    MGET      <count> <key>...
+    MPUT      <count> <key> <value>...
+    COMMIT
+    ABORT
+    BEGIN     <xid>
+    WAITS_FOR
+    KILL      <xid>
+    PREPARE
+    IN_DOUBT
+    RESOLVE   <xid> <commit>
+    WAITS_FOR_DELTA
+
+A response frame holds a status byte, the xid of the transaction that ran the
+request as an unsigned 64-bit integer, and for an OK response to GET the
+value, to MGET the count and the values, to WAITS_FOR the count and the
+(waiter, blocker) xid pairs, to WAITS_FOR_DELTA the count and pairs of the
+edges added and then of the edges removed, or to IN_DOUBT the count and the
+xids. Counts are unsigned 32-bit integers and xids unsigned 64-bit
+integers. Keys and values are strings: a 32-bit length followed by that many
+bytes of UTF-8, with a length of MISSING for a key that does not exist.
+Nothing is escaped.
+
+The rest of the requests let a router run a transaction across several servers
+(see partition.py). Servers only accept them when they are set up to trust
+their clients, see KVStoreServer. BEGIN starts the connection's next
+transaction with the given xid instead of one the server picks. PREPARE
+prepares the transaction for two-phase commit and gets PREPARED back, or
+COMMITTED if it had nothing to commit; a COMMIT or ABORT then finishes it. The
+others are not part of any transaction: WAITS_FOR returns the server's
+waits-for graph, WAITS_FOR_DELTA returns how it changed since the connection
+last asked (the first time, every edge is added), KILL aborts a transaction as
+a deadlock victim, IN_DOUBT returns the prepared transactions whose connection
+went away or that were recovered from the log, and RESOLVE commits (if
+<commit> is 1) or aborts one of them.
+"""
+
+(GET, PUT, MGET, MPUT, COMMIT, ABORT, BEGIN, WAITS_FOR, KILL, PREPARE,
+ IN_DOUBT, RESOLVE, WAITS_FOR_DELTA) = range(1, 14)
+
+OK, COMMITTED, USER_ABORT, DEADLOCK_ABORT, INVALID, PREPARED = range(6)
+
+# The text protocol's response for each status other than OK
+MESSAGES = {
+    COMMITTED: 'Transaction Completed',
+    USER_ABORT: 'User Abort',
+    DEADLOCK_ABORT: 'Deadlock Abort',
+    INVALID: 'Invalid command',
+    PREPARED: 'Prepared',
+}
+
+HELLO = b'PROTOCOL BINARY\n'
+HELLO_REPLY = b'Protocol binary\n'
+
+MISSING = 0xFFFFFFFF
+MAX_FRAME = 64 * 1024 * 1024
+
+_LENGTH = struct.Struct('>I')
+_OPCODE = struct.Struct('>B')
+_STATUS = struct.Struct('>BQ')
+_XID = struct.Struct('>Q')
+_RESOLVE = struct.Struct('>QB')
+_EDGE = struct.Struct('>QQ')
+
+HEADER_SIZE = _LENGTH.size
+
+def frame_length(header):
+    """
+    Returns the length of the frame that starts with the HEADER_SIZE bytes
+    @header.
+
+    @raise ValueError: if it is longer than MAX_FRAME.
+    """
+    length, = _LENGTH.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError('frame of %d bytes is too long' % length)
+    return length
+
+def _frame(parts):
+    body = b''.join(parts)
+    return _LENGTH.pack(len(body)) + body
+
+def _string(parts, value):
+    if value is None:
+        parts.append(_LENGTH.pack(MISSING))
+    else:
+        data = value.encode('utf-8')
+        parts.append(_LENGTH.pack(len(data)))
+        parts.append(data)
+
+def _edges(parts, edges):
+    parts.append(_LENGTH.pack(len(edges)))
+    for waiter, blocker in edges:
+        parts.append(_EDGE.pack(waiter, blocker))
+
+def _read_count(view, offset):
+    return _LENGTH.unpack_from(view, offset)[0], offset + _LENGTH.size
+
+def _read_edges(view, offset):
+    count, offset = _read_count(view, offset)
+    edges = []
+    for i in range(count):
+        edges.append(_EDGE.unpack_from(view, offset))
+        offset += _EDGE.size
+    return edges, offset
+
+def _read_string(view, offset):
+    length, offset = _read_count(view, offset)
+    if length == MISSING:
+        return None, offset
+    end = offset + length
+    if end > len(view):
+        raise ValueError('truncated string')
+    # Decodes straight out of the receive buffer
+    return str(view[offset:end], 'utf-8'), end
+
+def encode_request(opcode, args):
+    """
+    Returns the frame of a request. @args are the arguments of the matching
+    TransactionHandler method: (@key,) for GET, (@key, @value) for PUT,
+    (@keys,) for MGET, (@items,) for MPUT and () for COMMIT, ABORT and
+    PREPARE. BEGIN and KILL take (@xid,), RESOLVE takes (@xid, @commit) and
+    WAITS_FOR, WAITS_FOR_DELTA and IN_DOUBT take ().
+    """
+    parts = [_OPCODE.pack(opcode)]
+    if opcode == GET:
+        _string(parts, args[0])
+    elif opcode == PUT:
+        _string(parts, args[0])
+        _string(parts, args[1])
+    elif opcode == MGET:
+        parts.append(_LENGTH.pack(len(args[0])))
+        for key in args[0]:
+            _string(parts, key)
+    elif opcode == MPUT:
+        parts.append(_LENGTH.pack(len(args[0])))
+        for key, value in args[0].items():
+            _string(parts, key)
+            _string(parts, value)
+    elif opcode in (BEGIN, KILL):
+        parts.append(_XID.pack(args[0]))
+    elif opcode == RESOLVE:
+        parts.append(_RESOLVE.pack(args[0], bool(args[1])))
+    elif opcode not in (COMMIT, ABORT, WAITS_FOR, PREPARE, IN_DOUBT,
+                        WAITS_FOR_DELTA):
+        raise ValueError('unknown opcode %r' % (opcode,))
+    return _frame(parts)
+
+def decode_request(view):
+    """
+    Decodes the body of a request frame, a memoryview.
+
+    @return: (@opcode, @args) as taken by encode_request(), or None if the
+    request is malformed.
+    """
+    try:
+        opcode, = _OPCODE.unpack_from(view, 0)
+        offset = _OPCODE.size
+        if opcode == GET:
+            key, offset = _read_string(view, offset)
+            args = (key,)
+            keys = [key]
+        elif opcode == PUT:
+            key, offset = _read_string(view, offset)
+            value, offset = _read_string(view, offset)
+            if value is None:
+                return None
+            args = (key, value)
+            keys = [key]
+        elif opcode == MGET:
+            count, offset = _read_count(view, offset)
+            keys = []
+            for i in range(count):
+                key, offset = _read_string(view, offset)
+                keys.append(key)
+            args = (keys,)
+        elif opcode == MPUT:
+            count, offset = _read_count(view, offset)
+            items = {}
+            for i in range(count):
+                key, offset = _read_string(view, offset)
+                value, offset = _read_string(view, offset)
+                if value is None:
+                    return None
+                items[key] = value
+            args = (items,)
+            keys = list(items)
+        elif opcode in (BEGIN, KILL):
+            args = _XID.unpack_from(view, offset)
+            offset += _XID.size
+            keys = ()
+        elif opcode == RESOLVE:
+            xid, commit = _RESOLVE.unpack_from(view, offset)
+            args = (xid, bool(commit))
+            offset += _RESOLVE.size
+            keys = ()
+        elif opcode in (COMMIT, ABORT, WAITS_FOR, PREPARE, IN_DOUBT,
+                        WAITS_FOR_DELTA):
+            args = ()
+            keys = ()
+        else:
+            return None
+    except (struct.error, UnicodeDecodeError, ValueError):
+        return None
+    if offset != len(view) or not all(keys) or \
+            (opcode in (MGET, MPUT) and not keys):
+        return None
+    return opcode, args
+
+def encode_response(status, xid, opcode, value=None):
+    """
+    Returns the frame of the response to an @opcode request. @value is the
+    result of an OK GET (a string or None), MGET (a list of them),
+    WAITS_FOR (a list of (@waiter, @blocker) pairs), WAITS_FOR_DELTA (a pair
+    of such lists, the edges added and removed) or IN_DOUBT (a list of xids).
+    """
+    parts = [_STATUS.pack(status, xid)]
+    if status == OK:
+        if opcode == GET:
+            _string(parts, value)
+        elif opcode == MGET:
+            parts.append(_LENGTH.pack(len(value)))
+            for item in value:
+                _string(parts, item)
+        elif opcode == WAITS_FOR:
+            _edges(parts, value)
+        elif opcode == WAITS_FOR_DELTA:
+            _edges(parts, value[0])
+            _edges(parts, value[1])
+        elif opcode == IN_DOUBT:
+            parts.append(_LENGTH.pack(len(value)))
+            for xid in value:
+                parts.append(_XID.pack(xid))
+    return _frame(parts)
+
+def decode_response(view, opcode):
+    """
+    Decodes the body of the response frame @view, a memoryview, to an
+    @opcode request.
+
+    @return: (@status, @xid, @value).
+    @raise ValueError: if the response is malformed.
+    """
+    try:
+        status, xid = _STATUS.unpack_from(view, 0)
+        offset = _STATUS.size
+        value = None
+        if status == OK:
+            if opcode == GET:
+                value, offset = _read_string(view, offset)
+            elif opcode == MGET:
+                count, offset = _read_count(view, offset)
+                value = []
+                for i in range(count):
+                    item, offset = _read_string(view, offset)
+                    value.append(item)
+            elif opcode == WAITS_FOR:
+                value, offset = _read_edges(view, offset)
+            elif opcode == WAITS_FOR_DELTA:
+                added, offset = _read_edges(view, offset)
+                removed, offset = _read_edges(view, offset)
+                value = (added, removed)
+            elif opcode == IN_DOUBT:
+                count, offset = _read_count(view, offset)
+                value = []
+                for i in range(count):
+                    value.append(_XID.unpack_from(view, offset)[0])
+                    offset += _XID.size
+    except struct.error as e:
+        raise ValueError(str(e))
+    if offset != len(view):
+        raise ValueError('trailing bytes in response')
+    return status, xid, value
@@ -1,4 +1,4 @@
-from infra.client import KVStoreCommandLineClient
+from client import KVStoreCommandLineClient
 
 """
 You can start a client by simply running this file on the command line.
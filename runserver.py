@@ -1,11 +1,22 @@
-from infra.server import KVStoreServer
+import argparse
+
+from partition import PartitionedKVStoreServer
+from server import KVStoreServer
 
 """
-You can start the server by simply running this file on the command line.
+You can start the server by simply running this file on the command line. With
+--partitions N, it starts N worker processes that each own part of the keys.
 """
 
 def main():
-    server = KVStoreServer()
+    parser = argparse.ArgumentParser(description='Key-value store server.')
+    parser.add_argument('--partitions', type=int, default=1,
+                        help='worker processes to spread the keys over')
+    args = parser.parse_args()
+    if args.partitions > 1:
+        server = PartitionedKVStoreServer(partitions=args.partitions)
+    else:
+        server = KVStoreServer()
     server.run()
 
 if __name__ == '__main__':
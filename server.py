@@ -0,0 +1,505 @@
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+import protocol
+from kvstore import MVCCStore
+from locktable import LockTable
+from protocol import (ABORT, BEGIN, COMMIT, COMMITTED, DEADLOCK_ABORT, GET,
+                      IN_DOUBT, INVALID, KILL, MGET, MPUT, OK, PREPARE,
+                      PREPARED, PUT, RESOLVE, USER_ABORT, WAITS_FOR,
+                      WAITS_FOR_DELTA)
+from student import (DEADLOCK, KVSTORE_CLASS, LOG_LEVEL, USER,
+                     TransactionCoordinator, TransactionHandler)
+
+"""
+An asyncio front end for the transaction handler. This module requires
+Python 3.
+
+Every client connection runs one transaction at a time. Requests are lines of
+text and every request gets exactly one line back:
+
+    GET <key>             the value, or 'No such key'
+    PUT <key> <value>     'Success'
+    MGET <key> <key>...   a JSON list of the values, with 'No such key' for
+                          missing keys
+    MPUT <json object>    'Success', after putting every key-value pair
+    COMMIT                'Transaction Completed'
+    ABORT                 'User Abort'
+
+A request that has to wait for a lock gets no response until the lock is
+granted; the connection is parked on a future instead of holding a thread. If
+the transaction is chosen as a deadlock victim while it waits, the response is
+'Deadlock Abort'. After a commit or abort, the next request starts a new
+transaction. Malformed requests get 'Invalid command' and do not affect the
+transaction.
+
+Sending 'PROTOCOL BINARY' before the first request switches the connection to
+the length-prefixed binary protocol described in protocol.py, which carries
+the same requests without any text parsing or escaping.
+"""
+
+HOST = 'localhost'
+PORT = 8765
+DEADLOCK_CHECK_INTERVAL = 0.1
+
+logger = logging.getLogger(__name__)
+
+"""
+A transaction handler whose perform_get(), perform_put(), perform_multi_get()
+and perform_multi_put() are coroutines. Instead of returning None when the lock
+is not available, they suspend until the lock has been granted and then return
+whatever the synchronous handler would have returned. If the transaction is
+aborted while it waits, they return 'Deadlock Abort' or 'User Abort'.
+commit() and prepare() are coroutines too, which wait for the write-ahead log
+without blocking the event loop.
+
+Grants are delivered through the grant callback of TransactionHandler, so a
+waiting transaction costs nothing until the lock is released, even if the lock
+is released on another thread.
+"""
+class AsyncTransactionHandler(TransactionHandler):
+
+    __slots__ = ('_loop', '_waiter', '_abort_mode')
+
+    def __init__(self, lock_table, xid, store, wal=None, write_buffered=False,
+                 mvcc=False, loop=None):
+        TransactionHandler.__init__(self, lock_table, xid, store, wal,
+                                    write_buffered, mvcc)
+        self._loop = loop or asyncio.get_event_loop()
+        self._waiter = None
+        self._abort_mode = None
+        self.set_grant_callback(self._wake)
+
+    @property
+    def xid(self):
+        return self._xid
+
+    def _wake(self, handler):
+        self._loop.call_soon_threadsafe(self._resolve_waiter)
+
+    def _resolve_waiter(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _wait(self):
+        while True:
+            self._waiter = self._loop.create_future()
+            result = self.check_lock()
+            if result is not None:
+                return result
+            if self._desired_lock is None:
+                return 'Deadlock Abort' if self._abort_mode == DEADLOCK \
+                    else 'User Abort'
+            timer = None
+            if self._wait_deadline is not None:
+                # Wake up when the wait times out, so check_lock() can abort
+                timer = self._loop.call_later(
+                    max(0, self._wait_deadline - time.time()),
+                    self._resolve_waiter)
+            try:
+                await self._waiter
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    async def perform_get(self, key):
+        result = TransactionHandler.perform_get(self, key)
+        if result is None:
+            result = await self._wait()
+        return result
+
+    async def perform_put(self, key, value):
+        result = TransactionHandler.perform_put(self, key, value)
+        if result is None:
+            result = await self._wait()
+        return result
+
+    async def perform_multi_get(self, keys):
+        result = TransactionHandler.perform_multi_get(self, keys)
+        if result is None:
+            result = await self._wait()
+        return result
+
+    async def perform_multi_put(self, items):
+        result = TransactionHandler.perform_multi_put(self, items)
+        if result is None:
+            result = await self._wait()
+        return result
+
+    async def commit(self):
+        # The log is flushed on a worker thread so that the event loop keeps
+        # running and concurrent commits share an fsync. Locks are released
+        # back on the event loop.
+        if self._wal is not None:
+            await self._loop.run_in_executor(None, self._log_commit)
+        self._apply_writes()
+        self.release_and_grant_locks()
+        self._end_snapshot()
+        return 'Transaction Completed'
+
+    async def prepare(self):
+        if self._read_only():
+            return await self.commit()
+        if self._wal is not None:
+            await self._loop.run_in_executor(None, self._log_prepare)
+        self._prepared = True
+        return 'Prepared'
+
+    def abort(self, mode):
+        self._abort_mode = mode
+        return TransactionHandler.abort(self, mode)
+
+"""
+The key-value store server. It owns the store, the lock table and a
+transaction coordinator that checks for deadlocks every
+DEADLOCK_CHECK_INTERVAL seconds while transactions are waiting, and aborts the
+victims, picking the transactions with the least work to lose. With a
+deadlock_interval of None there is no detector, which is only safe if the lock
+table has a deadlock prevention policy. If it is given a write-ahead log, the
+log is replayed into the store before the server starts and every commit is
+recorded in it. With write_buffered, transactions keep their writes to
+themselves until they commit, and with mvcc, reads come from snapshots of an
+MVCCStore and never wait; see TransactionHandler.
+
+A transaction that has been prepared for two-phase commit (see protocol.py)
+is not aborted when its connection goes away. It becomes in doubt, keeping
+its locks until a RESOLVE request settles it, and so does every transaction
+the write-ahead log replays as prepared when the server starts.
+
+BEGIN, PREPARE, WAITS_FOR, WAITS_FOR_DELTA, KILL, IN_DOUBT and RESOLVE are
+meant for a router (see partition.py), and are answered with 'Invalid
+command' unless the server is created with router_requests. A client that
+can send them can abort or settle anybody's transactions, so a server that
+accepts them trusts everybody who can reach its port; the workers of a
+PartitionedKVStoreServer listen on HOST only and expect to be reached by
+their router alone.
+"""
+class KVStoreServer(object):
+
+    def __init__(self, host=HOST, port=PORT, store=None, lock_table=None,
+                 wal=None, write_buffered=False, mvcc=False,
+                 deadlock_interval=DEADLOCK_CHECK_INTERVAL,
+                 router_requests=False):
+        self._host = host
+        self._port = port
+        if store is None:
+            store = MVCCStore() if mvcc else KVSTORE_CLASS()
+        self._store = store
+        self._wal = wal
+        self._write_buffered = write_buffered
+        self._mvcc = mvcc
+        if wal is not None:
+            wal.replay(self._store)
+        self._lock_table = lock_table if lock_table is not None else LockTable()
+        self._coordinator = TransactionCoordinator(self._lock_table,
+                                                   self._rollback_cost)
+        self._deadlock_interval = deadlock_interval
+        self._router_requests = router_requests
+        self._handlers = {}
+        self._in_doubt = {}
+        # The waits-for edges last sent to each connection that asked for
+        # WAITS_FOR_DELTA, by writer
+        self._exported = {}
+        self._xids = itertools.count()
+        self._server = None
+        self._detector = None
+
+    @property
+    def port(self):
+        """
+        The port the server is listening on, which is only known after start()
+        if it was created with port 0.
+        """
+        if self._server is not None:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    def run(self):
+        """
+        Runs the server until it is interrupted.
+        """
+        logging.basicConfig(level=LOG_LEVEL)
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve_forever(self):
+        await self.start()
+        logger.info('Listening on %s:%d', self._host, self.port)
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def start(self):
+        if self._wal is not None and self._wal.prepared:
+            for xid, (writes, undo) in sorted(self._wal.prepared.items()):
+                handler = self._begin(xid)
+                handler.restore(writes, undo)
+                self._in_doubt[xid] = handler
+            self._xids = itertools.count(max(self._in_doubt) + 1)
+        self._server = await asyncio.start_server(self._serve_client,
+                                                  self._host, self._port)
+        if self._deadlock_interval is not None:
+            self._detector = asyncio.ensure_future(self._detect_deadlocks())
+
+    async def stop(self):
+        if self._detector is not None:
+            self._detector.cancel()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _begin(self, xid=None):
+        if xid is None:
+            xid = next(self._xids)
+        handler = AsyncTransactionHandler(self._lock_table, xid, self._store,
+                                          self._wal, self._write_buffered,
+                                          self._mvcc)
+        self._handlers[handler.xid] = handler
+        return handler
+
+    def _end(self, handler):
+        self._handlers.pop(handler.xid, None)
+
+    def abort_transaction(self, xid):
+        """
+        Aborts transaction @xid as a deadlock victim, if it is still waiting
+        for a lock. One that is not is no longer part of a deadlock.
+        """
+        handler = self._handlers.get(xid)
+        if handler is not None and \
+                self._lock_table.waiting_on(xid) is not None:
+            logger.info('Aborting transaction %d to break a deadlock', xid)
+            handler.abort(DEADLOCK)
+
+    def waits_for_edges(self):
+        """
+        Returns the waits-for graph as a sorted list of (@waiter, @blocker)
+        pairs, one for each transaction holding or queued ahead for the lock a
+        waiting transaction wants.
+        """
+        edges = set()
+        for xid in list(self._handlers):
+            key = self._lock_table.waiting_on(xid)
+            if key is not None:
+                edges.update((xid, blocker)
+                             for blocker in self._lock_table.blockers(key, xid))
+        return sorted(edges)
+
+    def waits_for_delta(self, exported):
+        """
+        Returns how the waits-for graph changed since it was last exported.
+
+        @param exported: the set of edges last exported, which is updated to
+        the current ones.
+        @return: a tuple (@added, @removed) of sorted lists of (@waiter,
+        @blocker) pairs.
+        """
+        edges = set(self.waits_for_edges())
+        added = sorted(edges - exported)
+        removed = sorted(exported - edges)
+        exported.clear()
+        exported.update(edges)
+        return added, removed
+
+    def _rollback_cost(self, xid):
+        handler = self._handlers.get(xid)
+        if handler is None:
+            return (0, 0)
+        return handler.rollback_cost()
+
+    async def _serve_client(self, reader, writer):
+        handler = None
+        binary = False
+        try:
+            while True:
+                if binary:
+                    header = await reader.readexactly(protocol.HEADER_SIZE)
+                    try:
+                        length = protocol.frame_length(header)
+                    except ValueError:
+                        break
+                    payload = await reader.readexactly(length)
+                    request = protocol.decode_request(memoryview(payload))
+                else:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    if handler is None and line == protocol.HELLO:
+                        writer.write(protocol.HELLO_REPLY)
+                        binary = True
+                        continue
+                    request = _parse_text(line)
+                opcode = request[0] if request is not None else None
+                if opcode in _ROUTER_REQUESTS and not self._router_requests:
+                    request = opcode = None
+                if opcode in (BEGIN, WAITS_FOR, WAITS_FOR_DELTA, KILL,
+                              IN_DOUBT, RESOLVE):
+                    handler = await self._control(handler, request, writer)
+                    await writer.drain()
+                    continue
+                if handler is None:
+                    handler = self._begin()
+                status, value = await self._execute(handler, request)
+                if binary:
+                    writer.write(protocol.encode_response(
+                        status, handler.xid, opcode, _missing(value)))
+                else:
+                    writer.write(_format_text(opcode, status, value))
+                if status in (COMMITTED, USER_ABORT, DEADLOCK_ABORT):
+                    self._end(handler)
+                    handler = None
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # A client that goes away mid-transaction gives up its locks,
+            # unless it has prepared the transaction
+            if handler is not None and handler.prepared:
+                self._in_doubt[handler.xid] = handler
+            elif handler is not None:
+                handler.abort(USER)
+                self._end(handler)
+            self._exported.pop(writer, None)
+            writer.close()
+
+    async def _control(self, handler, request, writer):
+        # Runs the binary-only requests a router sends, which do not go
+        # through a transaction handler. Returns the connection's handler.
+        opcode, args = request
+        status, value = OK, None
+        if opcode == BEGIN:
+            if handler is None and args[0] not in self._handlers:
+                handler = self._begin(args[0])
+            else:
+                status = INVALID
+        elif opcode == WAITS_FOR:
+            value = self.waits_for_edges()
+        elif opcode == WAITS_FOR_DELTA:
+            value = self.waits_for_delta(self._exported.setdefault(writer,
+                                                                   set()))
+        elif opcode == KILL:
+            self.abort_transaction(args[0])
+        elif opcode == IN_DOUBT:
+            value = sorted(self._in_doubt)
+        else:
+            await self._resolve(*args)
+        xid = handler.xid if handler is not None else 0
+        writer.write(protocol.encode_response(status, xid, opcode, value))
+        return handler
+
+    async def _resolve(self, xid, commit):
+        handler = self._in_doubt.pop(xid, None)
+        if handler is None:
+            return
+        if commit:
+            await handler.commit()
+        else:
+            handler.abort(USER)
+        self._end(handler)
+
+    async def _execute(self, handler, request):
+        """
+        Runs a single request, an (@opcode, @args) tuple as returned by
+        protocol.decode_request(), or None if it was malformed.
+
+        @return: a tuple (@status, @value), where @value is the result of an
+        OK GET or MGET.
+        """
+        if request is None:
+            return INVALID, None
+        opcode, args = request
+        if handler.prepared and opcode not in (COMMIT, ABORT):
+            return INVALID, None
+        if opcode == GET:
+            result = await handler.perform_get(*args)
+        elif opcode == PUT:
+            result = await handler.perform_put(*args)
+        elif opcode == MGET:
+            result = await handler.perform_multi_get(*args)
+        elif opcode == MPUT:
+            result = await handler.perform_multi_put(*args)
+        elif opcode == COMMIT:
+            result = await handler.commit()
+        elif opcode == PREPARE:
+            result = await handler.prepare()
+        else:
+            handler.abort(USER)
+            return USER_ABORT, None
+        if result == 'Deadlock Abort':
+            return DEADLOCK_ABORT, None
+        if result == 'User Abort':
+            return USER_ABORT, None
+        if opcode in (COMMIT, PREPARE):
+            return (PREPARED if result == 'Prepared' else COMMITTED), None
+        return OK, result
+
+    async def _detect_deadlocks(self):
+        while True:
+            await asyncio.sleep(self._deadlock_interval)
+            for xid in self._coordinator.find_deadlocks():
+                self.abort_transaction(xid)
+
+_ROUTER_REQUESTS = frozenset([BEGIN, PREPARE, WAITS_FOR, WAITS_FOR_DELTA, KILL,
+                              IN_DOUBT, RESOLVE])
+
+def _parse_text(line):
+    """
+    Parses a text request into the (@opcode, @args) form of
+    protocol.decode_request(), or None if it is malformed.
+    """
+    try:
+        text = line.decode('utf-8').rstrip('\r\n')
+    except UnicodeDecodeError:
+        return None
+    request = text.split(' ', 2)
+    command = request[0].upper()
+    if command == 'GET' and len(request) == 2 and request[1]:
+        return GET, (request[1],)
+    elif command == 'PUT' and len(request) == 3 and request[1]:
+        return PUT, (request[1], request[2])
+    elif command == 'MGET' and len(request) > 1:
+        keys = text.split(' ')[1:]
+        if all(keys):
+            return MGET, (keys,)
+    elif command == 'MPUT' and len(request) > 1:
+        items = _parse_items(text.split(' ', 1)[1])
+        if items is not None:
+            return MPUT, (items,)
+    elif command == 'COMMIT' and len(request) == 1:
+        return COMMIT, ()
+    elif command == 'ABORT' and len(request) == 1:
+        return ABORT, ()
+    return None
+
+def _parse_items(payload):
+    # A JSON object mapping non-empty keys without spaces to string values
+    try:
+        items = json.loads(payload)
+    except ValueError:
+        return None
+    if not isinstance(items, dict) or not items:
+        return None
+    for key, value in items.items():
+        if not key or ' ' in key or not isinstance(value, str):
+            return None
+    return items
+
+def _format_text(opcode, status, value):
+    if status != OK:
+        response = protocol.MESSAGES[status]
+    elif opcode == MGET:
+        response = json.dumps(value)
+    else:
+        response = value
+    return response.encode('utf-8') + b'\n'
+
+def _missing(value):
+    # The binary protocol has a proper marker for missing keys
+    if isinstance(value, list):
+        return [None if item == 'No such key' else item for item in value]
+    return None if value == 'No such key' else value
@@ -0,0 +1,384 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import struct
+import unittest
+
+import protocol
+from kvstore import InMemoryKVStore
+from locktable import LockTable
+from prevention import LockWaitTimeout
+from server import AsyncTransactionHandler, KVStoreServer
+from student import DEADLOCK
+from wal import WriteAheadLog
+
+class ServerFixture(object):
+    """
+    A mixin for test cases that run a scenario, a coroutine function taking
+    the server, against a server of @server_class started on a free port.
+    The server is created with the options from server_options(), updated
+    with the ones given to run_server().
+    """
+    server_class = KVStoreServer
+    timeout = 10
+
+    def server_options(self):
+        return {'store': InMemoryKVStore(), 'deadlock_interval': 0.01}
+
+    def run_server(self, scenario, **options):
+        settings = self.server_options()
+        settings.update(options)
+
+        async def main():
+            server = self.server_class(port=0, **settings)
+            await server.start()
+            try:
+                await scenario(server)
+            finally:
+                await server.stop()
+        asyncio.run(asyncio.wait_for(main(), self.timeout))
+
+class AsyncHandlerTest(unittest.TestCase):
+    def run_async(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+    def test_wait_for_grant(self):
+        async def scenario():
+            lock_table = LockTable()
+            store = InMemoryKVStore()
+            t0 = AsyncTransactionHandler(lock_table, 0, store)
+            t1 = AsyncTransactionHandler(lock_table, 1, store)
+            self.assertEqual(await t0.perform_put('a', '0'), 'Success')
+            read = asyncio.ensure_future(t1.perform_get('a'))
+            await asyncio.sleep(0)
+            self.assertFalse(read.done())
+            self.assertEqual(await t0.commit(), 'Transaction Completed')
+            self.assertEqual(await read, '0')
+        self.run_async(scenario())
+
+    def test_abort_while_waiting(self):
+        async def scenario():
+            lock_table = LockTable()
+            store = InMemoryKVStore()
+            t0 = AsyncTransactionHandler(lock_table, 0, store)
+            t1 = AsyncTransactionHandler(lock_table, 1, store)
+            self.assertEqual(await t0.perform_get('a'), 'No such key')
+            write = asyncio.ensure_future(t1.perform_put('a', '1'))
+            await asyncio.sleep(0)
+            self.assertEqual(t1.abort(DEADLOCK), 'Deadlock Abort')
+            self.assertEqual(await write, 'Deadlock Abort')
+            self.assertEqual(await t0.perform_put('a', '0'), 'Success')
+        self.run_async(scenario())
+
+    def test_lock_wait_timeout(self):
+        async def scenario():
+            lock_table = LockTable(prevention=LockWaitTimeout(0.05))
+            store = InMemoryKVStore()
+            t0 = AsyncTransactionHandler(lock_table, 0, store)
+            t1 = AsyncTransactionHandler(lock_table, 1, store)
+            self.assertEqual(await t0.perform_put('a', '0'), 'Success')
+            # Nobody releases the lock, the timeout wakes t1 up
+            self.assertEqual(await t1.perform_get('a'), 'Deadlock Abort')
+            self.assertEqual(await t0.commit(), 'Transaction Completed')
+            self.assertEqual(lock_table, {})
+        self.run_async(scenario())
+
+class ServerTest(ServerFixture, unittest.TestCase):
+    async def connect(self, server):
+        reader, writer = await asyncio.open_connection('localhost',
+                                                       server.port)
+
+        async def request(line):
+            writer.write(line.encode('utf-8') + b'\n')
+            return (await reader.readline()).decode('utf-8').rstrip('\n')
+        return request, writer
+
+    def test_commit(self):
+        async def scenario(server):
+            request, writer = await self.connect(server)
+            self.assertEqual(await request('GET a'), 'No such key')
+            self.assertEqual(await request('PUT a hello world'), 'Success')
+            self.assertEqual(await request('GET a'), 'hello world')
+            self.assertEqual(await request('COMMIT'), 'Transaction Completed')
+            self.assertEqual(await request('FROB'), 'Invalid command')
+            self.assertEqual(await request('ABORT'), 'User Abort')
+            writer.close()
+        self.run_server(scenario)
+
+    def test_multi_requests(self):
+        async def scenario(server):
+            request, writer = await self.connect(server)
+            self.assertEqual(await request('MPUT {"a": "0", "b": "1 2"}'),
+                             'Success')
+            self.assertEqual(await request('MGET a b c'),
+                             '["0", "1 2", "No such key"]')
+            self.assertEqual(await request('MPUT ["a"]'), 'Invalid command')
+            self.assertEqual(await request('MGET'), 'Invalid command')
+            self.assertEqual(await request('COMMIT'), 'Transaction Completed')
+            writer.close()
+        self.run_server(scenario)
+
+    def test_binary_protocol(self):
+        async def scenario(server):
+            reader, writer = await asyncio.open_connection('localhost',
+                                                           server.port)
+            writer.write(protocol.HELLO)
+            self.assertEqual(await reader.readline(), protocol.HELLO_REPLY)
+
+            async def request(opcode, *args):
+                writer.write(protocol.encode_request(opcode, args))
+                header = await reader.readexactly(protocol.HEADER_SIZE)
+                payload = await reader.readexactly(
+                    protocol.frame_length(header))
+                return protocol.decode_response(memoryview(payload), opcode)
+            self.assertEqual(await request(protocol.PUT, 'a b', 'c\nd'),
+                             (protocol.OK, 0, None))
+            self.assertEqual(await request(protocol.MGET, ['a b', 'e']),
+                             (protocol.OK, 0, ['c\nd', None]))
+            self.assertEqual(await request(protocol.COMMIT),
+                             (protocol.COMMITTED, 0, None))
+            self.assertEqual(await request(protocol.GET, 'a b'),
+                             (protocol.OK, 1, 'c\nd'))
+            # A malformed frame is rejected without ending the transaction
+            writer.write(struct.pack('>IBI', 5, protocol.GET, 10))
+            header = await reader.readexactly(protocol.HEADER_SIZE)
+            payload = await reader.readexactly(protocol.frame_length(header))
+            self.assertEqual(protocol.decode_response(memoryview(payload),
+                                                      protocol.GET),
+                             (protocol.INVALID, 1, None))
+            self.assertEqual(await request(protocol.ABORT),
+                             (protocol.USER_ABORT, 1, None))
+            # An oversized frame closes the connection
+            writer.write(struct.pack('>I', protocol.MAX_FRAME + 1))
+            self.assertEqual(await reader.read(), b'')
+            writer.close()
+        self.run_server(scenario)
+
+    def test_router_requests(self):
+        async def scenario(server):
+            async def connect():
+                reader, writer = await asyncio.open_connection('localhost',
+                                                               server.port)
+                writer.write(protocol.HELLO)
+                await reader.readline()
+
+                def send(opcode, *args):
+                    writer.write(protocol.encode_request(opcode, args))
+
+                async def receive(opcode):
+                    header = await reader.readexactly(protocol.HEADER_SIZE)
+                    payload = await reader.readexactly(
+                        protocol.frame_length(header))
+                    return protocol.decode_response(memoryview(payload),
+                                                    opcode)
+                return send, receive, writer
+            send0, receive0, writer0 = await connect()
+            send1, receive1, writer1 = await connect()
+            send0(protocol.BEGIN, 42)
+            self.assertEqual(await receive0(protocol.BEGIN),
+                             (protocol.OK, 42, None))
+            send0(protocol.BEGIN, 43)
+            self.assertEqual((await receive0(protocol.BEGIN))[0],
+                             protocol.INVALID)
+            send0(protocol.PUT, 'a', '0')
+            self.assertEqual(await receive0(protocol.PUT),
+                             (protocol.OK, 42, None))
+            send1(protocol.BEGIN, 7)
+            await receive1(protocol.BEGIN)
+            # Not waiting, so not a deadlock victim
+            send1(protocol.KILL, 42)
+            await receive1(protocol.KILL)
+            send1(protocol.GET, 'a')
+            await asyncio.sleep(0.05)
+            self.assertEqual(server.waits_for_edges(), [(7, 42)])
+            send0(protocol.WAITS_FOR)
+            self.assertEqual(await receive0(protocol.WAITS_FOR),
+                             (protocol.OK, 42, [(7, 42)]))
+            send0(protocol.WAITS_FOR_DELTA)
+            self.assertEqual(await receive0(protocol.WAITS_FOR_DELTA),
+                             (protocol.OK, 42, ([(7, 42)], [])))
+            send0(protocol.WAITS_FOR_DELTA)
+            self.assertEqual(await receive0(protocol.WAITS_FOR_DELTA),
+                             (protocol.OK, 42, ([], [])))
+            send0(protocol.KILL, 7)
+            await receive0(protocol.KILL)
+            self.assertEqual(await receive1(protocol.GET),
+                             (protocol.DEADLOCK_ABORT, 7, None))
+            send0(protocol.WAITS_FOR_DELTA)
+            self.assertEqual(await receive0(protocol.WAITS_FOR_DELTA),
+                             (protocol.OK, 42, ([], [(7, 42)])))
+            send0(protocol.COMMIT)
+            self.assertEqual(await receive0(protocol.COMMIT),
+                             (protocol.COMMITTED, 42, None))
+            writer0.close()
+            writer1.close()
+        self.run_server(scenario, router_requests=True)
+
+    def test_router_requests_need_flag(self):
+        async def scenario(server):
+            reader, writer = await asyncio.open_connection('localhost',
+                                                           server.port)
+            writer.write(protocol.HELLO)
+            await reader.readline()
+
+            async def request(opcode, *args):
+                writer.write(protocol.encode_request(opcode, args))
+                header = await reader.readexactly(protocol.HEADER_SIZE)
+                payload = await reader.readexactly(
+                    protocol.frame_length(header))
+                return protocol.decode_response(memoryview(payload), opcode)
+            for opcode, args in ((protocol.BEGIN, (42,)),
+                                 (protocol.KILL, (0,)),
+                                 (protocol.RESOLVE, (0, True)),
+                                 (protocol.PREPARE, ())):
+                self.assertEqual((await request(opcode, *args))[0],
+                                 protocol.INVALID)
+            writer.close()
+        self.run_server(scenario)
+
+    def test_in_doubt(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'wal')
+
+        async def connect(server):
+            reader, writer = await asyncio.open_connection('localhost',
+                                                           server.port)
+            writer.write(protocol.HELLO)
+            await reader.readline()
+
+            async def request(opcode, *args):
+                writer.write(protocol.encode_request(opcode, args))
+                header = await reader.readexactly(protocol.HEADER_SIZE)
+                payload = await reader.readexactly(
+                    protocol.frame_length(header))
+                return protocol.decode_response(memoryview(payload), opcode)
+            return request, writer
+
+        async def prepare():
+            wal = WriteAheadLog(path)
+            server = KVStoreServer(port=0, store=InMemoryKVStore(), wal=wal,
+                                   router_requests=True)
+            await server.start()
+            try:
+                request0, writer0 = await connect(server)
+                await request0(protocol.BEGIN, 5)
+                await request0(protocol.PUT, 'a', '0')
+                self.assertEqual(await request0(protocol.PREPARE),
+                                 (protocol.PREPARED, 5, None))
+                self.assertEqual((await request0(protocol.GET, 'a'))[0],
+                                 protocol.INVALID)
+                # The prepared transaction outlives its connection
+                writer0.close()
+                request1, writer1 = await self.connect(server)
+                read = asyncio.ensure_future(request1('GET a'))
+                await asyncio.sleep(0.05)
+                self.assertFalse(read.done())
+                request2, writer2 = await connect(server)
+                self.assertEqual(await request2(protocol.IN_DOUBT),
+                                 (protocol.OK, 0, [5]))
+                await request2(protocol.RESOLVE, 5, False)
+                self.assertEqual(await read, 'No such key')
+                self.assertEqual(await request1('PUT b 1'), 'Success')
+                self.assertEqual(await request1('COMMIT'),
+                                 'Transaction Completed')
+                request3, writer3 = await connect(server)
+                await request3(protocol.BEGIN, 6)
+                await request3(protocol.PUT, 'b', '2')
+                await request3(protocol.PREPARE)
+                writer1.close()
+                writer2.close()
+                writer3.close()
+            finally:
+                await server.stop()
+                wal.close()
+
+        async def recover():
+            wal = WriteAheadLog(path)
+            server = KVStoreServer(port=0, store=InMemoryKVStore(), wal=wal,
+                                   router_requests=True)
+            await server.start()
+            try:
+                request, writer = await connect(server)
+                self.assertEqual(await request(protocol.IN_DOUBT),
+                                 (protocol.OK, 0, [6]))
+                await request(protocol.RESOLVE, 6, True)
+                self.assertEqual(await request(protocol.MGET, ['a', 'b']),
+                                 (protocol.OK, 7, [None, '2']))
+                writer.close()
+            finally:
+                await server.stop()
+                wal.close()
+        asyncio.run(asyncio.wait_for(prepare(), 10))
+        asyncio.run(asyncio.wait_for(recover(), 10))
+
+    def test_blocked_request(self):
+        async def scenario(server):
+            request0, writer0 = await self.connect(server)
+            request1, writer1 = await self.connect(server)
+            self.assertEqual(await request0('PUT a 0'), 'Success')
+            read = asyncio.ensure_future(request1('GET a'))
+            await asyncio.sleep(0.05)
+            self.assertFalse(read.done())
+            self.assertEqual(await request0('COMMIT'),
+                             'Transaction Completed')
+            self.assertEqual(await read, '0')
+            writer0.close()
+            writer1.close()
+        self.run_server(scenario)
+
+    def test_disconnect_releases_locks(self):
+        async def scenario(server):
+            request0, writer0 = await self.connect(server)
+            request1, writer1 = await self.connect(server)
+            self.assertEqual(await request0('PUT a 0'), 'Success')
+            write = asyncio.ensure_future(request1('PUT a 1'))
+            await asyncio.sleep(0.05)
+            writer0.close()
+            self.assertEqual(await write, 'Success')
+            self.assertEqual(await request1('GET a'), '1')
+            writer1.close()
+        self.run_server(scenario)
+
+    def test_deadlock(self):
+        async def scenario(server):
+            request1, writer1 = await self.connect(server)
+            request2, writer2 = await self.connect(server)
+            self.assertEqual(await request1('GET a'), 'No such key')
+            self.assertEqual(await request2('GET b'), 'No such key')
+            write1 = asyncio.ensure_future(request1('PUT b 1'))
+            write2 = asyncio.ensure_future(request2('PUT a 2'))
+            # The younger transaction is aborted
+            self.assertEqual(await write2, 'Deadlock Abort')
+            self.assertEqual(await write1, 'Success')
+            writer1.close()
+            writer2.close()
+        self.run_server(scenario)
+
+    def test_write_ahead_log(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'wal')
+
+        async def main():
+            server = KVStoreServer(port=0, store=InMemoryKVStore(),
+                                   wal=WriteAheadLog(path))
+            await server.start()
+            try:
+                request, writer = await self.connect(server)
+                self.assertEqual(await request('PUT a 0'), 'Success')
+                self.assertEqual(await request('COMMIT'),
+                                 'Transaction Completed')
+                self.assertEqual(await request('PUT b 1'), 'Success')
+                writer.close()
+            finally:
+                await server.stop()
+        asyncio.run(asyncio.wait_for(main(), 10))
+
+        store = InMemoryKVStore()
+        KVStoreServer(port=0, store=store, wal=WriteAheadLog(path))
+        self.assertEqual(store.get_many(['a', 'b']), ['0', None])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,11 @@
 import logging
+import threading
+import time
 
-from kvstore import DBMStore, InMemoryKVStore
+from kvstore import CachedStore, DBMStore, InMemoryKVStore, LogStore
+from locktable import (COMBINED, EXCLUSIVE, INTENTION_EXCLUSIVE,
+                       INTENTION_SHARED, SHARED, covers, deadlock_victims,
+                       lock_table_of, partition_resource)
 
 LOG_LEVEL = logging.WARNING
 
@@ -17,11 +22,14 @@ Part I: Implementing request handling methods for the transaction handler
 
 The transaction handler has access to the following objects:
 
-self._lock_table: the global lock table. More information in the README.
+self._lock_table: the global lock table, a LockTable mapping each key to a
+LockEntry, or a ShardedLockTable if transactions run on several threads. A
+plain dict passed in its place is used through a LockTable view of it. More
+information in locktable.py.
 
-self._acquired_locks: a list of locks acquired by the transaction. Used to
-release locks when the transaction commits or aborts. This list is initially
-empty.
+self._acquired_locks: a dict mapping each key the transaction holds a lock on
+to the mode it holds it in. Used to release locks when the transaction commits
+or aborts. An upgrade simply replaces the mode. This dict is initially empty.
 
 self._desired_lock: the lock that the transaction is waiting to acquire as well
 as the operation to perform. This is initialized to None.
@@ -32,22 +40,121 @@ unique transaction ID.
 self._store: the in-memory key-value store. You may refer to kvstore.py for
 methods supported by the store.
 
-self._undo_log: a list of undo operations to be performed when the transaction
-is aborted. The undo operation is a tuple of the form (@key, @value). This list
-is initially empty.
+self._wal: the write-ahead log that commits are recorded in before they are
+acknowledged, or None. See wal.py.
+
+self._write_buffer: in write-buffered mode, a dict of the values the
+transaction has put, which are only written to the store when it commits.
+Reads by the transaction itself see them first. Nothing is written to
+self._undo_log, and an abort simply drops the buffer. None if the transaction
+writes to the store in place.
+
+self._snapshot: in MVCC mode, the snapshot of the MVCCStore the transaction
+reads from, or None. See below.
+
+In MVCC mode, the store must be an MVCCStore. Reads see the store as of the
+moment the transaction started, plus the transaction's own writes, and take no
+locks at all, so they never wait for writers and writers never wait for them.
+Writes still take exclusive locks, so writers wait for each other, and are
+buffered as in write-buffered mode. At commit they become new versions in the
+store. The first committer wins: once a transaction has the exclusive lock on
+a key, it aborts with 'Deadlock Abort' if another transaction committed a
+version of the key after its snapshot was taken, so read-modify-write cycles
+never lose updates. The lock is held until commit, so nobody can commit the
+key after the check.
+
+self._undo_log: the undo operations to be performed when the transaction is
+aborted, as a dict mapping each key the transaction has written to its value
+before the first of those writes, or None if it did not exist. Later writes to
+the same key leave it alone. This dict is initially empty.
+
+self._granted: a threading.Event that is set when the lock in
+self._desired_lock is granted, so that a server handler can block on it
+instead of polling check_lock(). It is cleared whenever a new request is
+made, so that a wake-up meant for an earlier one does not end the wait.
+
+self._grant_callback: called with the transaction handler when the lock in
+self._desired_lock is granted, or None. See set_grant_callback().
+
+self._pending_batch: a multi-key operation that is waiting for one of its
+locks, as a tuple (@locks, @index, @finish), or None. @locks is the list of
+locks to acquire in order, as (@key, @mode, @partition) tuples, @index is the
+position of the lock being waited for and @finish performs the operation once
+all of them are locked. @partition is the partition of a key lock under
+hierarchical locking, and None otherwise.
+
+If the lock table has a partition function (see LockTable), locking is
+hierarchical. Every operation, single-key ones included, goes through the same
+path as multi-key operations: before locking a key in "S" or "X" mode, the
+transaction locks the key's partition in "IS" or "IX" mode. Once it holds more
+than the lock table's escalation threshold of key locks in one partition, it
+asks for an "S" lock on the partition, or "X" if it has written to it, and if
+that can be granted right away it releases the key locks, which the partition
+lock now covers. Otherwise it keeps the key locks and tries again with the
+next one.
+
+self._row_locks: under hierarchical locking, a dict mapping each partition to
+the set of keys the transaction holds locks on in it.
+
+self._escalated: the set of partitions the transaction has escalated to a
+partition lock.
+
+If the lock table has a deadlock prevention policy (see prevention.py), the
+transaction registers with it, and consults it every time one of its requests
+is queued. If the policy does not let it wait, it aborts itself and the
+request returns 'Deadlock Abort'.
+
+self._wounded: True once an older transaction has wounded this one under the
+wound-wait policy. It aborts the next time it has to wait, or the next time
+check_lock() finds its lock still not granted.
+
+self._wait_deadline: under a lock-wait timeout policy, the time at which the
+request in self._desired_lock times out, or None. check_lock() aborts the
+transaction once it has passed.
+
+self._wait_started: if the lock table has a metrics hook, the time at which the
+request in self._desired_lock was queued, or None.
+
+self._prepared: True once the transaction has been prepared for two-phase
+commit, see prepare(). From then on it must not abort unless it is told to.
+
+self._started: False once the transaction has released its locks. The
+handler's next request then starts a new transaction, which registers with
+the deadlock prevention policy again and has not been wounded.
 
 You may assume that the key/value inputs to these methods are already type-
 checked and are valid.
 """
-class TransactionHandler:
-
-    def __init__(self, lock_table, xid, store):
-        self._lock_table = lock_table
-        self._acquired_locks = []
+class TransactionHandler(object):
+
+    __slots__ = ('_lock_table', '_acquired_locks', '_desired_lock', '_xid',
+                 '_store', '_undo_log', '_wal', '_write_buffer', '_snapshot',
+                 '_granted', '_grant_callback', '_pending_batch', '_row_locks',
+                 '_escalated', '_wounded', '_wait_deadline', '_wait_started',
+                 '_prepared', '_started')
+
+    def __init__(self, lock_table, xid, store, wal=None,
+                 write_buffered=False, mvcc=False):
+        self._lock_table = lock_table_of(lock_table)
+        self._acquired_locks = {}
         self._desired_lock = None
         self._xid = xid
         self._store = store
-        self._undo_log = []
+        self._undo_log = {}
+        self._wal = wal
+        self._write_buffer = {} if write_buffered or mvcc else None
+        self._snapshot = store.begin() if mvcc else None
+        self._granted = threading.Event()
+        self._grant_callback = None
+        self._pending_batch = None
+        self._row_locks = {}
+        self._escalated = set()
+        self._wounded = False
+        self._wait_deadline = None
+        self._wait_started = None
+        self._prepared = False
+        self._started = False
+        self._start()
 
     def perform_put(self, key, value):
         """
@@ -69,44 +176,26 @@ class TransactionHandler:
         @return: if the transaction successfully acquires the lock and performs
         the insertion/update, returns 'Success'. If the transaction cannot
         acquire the lock, returns None, and saves the lock that the transaction
-        is waiting to acquire in self._desired_lock.
-
-        lock_table = {key, ([(id, X) (id, S)], [])}
-        """
-        # Part 1.1: your code here!
-        if self._lock_table.has_key(key):
-            upgrade = False
-            only_this_x = True
-            for lock in self._lock_table[key][0]:
-                if lock[0] == self._xid:
-                    upgrade = True
-                else:
-                    only_this_x = False 
-            # It's an upgrade or I already have this lock!
-            if upgrade and only_this_x:
-                self._lock_table[key][0] = [(self._xid, "X")]
-                self._undo_log.append((key, self._store.get(key)))
-                if (key, "S") in self._acquired_locks:
-                    self._acquired_locks.remove((key, "S"))
-                    self._acquired_locks.append((key, "X"))
-                self._store.put(key, value)
-                return 'Success'
-            # Something else has this key, but so do we and we want to upgrade
-            elif upgrade:
-                self._lock_table[key][1].insert(0, (self._xid, "X"))
-                self._desired_lock = (key, "X", value)
-                return
-            # I need to get in the back of the line
-            else:
-                self._lock_table[key][1].append((self._xid, "X"))
-                self._desired_lock = (key, "X", value)
-                return
-        else:
-            self._lock_table[key] = [[(self._xid, "X")], []] 
-            self._undo_log.append((key, self._store.get(key)))
-            self._acquired_locks.append((key, "X"))
-            self._store.put(key, value)
-            return 'Success'
+        is waiting to acquire in self._desired_lock. If the deadlock prevention
+        policy does not let the transaction wait, aborts it and returns
+        'Deadlock Abort'.
+        """
+        self._start()
+        if self._lock_table.partition_of is not None:
+            return self._start_batch([key], EXCLUSIVE,
+                                     lambda: self._write_many([(key, value)]))
+        held = self._lock_table.held(key, self._xid)
+        if held != EXCLUSIVE:
+            # Upgrades jump to the front of the queue, everybody else gets in
+            # the back of the line
+            self._granted.clear()
+            self._desired_lock = (key, EXCLUSIVE, value)
+            if not self._lock_table.acquire(key, self._xid, EXCLUSIVE,
+                                            self._notify_granted):
+                return self._blocked(key)
+            self._desired_lock = None
+            self._acquired_locks[key] = EXCLUSIVE
+        return self._write(key, value)
 
     def perform_get(self, key):
         """
@@ -124,53 +213,239 @@ class TransactionHandler:
         the value, returns the value. If the key does not exist, returns 'No
         such key'. If the transaction cannot acquire the lock, returns None,
         and saves the lock that the transaction is waiting to acquire in
-        self._desired_lock.
-        """
-        # Part 1.1: your code here!
-        if self._lock_table.has_key(key):
-            only_shared = True
-            only_this_x = True
-            for lock in self._lock_table[key][0]:
-                if lock[0] != self._xid:
-                    only_this_x = False
-                if lock[1] != "S":
-                    only_shared = False
-            if only_this_x:
-                #Special case when I hold the X lock:
-                value = self._store.get(key)
-                if value is None:
-                    return 'No such key'
-                else:
-                    return value
-            # Others are sharing
-            elif only_shared:
-                # No one else is waiting
-                if len(self._lock_table[key][1]) == 0:
-                    self._lock_table[key][0].append((self._xid, "S"))
-                    self._acquired_locks.append((key, "S"))
-                    value = self._store.get(key)
-                    if value is None:
-                        return 'No such key'
-                    else:
-                        return value
-                #Someone else is waiting -> Go to the back of the line
-                else:
-                    self._lock_table[key][1].append((self._xid, "S"))
-                    self._desired_lock = (key, "S")
-                    return
-            # I need to get in the back of the line
-            else:
-                self._lock_table[key][1].append((self._xid, "S"))
-                self._desired_lock = (key, "S")
-                return
+        self._desired_lock. If the deadlock prevention policy does not let the
+        transaction wait, aborts it and returns 'Deadlock Abort'.
+        """
+        self._start()
+        if self._snapshot is not None:
+            return self._read(key)
+        if self._lock_table.partition_of is not None:
+            return self._start_batch([key], SHARED, lambda: self._read(key))
+        if self._lock_table.held(key, self._xid) is None:
+            # Readers queue behind any waiting writer so it does not starve
+            self._granted.clear()
+            self._desired_lock = (key, SHARED)
+            if not self._lock_table.acquire(key, self._xid, SHARED,
+                                            self._notify_granted):
+                return self._blocked(key)
+            self._desired_lock = None
+            self._acquired_locks[key] = SHARED
+        return self._read(key)
+
+    def perform_multi_get(self, keys):
+        """
+        Handles a GET request for several keys at once. The shared locks on all
+        the keys are acquired in one pass, in sorted key order, and the values
+        are then read from the store in one bulk read. Within one call the
+        locks are taken in the same order by every transaction, so two calls
+        cannot deadlock on each other if neither transaction holds locks from
+        an earlier request. A transaction that makes several multi-key calls,
+        or mixes them with single-key requests, can still deadlock.
+
+        @param self: the transaction handler.
+        @param keys: the keys to look up from the store.
+
+        @return: if the transaction acquires all the locks, returns a list with
+        the value of each key in @keys, or 'No such key' for keys that do not
+        exist. If it has to wait for a lock, returns None and saves that lock
+        in self._desired_lock; check_lock() returns the list once all the locks
+        have been acquired.
+        """
+        self._start()
+        keys = list(keys)
+        if self._snapshot is not None:
+            return self._read_many(keys)
+        return self._start_batch(keys, SHARED, lambda: self._read_many(keys))
+
+    def perform_multi_put(self, items):
+        """
+        Handles a PUT request for several key-value pairs at once. The
+        exclusive locks on all the keys are acquired in one pass, in sorted key
+        order, and the pairs are then written to the store in one bulk write.
+        See perform_multi_get() for when this can deadlock; lock upgrades
+        can deadlock too.
+
+        @param self: the transaction handler.
+        @param items: a dict or a list of (@key, @value) pairs to be inserted
+        into the store. If a key appears more than once, the last value wins.
+
+        @return: if the transaction acquires all the locks, returns 'Success'.
+        If it has to wait for a lock, returns None and saves that lock in
+        self._desired_lock; check_lock() returns 'Success' once all the locks
+        have been acquired and the pairs have been written.
+        """
+        self._start()
+        if isinstance(items, dict):
+            items = items.items()
+        items = list(items)
+        return self._start_batch([key for key, value in items], EXCLUSIVE,
+                                 lambda: self._write_many(items))
+
+    def _start_batch(self, keys, mode, finish):
+        self._pending_batch = (self._lock_plan(keys, mode), 0, finish)
+        return self._continue_batch()
+
+    def _lock_plan(self, keys, mode):
+        """
+        Returns the locks needed to access @keys in @mode, as a list of
+        (@key, @mode, @partition) tuples in the order they must be acquired:
+        sorted by key, or under hierarchical locking sorted by partition, with
+        each partition's intention lock ahead of the sorted keys in it.
+        Partitions the transaction has escalated need no key locks.
+        """
+        partition_of = self._lock_table.partition_of
+        if partition_of is None:
+            return [(key, mode, None) for key in sorted(set(keys))]
+        partitions = {}
+        for key in set(keys):
+            partitions.setdefault(partition_of(key), []).append(key)
+        intention = INTENTION_SHARED if mode == SHARED else INTENTION_EXCLUSIVE
+        plan = []
+        for partition in sorted(partitions):
+            resource = partition_resource(partition)
+            if partition in self._escalated:
+                # An "S" partition lock has to be upgraded for writes
+                plan.append((resource, mode, None))
+                continue
+            plan.append((resource, intention, None))
+            plan.extend((key, mode, partition)
+                        for key in sorted(partitions[partition]))
+        return plan
+
+    def _continue_batch(self):
+        locks, start, finish = self._pending_batch
+        for index in range(start, len(locks)):
+            key, mode, partition = locks[index]
+            if partition in self._escalated:
+                # Escalated while this batch was running
+                continue
+            held = self._lock_table.held(key, self._xid)
+            if covers(held, mode):
+                continue
+            self._granted.clear()
+            self._desired_lock = (key, mode)
+            if not self._lock_table.acquire(key, self._xid, mode,
+                                            self._notify_granted):
+                self._pending_batch = (locks, index, finish)
+                return self._blocked(key)
+            self._desired_lock = None
+            self._add_acquired_lock(key, mode if held is None
+                                    else COMBINED[held, mode], partition)
+        self._pending_batch = None
+        return finish()
+
+    def _blocked(self, key):
+        # Called right after a request has been queued on @key
+        if self._lock_table.metrics is not None:
+            self._wait_started = time.time()
+        policy = self._lock_table.prevention
+        if policy is None:
+            return
+        if self._wounded or not policy.on_block(
+                self, self._lock_table.blockers(key, self._xid)):
+            return self.abort(DEADLOCK)
+        if policy.timeout is not None:
+            self._wait_deadline = time.time() + policy.timeout
+
+    def wound(self):
+        """
+        Makes the transaction abort because an older transaction needs its
+        locks, or because a deadlock detector running on another thread
+        picked it as a victim. Called by the wound-wait policy on the older
+        transaction's thread, so it leaves the handler's state alone: it
+        only marks the transaction and wakes it up in case it is waiting for
+        a lock. The transaction then aborts itself in check_lock(), or the
+        next time it has to wait.
+
+        @param self: the transaction handler.
+        """
+        self._wounded = True
+        self._notify_granted()
+
+    def rollback_cost(self):
+        """
+        Returns how much work is lost if the transaction is aborted, for the
+        deadlock detector to compare transactions by: a tuple of the number of
+        writes that would have to be undone or redone, and the number of locks
+        held.
+
+        @param self: the transaction handler.
+        """
+        writes = len(self._undo_log)
+        if self._write_buffer:
+            writes += len(self._write_buffer)
+        return (writes, len(self._acquired_locks))
+
+    def _add_acquired_lock(self, key, mode, partition=None):
+        self._acquired_locks[key] = mode
+        if partition is not None:
+            rows = self._row_locks.get(partition)
+            if rows is None:
+                rows = self._row_locks[partition] = set()
+            rows.add(key)
+            threshold = self._lock_table.escalation_threshold
+            if threshold is not None and len(rows) > threshold:
+                self._escalate(partition)
+
+    def _escalate(self, partition):
+        resource = partition_resource(partition)
+        held = self._lock_table.held(resource, self._xid)
+        mode = EXCLUSIVE if held == INTENTION_EXCLUSIVE else SHARED
+        if not self._lock_table.try_acquire(resource, self._xid, mode):
+            return
+        self._escalated.add(partition)
+        self._acquired_locks[resource] = COMBINED[held, mode]
+        for key in self._row_locks.pop(partition):
+            del self._acquired_locks[key]
+            self._release(key)
+
+    def _read(self, key):
+        if self._write_buffer and key in self._write_buffer:
+            return self._write_buffer[key]
+        if self._snapshot is not None:
+            value = self._store.get_at(key, self._snapshot)
         else:
-            self._lock_table[key] = [[(self._xid, "S")], []]
-            self._acquired_locks.append((key, "S"))
             value = self._store.get(key)
-            if value is None:
-                return 'No such key'
-            else:
-                return value
+        if value is None:
+            return 'No such key'
+        return value
+
+    def _read_many(self, keys):
+        if self._snapshot is not None:
+            values = self._store.get_many_at(keys, self._snapshot)
+        else:
+            values = self._store.get_many(keys)
+        if self._write_buffer:
+            values = [self._write_buffer.get(key, value)
+                      for key, value in zip(keys, values)]
+        return ['No such key' if value is None else value
+                for value in values]
+
+    def _write(self, key, value):
+        # Called with the exclusive lock on @key held
+        if self._write_buffer is not None:
+            if self._write_conflict([key]):
+                return self.abort(DEADLOCK)
+            self._write_buffer[key] = value
+        else:
+            if key not in self._undo_log:
+                self._undo_log[key] = self._store.get(key)
+            self._store.put(key, value)
+        return 'Success'
+
+    def _write_many(self, items):
+        if self._write_buffer is not None:
+            items = list(items)
+            if self._write_conflict([key for key, value in items]):
+                return self.abort(DEADLOCK)
+            self._write_buffer.update(items)
+            return 'Success'
+        undo_log = self._undo_log
+        keys = sorted(set(key for key, value in items if key not in undo_log))
+        if keys:
+            undo_log.update(zip(keys, self._store.get_many(keys)))
+        self._store.put_many(items)
+        return 'Success'
 
     def release_and_grant_locks(self):
         """
@@ -184,52 +459,86 @@ class TransactionHandler:
 
         @param self: the transaction handler.
         """
-        for l in self._acquired_locks:
-            only_this_x = True
-            only_shared = True
-            for lock in self._lock_table[l[0]][0]:
-                if lock[0] != self._xid:
-                    only_this_x = False
-                if lock[1] == "X":
-                    only_shared = False
-
-            # I am the only lock so I need to pass control to the next item in queue 
-            if only_this_x:
-                # If nothing in the queue, remove from lock table! No more locks!
-                if len(self._lock_table[l[0]][1]) == 0:
-                    self._lock_table.pop(l[0], None)
-                else:
-                    #if the next item in queue is "X", pop it and make that the lock in the list
-                    if self._lock_table[l[0]][1][0][1] == "X":
-                        self._lock_table[l[0]][0] = [self._lock_table[l[0]][1].pop(0)]
-                    else: 
-                        # otherwise, add as many "S" locks from the queue as you can!
-                        while len(self._lock_table[l[0]][1]) != 0:
-                            if self._lock_table[l[0]][1][0][1] == "S":
-                                self._lock_table[l[0]][0].append(self._lock_table[l[0]][1].pop(0))
-                            else:
-                                break
-                        self._lock_table[l[0]][0].remove((self._xid, l[1]))
-            else:
-                # I am not the only lock, so I will just quietly bow out
-                self._lock_table[l[0]][0].remove((self._xid, l[1]))
-                # If now there is only one lock left and the queue has an upgrade, make the change
-                if len(self._lock_table[l[0]][0]) == 1 and len(self._lock_table[l[0]][1]) != 0:
-                    for i in range(len(self._lock_table[l[0]][1])):
-                        # Make sure the xids match
-                        if self._lock_table[l[0]][0][0][0] == self._lock_table[l[0]][1][i][0]:
-                            self._lock_table[l[0]][0] = [self._lock_table[l[0]][1].pop(i)]
-                            break
-
-        self._acquired_locks = []
-
-        #Clean up the queue too!
-        if self._desired_lock != None:
+        # Withdraw the pending request first, so that an upgrade we were
+        # waiting for is not granted to us on the way out. A request that was
+        # granted but never picked up by check_lock() is released below.
+        if self._desired_lock is not None:
             key = self._desired_lock[0]
-            lock_type = self._desired_lock[1]
-            if (self._xid, lock_type) in self._lock_table[key][1]:
-                self._lock_table[key][1].remove((self._xid, lock_type))                
+            self._lock_table.cancel(key, self._xid)
+            self._release(key)
             self._desired_lock = None
+            self._pending_batch = None
+            # Wake up anybody blocked in wait_for_lock() on our behalf
+            self._notify_granted()
+
+        for key in self._acquired_locks:
+            self._release(key)
+        self._acquired_locks.clear()
+        self._row_locks = {}
+        self._escalated = set()
+        self._wait_deadline = None
+        self._wait_started = None
+        self._prepared = False
+        self._started = False
+        if self._lock_table.prevention is not None:
+            self._lock_table.prevention.end(self)
+
+    def _start(self):
+        # A handler that has finished a transaction starts the next one with
+        # its next request
+        if self._started:
+            return
+        self._started = True
+        self._wounded = False
+        if self._lock_table.prevention is not None:
+            self._lock_table.prevention.begin(self)
+
+    def _release(self, key):
+        for xid, mode, notify in self._lock_table.release(key, self._xid):
+            if notify is not None:
+                notify()
+
+    def _notify_granted(self):
+        self._granted.set()
+        if self._grant_callback is not None:
+            self._grant_callback(self)
+
+    def set_grant_callback(self, callback):
+        """
+        Registers a function to be called as callback(@handler) when the lock
+        this transaction is waiting for is granted, so that the server handler
+        can resume the blocked request immediately and then call check_lock()
+        to complete it. The callback is also called when the transaction is
+        aborted while waiting. It runs on the thread of the transaction that
+        released the lock, so it should only hand the work off, for example
+        with loop.call_soon_threadsafe(). Pass None to remove the callback.
+
+        @param self: the transaction handler.
+        @param callback: a function taking the transaction handler, or None.
+        """
+        self._grant_callback = callback
+
+    def wait_for_lock(self, timeout=None):
+        """
+        Blocks the calling thread without polling until the lock that
+        perform_get() or perform_put() is waiting for has been granted, then
+        completes the operation.
+
+        @param self: the transaction handler.
+        @param timeout: the maximum number of seconds to wait, or None to wait
+        forever.
+
+        @return: whatever check_lock() returns. If the wait times out, or the
+        transaction is aborted while waiting, returns None.
+        """
+        if self._desired_lock is None:
+            return
+        if self._wait_deadline is not None:
+            remaining = max(0, self._wait_deadline - time.time())
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        self._granted.wait(timeout)
+        return self.check_lock()
 
     def commit(self):
         """
@@ -238,13 +547,102 @@ class TransactionHandler:
         Note: This method is already implemented for you, and you only need to
         implement the subroutine release_locks().
 
+        If the transaction has a write-ahead log, its writes are made durable
+        before any lock is released, so nobody can read them before they are.
+
         @param self: the transaction handler.
 
         @return: returns 'Transaction Completed'
         """
+        self._log_commit()
+        self._apply_writes()
         self.release_and_grant_locks()
+        self._end_snapshot()
         return 'Transaction Completed'
 
+    def prepare(self):
+        """
+        Prepares the transaction for two-phase commit. Once this returns, the
+        transaction can commit even if the process crashes: if it has a
+        write-ahead log, its writes and the undo values of the keys it wrote
+        in place are logged in a prepare record, which the log replays as
+        prepared until a commit() or abort() records the outcome. The
+        transaction keeps its locks until then.
+
+        A transaction that has written nothing has nothing to lose either way,
+        so it commits right away instead.
+
+        @param self: the transaction handler.
+
+        @return: 'Prepared', or 'Transaction Completed' if it committed.
+        """
+        if self._read_only():
+            return self.commit()
+        self._log_prepare()
+        self._prepared = True
+        return 'Prepared'
+
+    @property
+    def prepared(self):
+        return self._prepared
+
+    def restore(self, writes, undo):
+        """
+        Puts a transaction that was prepared before a crash back into the
+        prepared state, taking its locks and redoing its writes. Must be called
+        on a new handler before other transactions run.
+
+        @param writes, undo: as replayed from the write-ahead log, see
+        WriteAheadLog.prepared.
+        """
+        for key, value in writes:
+            if TransactionHandler.perform_put(self, key, value) != 'Success':
+                raise RuntimeError('transaction %r cannot lock %r' %
+                                   (self._xid, key))
+        for key, value in undo:
+            self._undo_log[key] = value
+        self._prepared = True
+
+    def _write_conflict(self, keys):
+        # First committer wins under MVCC
+        return self._snapshot is not None and \
+            self._store.committed_since(keys, self._snapshot)
+
+    def _read_only(self):
+        return not self._undo_log and not self._write_buffer
+
+    def _final_writes(self):
+        if self._write_buffer:
+            return list(self._write_buffer.items())
+        keys = list(self._undo_log)
+        return list(zip(keys, self._store.get_many(keys)))
+
+    def _log_prepare(self):
+        if self._wal is not None:
+            self._wal.prepare(self._xid, self._final_writes(),
+                              list(self._undo_log.items()))
+
+    def _log_commit(self):
+        if self._wal is None:
+            return
+        if self._prepared:
+            self._wal.decide(self._xid, True)
+        elif not self._read_only():
+            self._wal.commit(self._xid, self._final_writes())
+
+    def _apply_writes(self):
+        if self._write_buffer:
+            if self._snapshot is not None:
+                self._store.commit_writes(self._write_buffer.items())
+            else:
+                self._store.put_many(self._write_buffer.items())
+            self._write_buffer.clear()
+
+    def _end_snapshot(self):
+        if self._snapshot is not None:
+            self._store.end(self._snapshot)
+            self._snapshot = None
+
     def abort(self, mode):
         """
         Aborts the transaction.
@@ -261,10 +659,16 @@ class TransactionHandler:
         @return: if mode == USER, returns 'User Abort'. If mode == DEADLOCK,
         returns 'Deadlock Abort'.
         """
-        while (len(self._undo_log) > 0):
-            k,v = self._undo_log.pop()
-            self._store.put(k, v)
+        if self._lock_table.metrics is not None:
+            self._lock_table.metrics.abort(self._xid, mode)
+        if self._prepared and self._wal is not None:
+            self._wal.decide(self._xid, False)
+        self._store.put_many(self._undo_log.items())
+        self._undo_log.clear()
+        if self._write_buffer:
+            self._write_buffer.clear()
         self.release_and_grant_locks()
+        self._end_snapshot()
         if (mode == USER):
             return 'User Abort'
         else:
@@ -273,11 +677,13 @@ class TransactionHandler:
     def check_lock(self):
         """
         If perform_get() or perform_put() returns None, then the transaction is
-        waiting to acquire a lock. This method is called periodically to check
-        if the lock has been granted due to commit or abort of other
-        transactions. If so, then this method returns the string that would 
-        have been returned by perform_get() or perform_put() if the method had
-        not been blocked. Otherwise, this method returns None.
+        waiting to acquire a lock. This method is called to check if the lock
+        has been granted due to commit or abort of other transactions, either
+        after the grant has been signalled (see set_grant_callback() and
+        wait_for_lock()) or periodically as a fallback. If so, then this
+        method returns the string that would have been returned by
+        perform_get() or perform_put() if the method had not been blocked.
+        Otherwise, this method returns None.
 
         As an example, suppose Joe is trying to perform 'GET a'. If Nisha has an
         exclusive lock on key 'a', then Joe's transaction is blocked, and
@@ -303,49 +709,63 @@ class TransactionHandler:
         @return: if the lock has been granted, then returns whatever would be
         returned by perform_get() and perform_put() when the transaction
         successfully acquired the lock. If the lock has not been granted,
-        returns None.
+        returns None, unless the wait has timed out under a lock-wait timeout
+        policy, in which case the transaction is aborted and this returns
+        'Deadlock Abort'.
         """
 
+        if self._desired_lock is None:
+            return
         key = self._desired_lock[0]
         lock_type = self._desired_lock[1]
+        held = self._lock_table.held(key, self._xid)
+        if not covers(held, lock_type):
+            if self._wounded:
+                return self.abort(DEADLOCK)
+            if (self._wait_deadline is not None and
+                    time.time() >= self._wait_deadline):
+                return self.abort(DEADLOCK)
+            return
 
-        for lock in self._lock_table[key][0]:
-            # I HAVE THE LOCK!!! WHOOO!!!
-            if lock[0] == self._xid and lock_type == lock[1]:
-                if lock_type == "S":
-                    self._acquired_locks.append((key, "S"))
-                    value = self._store.get(key)
-                    if value is None:
-                        return 'No such key'
-                    else:
-                        return value
-                elif lock_type == "X":
-                    # There's been an upgrade
-                    if self._acquired_locks.count((key, "S")) > 0:
-                        self._acquired_locks.remove((key, "S"))
-                    self._undo_log.append((key, self._store.get(key)))
-                    self._store.put(key, self._desired_lock[2])
-                    self._acquired_locks.append((key, "X"))
-                    return 'Success'
-
-        return
+        desired_lock, self._desired_lock = self._desired_lock, None
+        self._wait_deadline = None
+        self._granted.clear()
+        if self._wait_started is not None:
+            self._lock_table.metrics.wait(key, self._xid, lock_type,
+                                          time.time() - self._wait_started)
+            self._wait_started = None
+        # There may have been an upgrade, held is what we hold now
+        if self._pending_batch is not None:
+            locks, index, finish = self._pending_batch
+            self._add_acquired_lock(key, held, locks[index][2])
+            self._pending_batch = (locks, index + 1, finish)
+            return self._continue_batch()
+        self._acquired_locks[key] = held
+        if lock_type == SHARED:
+            return self._read(key)
+        return self._write(key, desired_lock[2])
 
 """
 Part II: Implement deadlock detection method for the transaction coordinator
 
-The transaction coordinator has access to the following object:
+The transaction coordinator has access to the following objects:
 
 self._lock_table: see description from Part I
+
+self._cost: a function returning the cost of aborting a transaction given its
+xid, such as the rollback_cost() of its handler, or None. Costs must be
+comparable with each other.
 """
 
 class TransactionCoordinator:
 
-    def __init__(self, lock_table):
-        self._lock_table = lock_table
+    def __init__(self, lock_table, cost=None):
+        self._lock_table = lock_table_of(lock_table)
+        self._cost = cost
 
     def detect_deadlocks(self):
         """
-        Constructs a waits-for graph from the lock table, and runs a cycle
+        Walks the waits-for graph kept by the lock table, and runs a cycle
         detection algorithm to determine if a transaction needs to be aborted.
         You may choose which one transaction you plan to abort, as long as your
         choice is deterministic. For example, if transactions 1 and 2 form a
@@ -358,7 +778,8 @@ class TransactionCoordinator:
         deadlocked transactions, then this method will be called multiple
         times, with each call breaking one of the cycles, until it returns None
         to indicate that there are no more cycles. Afterward, the surviving
-        transactions will continue to run as normal.
+        transactions will continue to run as normal. To break every cycle in a
+        single pass, use find_deadlocks() instead.
 
         Note: in this method, you only need to find and return the xid of a
         transaction that needs to be aborted. You do not have to perform the
@@ -367,33 +788,46 @@ class TransactionCoordinator:
         @param self: the transaction coordinator.
 
         @return: If there are no cycles in the waits-for graph, returns None.
-        Otherwise, returns the xid of a transaction in a cycle.
-        
-        waiting {a, [b]} where b waits on a 
-        """
-        waiting = {}
-        for key in self._lock_table.keys():
-            lock_info = self._lock_table[key]
-            for lock in lock_info[0]:
-                if not waiting.has_key(lock[0]):
-                    waiting[lock[0]] = []
-                for waiting_lock in lock_info[1]:
-                    if waiting_lock[0] != lock[0]:
-                        waiting[lock[0]].append(waiting_lock[0])
-
-        def find_cycle(waiting, start, already_seen):
-            stack = [start]
-            while stack:
-                vertex = stack.pop()
-                if vertex in already_seen:
-                    return vertex
-                else:
-                    already_seen.append(vertex)
-                    for item in waiting[vertex]:
-                        if waiting.has_key(item):
-                            stack.append(item)
-            return
-
-        if waiting != {}:
-            return find_cycle(waiting, waiting.keys()[0], [])
+        Otherwise, returns the xid of a transaction in a cycle, the smallest
+        of the xids find_deadlocks() would return.
+        """
+        victims = self.find_deadlocks()
+        if victims:
+            return victims[0]
         return
+
+    def find_deadlocks(self):
+        """
+        Finds every cycle in the waits-for graph in one pass, using Tarjan's
+        strongly connected components algorithm, and picks the transactions to
+        abort to break all of them. The cheapest transaction to abort according
+        to self._cost is picked from each deadlocked component, and among
+        equally cheap ones, or without a cost function, the youngest, the one
+        with the largest xid. For a component that is a single cycle this
+        costs the least rollback work possible; for more tangled ones the
+        choice is made one victim at a time.
+
+        Only transactions waiting on keys that gained waits-for edges since the
+        last pass that found no cycle are searched from, and only blocked
+        transactions have outgoing edges, so the cost of a pass depends on the
+        number of waiting transactions rather than on the size of the table.
+
+        @param self: the transaction coordinator.
+
+        @return: a sorted list of the xids of the transactions to abort, empty
+        if there are no cycles.
+        """
+        starts, waits_for = self._lock_table.waits_for_snapshot()
+        if self._cost is None:
+            victims = deadlock_victims(starts, waits_for)
+        else:
+            victims = deadlock_victims(starts, waits_for, self._cheapest)
+        if victims:
+            # Search from here again until the victims have been aborted
+            self._lock_table.mark_touched(starts)
+            if self._lock_table.metrics is not None:
+                self._lock_table.metrics.deadlock(victims)
+        return victims
+
+    def _cheapest(self, xids):
+        return min(xids, key=lambda xid: (self._cost(xid), -xid))
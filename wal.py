@@ -0,0 +1,191 @@
+import json
+import os
+import threading
+import zlib
+
+"""
+An append-only write-ahead log of committed transactions.
+
+Every commit appends one record with the transaction's xid and the final value
+of every key it wrote, and returns once the record is on disk. Committers that
+arrive while a flush is in progress wait for the next one and are written out
+together by whichever of them gets there first, so a burst of commits costs
+one fsync per batch instead of one per transaction.
+
+Each record is a line of the form '<crc32> <json>'. A record torn by a crash
+fails its checksum, and replay() stops at the first such record. Opening the
+log cuts it off there, so that the records appended after a restart are not
+hidden behind it.
+
+Replaying the log on startup restores every committed write. Writes that a
+transaction made in place and never committed are not undone by the log; a
+store that keeps those out of the way until commit (see the write-buffered
+mode of TransactionHandler) is fully recoverable.
+
+For two-phase commit, a participant logs a prepare record with its writes,
+and the pre-images of the keys it wrote in place, before it votes to commit,
+and later a decision record with the outcome. replay() applies the writes of a
+prepared transaction when it reaches its commit decision, and leaves those of
+transactions that were prepared but never decided in @prepared, for the
+participant to hold on to until it learns the outcome. A coordinator logs its
+decisions in the same way, and reads them back with decisions().
+"""
+class WriteAheadLog(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._truncate_torn_tail()
+        self._file = open(path, 'ab')
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = []
+        self._appended = 0
+        self._durable = 0
+        self._flushing = False
+        self._failed = False
+        self.prepared = {}
+
+    def close(self):
+        with self._cond:
+            self._file.close()
+
+    def commit(self, xid, writes):
+        """
+        Appends the commit record of a transaction and blocks until it is
+        durable.
+
+        @param xid: the transaction's ID.
+        @param writes: a list of (@key, @value) pairs, the final value of each
+        key the transaction wrote. A value of None means the key was removed.
+        """
+        self._append([xid, writes])
+
+    def prepare(self, xid, writes, undo):
+        """
+        Appends the prepare record of a transaction and blocks until it is
+        durable.
+
+        @param writes: as for commit().
+        @param undo: a list of (@key, @value) pairs, the values the keys the
+        transaction wrote in place had before it wrote them.
+        """
+        self._append(['prepare', xid, writes, undo])
+
+    def decide(self, xid, commit):
+        """
+        Appends the outcome of a prepared transaction, or of a distributed
+        transaction this log is the coordinator's log of, and blocks until it
+        is durable.
+        """
+        self._append(['commit' if commit else 'abort', xid])
+
+    def _append(self, entry):
+        payload = json.dumps(entry, separators=(',', ':'))
+        record = ('%08x %s\n' % (zlib.crc32(payload.encode('utf-8')) &
+                                 0xffffffff, payload)).encode('utf-8')
+        with self._cond:
+            self._pending.append(record)
+            self._appended += 1
+            sequence = self._appended
+            while self._durable < sequence:
+                if self._failed:
+                    raise IOError('%s: an earlier flush failed' % self._path)
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                # Nobody is flushing, so we write out everything that has
+                # queued up so far, our own record included
+                self._flushing = True
+                batch, self._pending = self._pending, []
+                last = self._appended
+                self._cond.release()
+                try:
+                    self._file.write(b''.join(batch))
+                    self._file.flush()
+                    self._sync()
+                except BaseException:
+                    self._cond.acquire()
+                    self._flushing = False
+                    self._failed = True
+                    self._cond.notify_all()
+                    raise
+                self._cond.acquire()
+                self._flushing = False
+                self._durable = last
+                self._cond.notify_all()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+
+    def replay(self, store):
+        """
+        Applies every committed transaction in the log to @store, in commit
+        order. Afterwards @prepared maps the xid of every transaction that was
+        prepared but not decided to a tuple (@writes, @undo) as given to
+        prepare().
+
+        @return: the number of transactions replayed.
+        """
+        count = 0
+        self.prepared = {}
+        with store.write_batch():
+            for record in self._records():
+                if record[0] == 'prepare':
+                    self.prepared[record[1]] = (record[2], record[3])
+                    continue
+                if record[0] in ('commit', 'abort'):
+                    entry = self.prepared.pop(record[1], None)
+                    if entry is None or record[0] == 'abort':
+                        continue
+                    writes = entry[0]
+                else:
+                    writes = record[1]
+                store.put_many([(key, value) for key, value in writes])
+                count += 1
+        return count
+
+    def decisions(self):
+        """
+        Returns a dict mapping the xid of every decided transaction to True
+        if it committed and False if it aborted.
+        """
+        return dict((record[1], record[0] == 'commit')
+                    for record in self._records()
+                    if record[0] in ('commit', 'abort'))
+
+    def _truncate_torn_tail(self):
+        if not os.path.exists(self._path):
+            return
+        valid = 0
+        for record, valid in self._scan():
+            pass
+        if valid < os.path.getsize(self._path):
+            with open(self._path, 'r+b') as log:
+                log.truncate(valid)
+                log.flush()
+                os.fsync(log.fileno())
+
+    def _records(self):
+        for record, end in self._scan():
+            yield record
+
+    def _scan(self):
+        # Yields each valid record with the offset just past it
+        with open(self._path, 'rb') as log:
+            end = 0
+            for line in log:
+                record = self._decode(line)
+                if record is None:
+                    break
+                end += len(line)
+                yield record, end
+
+    def _decode(self, line):
+        if not line.endswith(b'\n'):
+            return None
+        checksum, _, payload = line.rstrip(b'\n').partition(b' ')
+        try:
+            if int(checksum, 16) != zlib.crc32(payload) & 0xffffffff:
+                return None
+            return json.loads(payload.decode('utf-8'))
+        except ValueError:
+            return None
@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from kvstore import InMemoryKVStore
+from locktable import LockTable
+from student import USER, TransactionHandler
+from wal import WriteAheadLog
+
+class SlowLog(WriteAheadLog):
+    def __init__(self, path):
+        WriteAheadLog.__init__(self, path)
+        self.syncs = 0
+
+    def _sync(self):
+        self.syncs += 1
+        time.sleep(0.05)
+
+class WriteAheadLogTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'wal')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_replay(self):
+        wal = WriteAheadLog(self._path)
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store, wal)
+        t1 = TransactionHandler(lock_table, 1, store, wal)
+        t2 = TransactionHandler(lock_table, 2, store, wal)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t0.perform_put('a', '1'), 'Success')
+        self.assertEqual(t0.perform_put('b', '0'), 'Success')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.perform_put('a', '2'), 'Success')
+        self.assertEqual(t1.abort(USER), 'User Abort')
+        self.assertEqual(t2.perform_get('b'), '0')
+        self.assertEqual(t2.perform_put('c', '2'), 'Success')
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        wal.close()
+
+        recovered = InMemoryKVStore()
+        self.assertEqual(WriteAheadLog(self._path).replay(recovered), 2)
+        self.assertEqual(recovered.get_many(['a', 'b', 'c']), ['1', '0', '2'])
+
+    def test_torn_record(self):
+        wal = WriteAheadLog(self._path)
+        wal.commit(0, [('a', '0')])
+        wal.commit(1, [('a', '1')])
+        wal.close()
+        with open(self._path, 'rb') as log:
+            data = log.read()
+        with open(self._path, 'wb') as log:
+            log.write(data[:-3])
+        store = InMemoryKVStore()
+        self.assertEqual(WriteAheadLog(self._path).replay(store), 1)
+        self.assertEqual(store.get('a'), '0')
+
+    def test_append_after_torn_record(self):
+        wal = WriteAheadLog(self._path)
+        wal.commit(0, [('a', '0')])
+        wal.commit(1, [('a', '1')])
+        wal.close()
+        with open(self._path, 'rb') as log:
+            data = log.read()
+        with open(self._path, 'wb') as log:
+            log.write(data[:-3])
+        wal = WriteAheadLog(self._path)
+        self.assertEqual(wal.replay(InMemoryKVStore()), 1)
+        wal.commit(2, [('b', '2')])
+        wal.close()
+        store = InMemoryKVStore()
+        self.assertEqual(WriteAheadLog(self._path).replay(store), 2)
+        self.assertEqual(store.get_many(['a', 'b']), ['0', '2'])
+
+    def test_group_commit(self):
+        wal = SlowLog(self._path)
+        threads = [threading.Thread(target=wal.commit, args=(xid, [('a', 'v')]))
+                   for xid in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        wal.close()
+        self.assertTrue(wal.syncs < 10)
+        self.assertEqual(WriteAheadLog(self._path).replay(InMemoryKVStore()), 10)
+
+    def test_prepared_replay(self):
+        wal = WriteAheadLog(self._path)
+        wal.commit(0, [('a', '0')])
+        wal.prepare(1, [('a', '1'), ('b', '1')], [('a', '0'), ('b', None)])
+        wal.prepare(2, [('c', '2')], [('c', None)])
+        wal.prepare(3, [('d', '3')], [('d', None)])
+        wal.decide(2, False)
+        wal.decide(1, True)
+        wal.decide(4, True)
+        wal.close()
+        wal = WriteAheadLog(self._path)
+        store = InMemoryKVStore()
+        self.assertEqual(wal.replay(store), 2)
+        self.assertEqual(store.get_many(['a', 'b', 'c', 'd']),
+                         ['1', '1', None, None])
+        self.assertEqual(wal.prepared, {3: ([['d', '3']], [['d', None]])})
+        self.assertEqual(wal.decisions(), {1: True, 2: False, 4: True})
+        wal.close()
+
+    def test_prepare(self):
+        wal = WriteAheadLog(self._path)
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store, wal)
+        self.assertEqual(t0.perform_get('a'), 'No such key')
+        # Nothing written, nothing to wait for
+        self.assertEqual(t0.prepare(), 'Transaction Completed')
+        self.assertEqual(lock_table, {})
+        t1 = TransactionHandler(lock_table, 1, store, wal)
+        self.assertEqual(t1.perform_put('a', '1'), 'Success')
+        self.assertEqual(t1.prepare(), 'Prepared')
+        self.assertTrue(t1.prepared)
+        wal.close()
+
+        # The process crashes while t1 is prepared
+        wal = WriteAheadLog(self._path)
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        self.assertEqual(wal.replay(store), 0)
+        t1 = TransactionHandler(lock_table, 1, store, wal)
+        t1.restore(*wal.prepared[1])
+        t2 = TransactionHandler(lock_table, 2, store, wal)
+        self.assertEqual(t2.perform_get('a'), None)
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), '1')
+        wal.close()
+        wal = WriteAheadLog(self._path)
+        self.assertEqual(wal.replay(InMemoryKVStore()), 1)
+        self.assertEqual(wal.prepared, {})
+        wal.close()
+
+    def test_abort_prepared(self):
+        wal = WriteAheadLog(self._path)
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        store.put('a', '0')
+        t0 = TransactionHandler(lock_table, 0, store, wal)
+        self.assertEqual(t0.perform_put('a', '1'), 'Success')
+        self.assertEqual(t0.prepare(), 'Prepared')
+        wal.close()
+        wal = WriteAheadLog(self._path)
+        store = InMemoryKVStore()
+        store.put('a', '0')
+        wal.replay(store)
+        t0 = TransactionHandler(LockTable(), 0, store, wal)
+        t0.restore(*wal.prepared[0])
+        self.assertEqual(store.get('a'), '1')
+        self.assertEqual(t0.abort(USER), 'User Abort')
+        self.assertEqual(store.get('a'), '0')
+        self.assertEqual(wal.decisions(), {0: False})
+        wal.close()
+
+if __name__ == '__main__':
+    unittest.main()